@@ -0,0 +1,191 @@
+"""
+Precomputed answers for every combination of the checklist symptoms.
+
+With the 14 symptoms in rules_engine.SYMPTOMS there are only 2**14 = 16,384
+possible fact sets, so the rule matches (and optionally the RAG top-k for the
+joined symptom string) can be computed offline and served as array lookups:
+
+    python src/answer_table.py                 # rules only
+    python src/answer_table.py --with-rag      # + RAG top-k from data/rag_index
+
+Layout (one .npz): bit i of a combination code is SYMPTOMS[i]; rule hits are
+stored CSR-style (rule_offsets / rule_ids), RAG results as (n_codes, top_k)
+position and score arrays. Requests with free text or a true symptom outside
+the vocabulary fall back to live computation, as do tables built for other
+rules or another index (checked by fingerprint).
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from typing import TYPE_CHECKING, Dict, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+from metrics import CACHE_LOOKUPS
+from rules_engine import SYMPTOMS, RuleEngine
+
+if TYPE_CHECKING:
+    from rag import RAGIndex
+
+ANSWER_TABLE_PATH = os.getenv("ANSWER_TABLE_PATH", "data/answer_table.npz")
+PRECOMPUTE_TOP_K = 5  # matches the top_k of the API / hybrid retrieval
+PRECOMPUTE_BATCH = 1024  # queries embedded + searched per call
+
+
+def rules_fingerprint(rules: List[Mapping]) -> str:
+    # dict(): compact Rule objects hash the same as the plain rule dicts
+    return hashlib.sha1(json.dumps([dict(r) for r in rules], sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def combination_query(code: int, symptoms: List[str] = SYMPTOMS) -> str:
+    """The RAG query the live path builds for this combination (rules_engine.symptom_query)."""
+    return ", ".join(s for i, s in enumerate(symptoms) if code >> i & 1)
+
+
+def precompute(engine: RuleEngine, rag: "RAGIndex" = None, symptoms: List[str] = SYMPTOMS,
+               top_k: int = PRECOMPUTE_TOP_K, batch: int = PRECOMPUTE_BATCH) -> Dict[str, np.ndarray]:
+    n_codes = 1 << len(symptoms)
+    codes = np.arange(n_codes, dtype=np.int64)
+    # (n_codes, n_symptoms) 0/1 matrix in checklist order, then reordered to the engine's columns
+    bits = ((codes[:, None] >> np.arange(len(symptoms))) & 1).astype(np.float32)
+    F = np.zeros((n_codes, len(engine.symptom_index)), dtype=np.float32)
+    for i, s in enumerate(symptoms):
+        j = engine.symptom_index.get(s)
+        if j is not None:
+            F[:, j] = bits[:, i]
+    hits = engine.match_matrix(F)
+    rows, rule_ids = np.nonzero(hits)
+    rule_offsets = np.zeros(n_codes + 1, dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=n_codes), out=rule_offsets[1:])
+
+    table = {
+        "symptoms": np.asarray(symptoms),
+        "rule_offsets": rule_offsets,
+        "rule_ids": rule_ids.astype(np.int16 if len(engine.rules) < 2 ** 15 else np.int32),
+        "rules_fingerprint": np.asarray(rules_fingerprint(engine.rules)),
+    }
+    if rag is not None:
+        scores = np.zeros((n_codes, top_k), dtype=np.float32)
+        positions = np.full((n_codes, top_k), -1, dtype=np.int32)
+        for start in range(0, n_codes, batch):
+            stop = min(start + batch, n_codes)
+            D, I = rag.search([combination_query(c, symptoms) for c in range(start, stop)], top_k)
+            scores[start:stop], positions[start:stop] = D, I
+        table.update({
+            "rag_scores": scores,
+            "rag_positions": positions,
+            "rag_fingerprint": np.asarray(rag.fingerprint()),
+        })
+    return table
+
+
+def save_table(table: Dict[str, np.ndarray], path: str = ANSWER_TABLE_PATH):
+    d = os.path.dirname(path)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    tmp = path + ".tmp.npz"
+    np.savez(tmp, **table)
+    os.replace(tmp, path)
+
+
+class AnswerTable:
+    def __init__(self, arrays: Dict[str, np.ndarray], engine: RuleEngine):
+        self.symptoms = [str(s) for s in arrays["symptoms"]]
+        self.bit = {s: i for i, s in enumerate(self.symptoms)}
+        self.rules = engine.rules
+        self.has_rules = str(arrays["rules_fingerprint"]) == rules_fingerprint(engine.rules)
+        if not self.has_rules:
+            print("[answer table] rules changed since the table was built; rule lookups disabled")
+        self.rule_offsets = arrays["rule_offsets"]
+        self.rule_ids = arrays["rule_ids"]
+        self.rag_scores = arrays.get("rag_scores")
+        self.rag_positions = arrays.get("rag_positions")
+        self.rag_fingerprint = str(arrays["rag_fingerprint"]) if "rag_fingerprint" in arrays else None
+        self._rag_checked = {}  # id(rag) -> fingerprint matches
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls, path: str = ANSWER_TABLE_PATH, engine: RuleEngine = None) -> Optional["AnswerTable"]:
+        """None if no table was precomputed."""
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as z:
+            arrays = {k: z[k] for k in z.files}
+        return cls(arrays, engine or RuleEngine(compiled=True))
+
+    def code(self, facts: Dict[str, bool], text: str = "") -> Optional[int]:
+        """Combination code of a checklist-only request, None when the table can't answer it."""
+        if text and text.strip():
+            return None
+        code = 0
+        for k, v in facts.items():
+            if not v:
+                continue
+            bit = self.bit.get(k)
+            if bit is None:
+                return None
+            code |= 1 << bit
+        return code
+
+    def rule_matches(self, facts: Dict[str, bool]) -> Optional[List[dict]]:
+        """Same as RuleEngine.evaluate() (free text never affects rules); None -> evaluate live."""
+        code = self.code(facts) if self.has_rules else None
+        if code is None:
+            self.misses += 1
+            CACHE_LOOKUPS.inc(cache="answer_table", result="miss")
+            return None
+        self.hits += 1
+        CACHE_LOOKUPS.inc(cache="answer_table", result="hit")
+        ids = self.rule_ids[self.rule_offsets[code]:self.rule_offsets[code + 1]]
+        return [self.rules[i] for i in ids]
+
+    def _rag_ok(self, rag: "RAGIndex") -> bool:
+        ok = self._rag_checked.get(id(rag))
+        if ok is None:
+            ok = self.rag_fingerprint is not None and self.rag_fingerprint == rag.fingerprint()
+            if self.rag_fingerprint is not None and not ok:
+                print("[answer table] RAG index changed since the table was built; retrieval lookups disabled")
+            self._rag_checked[id(rag)] = ok
+        return ok
+
+    def retrieved(self, facts: Dict[str, bool], rag: "RAGIndex", text: str = "",
+                  top_k: int = PRECOMPUTE_TOP_K) -> Optional[List[Tuple[float, dict]]]:
+        """Same shape as RAGIndex.query(); None -> query the index live."""
+        code = self.code(facts, text)
+        if code is None or self.rag_positions is None or top_k > self.rag_positions.shape[1] \
+                or not self._rag_ok(rag):
+            self.misses += 1
+            CACHE_LOOKUPS.inc(cache="answer_table", result="miss")
+            return None
+        self.hits += 1
+        CACHE_LOOKUPS.inc(cache="answer_table", result="hit")
+        return [(float(s), rag.passages[int(i)])
+                for s, i in zip(self.rag_scores[code, :top_k], self.rag_positions[code, :top_k]) if i >= 0]
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "rules": self.has_rules,
+                "rag": self.rag_positions is not None}
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Precompute rule (and RAG) answers for every checklist combination.")
+    p.add_argument("--out", default=ANSWER_TABLE_PATH)
+    p.add_argument("--with-rag", action="store_true", help="also store the RAG top-k per combination")
+    p.add_argument("--index", default="data/rag_index")
+    p.add_argument("--top-k", type=int, default=PRECOMPUTE_TOP_K)
+    args = p.parse_args()
+
+    t = time.perf_counter()
+    rag = None
+    if args.with_rag:
+        from rag import RAGIndex
+        rag = RAGIndex()
+        rag.load(args.index)
+    table = precompute(RuleEngine(compiled=True), rag, top_k=args.top_k)
+    save_table(table, args.out)
+    print(f"{len(table['rule_offsets']) - 1} combinations → {args.out} "
+          f"({os.path.getsize(args.out) / 1024:.0f} KiB, {time.perf_counter() - t:.1f}s)")
@@ -1,37 +1,206 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, Any
-from hybrid_engine import HybridEngine
-from rules_engine import RuleEngine
+from typing import Dict, Any, List, Optional
+import asyncio
+import io
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+import numpy as np
+from hybrid_engine import FAST_PATH_POLICIES, StageTimeout
+from metrics import CONTENT_TYPE, REQUEST_SECONDS, REQUESTS, collect_timings, render, timed, timings_ms
+from resources import get_answer_table, get_hybrid_engine, get_rule_engine, warm_up
 
-app = FastAPI(title="Expert System Medical Diagnosis API (Prototype)")
+WARM_UP = os.getenv("WARM_UP", "1") == "1"  # set WARM_UP=0 for rules-only deployments
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # load embedder + index and run a dummy query before serving traffic
+    if WARM_UP:
+        warm_up()
+    yield
+
+app = FastAPI(title="Expert System Medical Diagnosis API (Prototype)", lifespan=lifespan)
 
 class SymptomsPayload(BaseModel):
     symptoms: Dict[str, bool]
     text: str = ""  # optional user text
-    mode: str = "hybrid"  # "rules" | "rag" | "hybrid"
+    mode: str = "hybrid"  # "rules" | "scored" | "rag" | "hybrid"
+    top_k: int = 5  # scored only: number of ranked partial matches
+    timings: bool = False  # add a per-stage "timings" breakdown (ms) to the response
+    stream: bool = False  # hybrid only: server-sent events with the LLM summary as it is generated
+    fast_path: Optional[str] = None  # hybrid only: "off" | "emergency" | "confident" overrides HYBRID_FAST_PATH
+
+class BatchPayload(BaseModel):
+    patients: List[Dict[str, bool]]
+
+BATCH_CHUNK_ROWS = 10000  # rows matched per matmul while streaming
 
-# instantiate shared engine (lazy load rag inside hybrid)
-hybrid = HybridEngine()
+@app.get("/stats")
+def stats():
+    hybrid = get_hybrid_engine()
+    cache = hybrid.llm_cache
+    table = get_answer_table()
+    return {"rag": hybrid.rag.stats(),
+            "llm_cache": {"hits": getattr(cache, "hits", None), "misses": getattr(cache, "misses", None)},
+            "answer_table": table.stats() if table else None,
+            "semantic_cache": hybrid.semantic_cache.stats() if hybrid.semantic_cache is not None else None}
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text format: request/stage latency histograms, cache and LLM error counters."""
+    return Response(render(), media_type=CONTENT_TYPE)
 
 @app.post("/diagnose")
-def diagnose(payload: SymptomsPayload):
+async def diagnose(payload: SymptomsPayload):
+    start = time.perf_counter()
+    status = "ok"
+    streamed = False
     try:
-        if payload.mode == "rules":
-            engine = RuleEngine()
-            matches = engine.evaluate(payload.symptoms)
-            return {"mode":"rules","matches":matches}
-
-        elif payload.mode == "rag":
-            out = hybrid.rag.query(payload.text or ", ".join([k for k,v in payload.symptoms.items() if v]))
-            # return minimal info
-            return {"mode":"rag", "retrieved":[{"score":float(s),"text":p["text"]} for s,p in out]}
-
-        elif payload.mode == "hybrid":
-            out = hybrid.explain(payload.symptoms, payload.text)
-            return {"mode":"hybrid","rule_matches":out["rule_matches"], "retrieved": [{"score":s,"text":p["text"]} for s,p in out["retrieved"]], "llm_summary": out["llm_summary"]}
-
-        else:
-            raise HTTPException(status_code=400, detail="Unknown mode")
+        with collect_timings() as timings:
+            out = await _diagnose(payload, timings, start)
+        streamed = isinstance(out, StreamingResponse)  # observed by _sse_hybrid() when the stream closes
+        if payload.timings and isinstance(out, dict):
+            out["timings"] = timings_ms(timings)
+        return out
+    except HTTPException as e:
+        status = str(e.status_code)
+        raise
+    except StageTimeout as e:
+        status = "504"
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
+        status = "500"
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if not streamed:
+            REQUESTS.inc(mode=payload.mode, status=status)
+            REQUEST_SECONDS.observe(time.perf_counter() - start, mode=payload.mode)
+
+async def _diagnose(payload: SymptomsPayload, timings: Dict[str, float], start: float):
+    if payload.mode == "rules":
+        with timed("rules"):
+            table = get_answer_table()
+            matches = table.rule_matches(payload.symptoms) if table else None
+            if matches is None:
+                matches = get_rule_engine().evaluate(payload.symptoms)
+        return {"mode":"rules","matches":_rules_json(matches)}
+
+    elif payload.mode == "scored":
+        with timed("rules"):
+            ranked = get_rule_engine().rank(payload.symptoms, top_k=payload.top_k)
+        return {"mode":"scored","ranked":ranked}
+
+    elif payload.mode == "rag":
+        out = await get_hybrid_engine().retrieve_symptoms_async(payload.symptoms, payload.text)
+        # return minimal info
+        return {"mode":"rag", "retrieved":[{"score":float(s),"text":p["text"]} for s,p in out]}
+
+    elif payload.mode == "hybrid" and payload.fast_path is not None and payload.fast_path not in FAST_PATH_POLICIES:
+        raise HTTPException(status_code=400, detail=f"Unknown fast_path; expected one of {list(FAST_PATH_POLICIES)}")
+
+    elif payload.mode == "hybrid" and payload.stream:
+        out = await get_hybrid_engine().explain_stream_async(payload.symptoms, payload.text, payload.fast_path)
+        return StreamingResponse(_sse_hybrid(out, timings if payload.timings else None, start),
+                                 media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    elif payload.mode == "hybrid":
+        out = await get_hybrid_engine().explain_async(payload.symptoms, payload.text, payload.fast_path)
+        return {"mode":"hybrid","rule_matches":_rules_json(out["rule_matches"]), "retrieved": [{"score":s,"text":p["text"]} for s,p in out["retrieved"]], "llm_summary": out["llm_summary"], "llm_cache": out["llm_cache"], **_path_info(out), "prompt": out.get("prompt")}
+
+    else:
+        raise HTTPException(status_code=400, detail="Unknown mode")
+
+
+def _path_info(out: Dict[str, Any]) -> Dict[str, Any]:
+    """Which hybrid path answered; on the fast path the LLM summary lands in the cache
+    (llm_elaboration "background") or is produced when asked again with fast_path "off"."""
+    info = {"path": out["path"]}
+    if out["path"] == "fast":
+        info.update(fast_reason=out["fast_reason"], llm_elaboration=out["llm_elaboration"])
+    return info
+
+def _rules_json(rules: List[Any]) -> List[dict]:
+    """Rule matches as plain dicts: the shared engine is compact, and Rule is a Mapping, not a dict."""
+    return [dict(r, conditions=list(r["conditions"])) for r in rules]
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def _sse_hybrid(out: Dict[str, Any], timings: Dict[str, float] = None, start: float = None):
+    """
+    Events: "context" (rule matches + retrieved passages), one "chunk" per LLM text
+    chunk, then "done" (cache status and path, plus stage timings if requested) or "error".
+    The request counter / latency (from start) are recorded when the stream closes.
+    """
+    status = "ok"
+    try:
+        yield _sse("context", {"mode": "hybrid", "rule_matches": _rules_json(out["rule_matches"]),
+                               "retrieved": [{"score": s, "text": p["text"]} for s, p in out["retrieved"]]})
+        # the stream runs after diagnose() returned: keep recording into the same request's timings
+        with collect_timings(timings):
+            try:
+                async for chunk in out["llm_stream"]:
+                    yield _sse("chunk", {"text": chunk})
+            except Exception as e:
+                status = "504" if isinstance(e, StageTimeout) else "500"
+                yield _sse("error", {"detail": str(e)})
+                return
+        done = {"llm_cache": out["llm_cache"], **_path_info(out), "prompt": out.get("prompt")}
+        if timings is not None:
+            done["timings"] = timings_ms(timings)
+        yield _sse("done", done)
+    finally:
+        REQUESTS.inc(mode="hybrid", status=status)
+        if start is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, mode="hybrid")
+
+
+def _stream_matches(F: np.ndarray, ids: List[Any] = None):
+    rules_engine = get_rule_engine()
+    for start in range(0, len(F), BATCH_CHUNK_ROWS):
+        hits = rules_engine.match_matrix(F[start:start + BATCH_CHUNK_ROWS])
+        lines = []
+        for offset, row in enumerate(hits):
+            n = start + offset
+            matches = [rules_engine.rules[i] for i in np.flatnonzero(row)]
+            out = {"row": n, "matches": [m["name"] for m in matches], "emergency": any(m["emergency"] for m in matches)}
+            if ids is not None:
+                out["id"] = ids[n]
+            lines.append(json.dumps(out, default=str))
+        yield "\n".join(lines) + "\n"
+
+def _batch_matrix(content_type: str, body: bytes):
+    """(fact matrix, ids or None) for a /diagnose/batch body."""
+    if content_type == "text/csv":
+        import pandas as pd  # only batch file uploads need pandas
+        df = pd.read_csv(io.BytesIO(body))
+    elif content_type in ("application/vnd.apache.parquet", "application/x-parquet", "application/octet-stream"):
+        import pandas as pd
+        df = pd.read_parquet(io.BytesIO(body))
+    else:
+        payload = BatchPayload(**json.loads(body or b"{}"))
+        return get_rule_engine().fact_matrix(payload.patients), None
+    ids = df["id"].tolist() if "id" in df.columns else None
+    return get_rule_engine().frame_matrix(df), ids
+
+@app.post("/diagnose/batch")
+async def diagnose_batch(request: Request):
+    """
+    Rules-only diagnosis for many patients, streamed back as NDJSON (one line per patient).
+    Body is either JSON {"patients": [{symptom: bool, ...}, ...]},
+    a CSV (Content-Type: text/csv) or a Parquet file (application/vnd.apache.parquet)
+    with one boolean column per symptom and an optional "id" column.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    body = await request.body()
+    try:
+        # parsing and the fact matrix are CPU-bound: keep them off the event loop
+        F, ids = await asyncio.to_thread(_batch_matrix, content_type, body)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid batch input: {e}")
+
+    return StreamingResponse(_stream_matches(F, ids), media_type="application/x-ndjson")
@@ -0,0 +1,111 @@
+"""
+Compare embedding backends (torch vs ONNX vs ONNX int8) on CPU.
+
+Reports, per backend:
+ - single-query latency (p50/p95 ms) on short symptom-style queries
+ - batch throughput (passages/sec) over the corpus
+ - agreement with torch: mean cosine between embeddings and top-k overlap of
+   retrieval results from a flat index built with each backend's own vectors
+
+    python src/embedders.py export            # once, creates data/onnx/...
+    python src/bench_embedders.py --data data/passages.csv --json bench_embedders.json
+"""
+
+import argparse
+import json
+import time
+
+import faiss
+import numpy as np
+import pandas as pd
+
+from embedders import BACKENDS, ONNX_DIR, make_embedder
+from rag import EMBED_MODEL_NAME, encode_normalized
+
+DEFAULT_QUERIES = [
+    "fever, cough", "fever, chills, sweating", "chest pain and shortness of breath",
+    "nausea, vomiting, abdominal_pain", "headache, body_pain, fever", "runny nose and sore throat",
+    "is a malaria test needed", "low platelet count", "fatigue, sweating, headache", "cough, sore_throat",
+]
+
+
+def _percentile_ms(samples, q):
+    return float(np.percentile(np.asarray(samples) * 1000.0, q))
+
+
+def bench_backend(backend: str, texts, queries, model_name: str, repeat: int, onnx_root: str = ONNX_DIR):
+    t = time.perf_counter()
+    embedder = make_embedder(model_name, backend, onnx_root=onnx_root)
+    load_s = time.perf_counter() - t
+
+    encode_normalized(embedder, queries[:2])  # warm-up
+    latencies = []
+    for _ in range(repeat):
+        for q in queries:
+            t = time.perf_counter()
+            embedder.encode([q], convert_to_numpy=True)
+            latencies.append(time.perf_counter() - t)
+
+    t = time.perf_counter()
+    passage_vecs = encode_normalized(embedder, texts)
+    throughput = len(texts) / (time.perf_counter() - t)
+    query_vecs = encode_normalized(embedder, queries)
+    return {
+        "backend": backend,
+        "load_s": load_s,
+        "query_p50_ms": _percentile_ms(latencies, 50),
+        "query_p95_ms": _percentile_ms(latencies, 95),
+        "passages_per_sec": throughput,
+    }, passage_vecs, query_vecs
+
+
+def top_k(passage_vecs, query_vecs, k):
+    index = faiss.IndexFlatIP(passage_vecs.shape[1])
+    index.add(passage_vecs)
+    return index.search(query_vecs, min(k, len(passage_vecs)))[1]
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Latency/throughput/agreement of embedding backends.")
+    p.add_argument("--data", default="data/passages.csv")
+    p.add_argument("--model", default=EMBED_MODEL_NAME)
+    p.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    p.add_argument("--onnx-dir", default=ONNX_DIR)
+    p.add_argument("--max-passages", type=int, default=5000)
+    p.add_argument("--top-k", type=int, default=5)
+    p.add_argument("--repeat", type=int, default=20)
+    p.add_argument("--json", default=None, help="write the result rows to this file")
+    args = p.parse_args(argv)
+
+    texts = pd.read_csv(args.data, nrows=args.max_passages)["text"].astype(str).tolist()
+    queries = DEFAULT_QUERIES
+    rows, baseline = [], None
+    for backend in args.backends:
+        try:
+            row, pvecs, qvecs = bench_backend(backend, texts, queries, args.model, args.repeat, args.onnx_dir)
+        except (ImportError, FileNotFoundError) as e:
+            print(f"skipping {backend}: {e}")
+            continue
+        hits = top_k(pvecs, qvecs, args.top_k)
+        if baseline is None:
+            baseline = (backend, pvecs, hits)
+        base_name, base_pvecs, base_hits = baseline
+        row["agreement_vs"] = base_name
+        row["mean_cosine"] = float(np.mean(np.sum(pvecs * base_pvecs, axis=1)))
+        row[f"top{args.top_k}_overlap"] = float(np.mean(
+            [len(set(a) & set(b)) / len(a) for a, b in zip(hits.tolist(), base_hits.tolist())]
+        ))
+        rows.append(row)
+
+    print(f"{len(texts)} passages, {len(queries)} queries, model {args.model}")
+    print(f"{'backend':<10} {'load s':>7} {'p50 ms':>7} {'p95 ms':>7} {'pass/s':>9} {'cosine':>7} {'top-k':>6}")
+    for r in rows:
+        print(f"{r['backend']:<10} {r['load_s']:>7.2f} {r['query_p50_ms']:>7.2f} {r['query_p95_ms']:>7.2f} "
+              f"{r['passages_per_sec']:>9.1f} {r['mean_cosine']:>7.4f} {r[f'top{args.top_k}_overlap']:>6.3f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Import-time budget check for the rules-only startup path.
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter, parses the
+per-module timings and fails (exit code 1) when the cumulative import time exceeds
+the module's budget or when a heavy RAG/LLM dependency gets imported eagerly.
+Budgets leave about 3x headroom over a typical dev machine (rules_engine ~150 ms,
+mostly numpy; api ~800 ms, mostly fastapi), so slow CI disks don't flake the check;
+the heavy-import check is the strict part.
+
+    python src/bench_import_time.py                  # checks rules_engine and api
+    python src/bench_import_time.py api --budget-ms 1000 --repeat 5
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MODULES = ["rules_engine", "api"]
+BUDGETS_MS = {"rules_engine": 500.0, "api": 2500.0}
+DEFAULT_BUDGET_MS = 2500.0  # modules without an entry above
+# must only load on first use of RAG / LLM
+HEAVY_MODULES = ["torch", "sentence_transformers", "faiss", "pandas", "google.generativeai", "streamlit"]
+
+
+def measure(module: str) -> Tuple[float, Dict[str, float]]:
+    """Returns (total ms, cumulative ms per imported module) for one cold import."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [SRC_DIR, os.environ.get("PYTHONPATH")])),
+               WARM_UP="0")
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=SRC_DIR, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+
+    per_module, total_us = {}, 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        us = int(cumulative)
+        per_module[name.strip()] = us / 1000.0
+        if not name[1:].startswith(" "):  # top-level entry (nested imports are indented)
+            total_us += us
+    return total_us / 1000.0, per_module
+
+
+def check(module: str, budget_ms: float, repeat: int) -> List[str]:
+    runs = [measure(module) for _ in range(repeat)]
+    total, per_module = min(runs, key=lambda r: r[0])  # best of N filters out disk/CPU noise
+    heavy = sorted({h for h in HEAVY_MODULES for m in per_module if m == h or m.startswith(h + ".")})
+    slowest = sorted(per_module.items(), key=lambda kv: kv[1], reverse=True)[:5]
+
+    print(f"import {module}: {total:.0f} ms (budget {budget_ms:.0f} ms)")
+    for name, ms in slowest:
+        print(f"    {ms:8.1f} ms  {name}")
+
+    failures = []
+    if total > budget_ms:
+        failures.append(f"{module}: {total:.0f} ms exceeds the {budget_ms:.0f} ms budget")
+    if heavy:
+        failures.append(f"{module}: eagerly imports {', '.join(heavy)}")
+    return failures
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    p.add_argument("--budget-ms", type=float, default=None, help="overrides the per-module budgets")
+    p.add_argument("--repeat", type=int, default=3)
+    args = p.parse_args(argv)
+
+    failures = []
+    for module in args.modules:
+        budget = args.budget_ms or BUDGETS_MS.get(module, DEFAULT_BUDGET_MS)
+        failures.extend(check(module, budget, args.repeat))
+    for f in failures:
+        print(f"FAIL {f}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,486 @@
+"""
+Reproducible benchmark suite for the diagnosis pipeline (CPU, offline).
+
+Cases, each run in a fresh spawned process so peak RSS is per case:
+ - rules  : RuleEngine.compile / evaluate / rank / match_matrix on synthetic rule
+            sets (10 .. 100k rules)
+ - rag    : RAGIndex build + query / query_many per query mode on synthetic
+            corpora (1k .. 1M passages)
+ - hybrid : HybridEngine.explain (sync) and explain_async under concurrency, with
+            a fake LLM that sleeps --llm-latency-ms instead of calling Gemini
+ - api    : the /diagnose route (rules, scored, rag, hybrid) through the ASGI stack
+ - memory : heap bytes (tracemalloc) of rules as dicts vs compact Rule objects and
+            of passages as a list of dicts vs the columnar PassageStore
+
+The default "hash" embedder returns deterministic pseudo-random vectors, so FAISS,
+BM25 and the rest of the pipeline are measured without model-load or encode() cost;
+pass --embedder torch|onnx|onnx-int8 to include a real model.
+Everything is seeded; results go to JSON together with commit and library versions.
+
+    python src/bench_pipeline.py run --json bench_main.json
+    python src/bench_pipeline.py run --modes rag --passages 1000000 --index-type hnsw --json big.json
+    python src/bench_pipeline.py compare bench_main.json bench_branch.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from rules_engine import SEVERITY_WEIGHTS, SYMPTOMS, RuleEngine, compact_rules
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+RULE_SIZES = [10, 100, 1_000, 10_000, 100_000]
+PASSAGE_SIZES = [1_000, 10_000, 100_000]  # add 1_000_000 explicitly; a flat index needs ~1.5 GB
+EXTRA_WORDS = (
+    "patient presents with reports mild severe acute chronic history onset days weeks recent travel "
+    "recommended consider treatment care monitor hydration rest referral urgent clinic follow up "
+    "platelet count cbc malaria test ecg troponin xray culture blood pressure oxygen saturation "
+    "viral bacterial infection inflammation dehydration rash joint muscle appetite dizziness"
+).split()
+
+
+class HashEmbedder:
+    """Deterministic pseudo-embeddings keyed by the text: no model, near-zero encode cost."""
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def encode(self, texts, convert_to_numpy: bool = True, show_progress_bar: bool = False, **_):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            out[i] = np.random.default_rng(zlib.crc32(text.encode("utf-8"))).standard_normal(self.dim)
+        return out[0] if single else out
+
+
+# --- synthetic data -------------------------------------------------------------
+
+def symptom_vocab(n_symptoms: int) -> List[str]:
+    return SYMPTOMS + [f"symptom_{i}" for i in range(max(0, n_symptoms - len(SYMPTOMS)))]
+
+
+def synthetic_rules(n_rules: int, vocab: List[str], seed: int = 0) -> List[dict]:
+    rng = np.random.default_rng(seed)
+    severities = list(SEVERITY_WEIGHTS)
+    rules = []
+    for i in range(n_rules):
+        conds = rng.choice(len(vocab), size=int(rng.integers(2, 6)), replace=False)
+        rules.append({
+            "name": f"Condition {i}",
+            "conditions": [vocab[j] for j in conds],
+            "severity": severities[int(rng.integers(len(severities)))],
+            "emergency": bool(rng.random() < 0.1),
+            "explanation": f"Synthetic rule {i}",
+        })
+    return rules
+
+
+def synthetic_facts(vocab: List[str], n: int, seed: int = 0, min_true: int = 2, max_true: int = 6) -> List[dict]:
+    rng = np.random.default_rng(seed)
+    facts = []
+    for _ in range(n):
+        true = rng.choice(len(vocab), size=int(rng.integers(min_true, max_true + 1)), replace=False)
+        f = {s: False for s in SYMPTOMS}
+        f.update({vocab[j]: True for j in true})
+        facts.append(f)
+    return facts
+
+
+def synthetic_passages(n: int, seed: int = 0) -> List[str]:
+    rng = np.random.default_rng(seed)
+    words = np.array([w for s in SYMPTOMS for w in s.split("_")] + EXTRA_WORDS)
+    lengths = rng.integers(12, 48, size=n)
+    picks = rng.integers(len(words), size=int(lengths.sum()))
+    out, start = [], 0
+    for n_words in lengths.tolist():
+        out.append(" ".join(words[picks[start:start + n_words]]) + ".")
+        start += n_words
+    return out
+
+
+def synthetic_queries(n: int, seed: int = 0) -> List[str]:
+    """Checklist-style queries ("fever, cough") mixed with short free-text questions."""
+    rng = np.random.default_rng(seed)
+    queries = []
+    for i in range(n):
+        if i % 4 == 3:
+            queries.append(" ".join(rng.choice(EXTRA_WORDS, size=int(rng.integers(3, 7)))))
+        else:
+            picks = rng.choice(len(SYMPTOMS), size=int(rng.integers(1, 5)), replace=False)
+            queries.append(", ".join(SYMPTOMS[j] for j in sorted(picks)))
+    return queries
+
+
+# --- measurement helpers --------------------------------------------------------
+
+def _rss_mb() -> float:
+    # ru_maxrss: peak resident set size of this process (KiB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _heap_mb(build: Callable):
+    """(object, MB of heap it holds): tracemalloc growth while building, object kept alive."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        obj = build()
+        return obj, (tracemalloc.get_traced_memory()[0] - before) / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def _latencies(fn: Callable, items) -> List[float]:
+    samples = []
+    for item in items:
+        t = time.perf_counter()
+        fn(item)
+        samples.append(time.perf_counter() - t)
+    return samples
+
+
+def _summary(prefix: str, samples: List[float]) -> Dict[str, float]:
+    ms = np.asarray(samples) * 1000.0
+    return {
+        f"{prefix}_p50_ms": float(np.percentile(ms, 50)),
+        f"{prefix}_p95_ms": float(np.percentile(ms, 95)),
+        f"{prefix}_p99_ms": float(np.percentile(ms, 99)),
+        f"{prefix}_mean_ms": float(ms.mean()),
+        f"{prefix}_per_sec": float(len(samples) / max(sum(samples), 1e-12)),
+    }
+
+
+def install_fake_llm(latency_ms: float, n_words: int = 120, n_chunks: int = 8):
+    """Swap the Gemini calls used by hybrid_engine for sleeps that return fixed text."""
+    import hybrid_engine
+
+    delay = latency_ms / 1000.0
+    words = ["finding"] * n_words
+    text = " ".join(words)
+    chunks = [" ".join(words[i::n_chunks]) for i in range(n_chunks)]
+
+    def generate(prompt, max_tokens=500):
+        time.sleep(delay)
+        return text
+
+    async def generate_async(prompt, max_tokens=500):
+        await asyncio.sleep(delay)
+        return text
+
+    def stream(prompt, max_tokens=500):
+        for c in chunks:
+            time.sleep(delay / n_chunks)
+            yield c
+
+    async def stream_async(prompt, max_tokens=500):
+        for c in chunks:
+            await asyncio.sleep(delay / n_chunks)
+            yield c
+
+    hybrid_engine.generate_with_llm = generate
+    hybrid_engine.generate_with_llm_async = generate_async
+    hybrid_engine.stream_with_llm = stream
+    hybrid_engine.stream_with_llm_async = stream_async
+
+
+def build_rag(n_passages: int, index_type: str, embedder: str, dim: int, seed: int):
+    import pandas as pd
+    from rag import RAGIndex
+
+    rag = RAGIndex(embedder=HashEmbedder(dim)) if embedder == "hash" else RAGIndex(backend=embedder)
+    texts = synthetic_passages(n_passages, seed)
+    t = time.perf_counter()
+    rag.build_from_df(pd.DataFrame({"text": texts}), index_type=index_type)
+    return rag, time.perf_counter() - t
+
+
+def no_llm_cache():
+    """A cache with no tiers: every lookup misses, so each request reaches the (fake) LLM."""
+    from llm_cache import TieredCache
+    return TieredCache([])
+
+
+# --- cases (run in a child process) ---------------------------------------------
+
+def case_rules(n_rules: int, n_symptoms: int, n_queries: int, batch_rows: int, seed: int) -> dict:
+    vocab = symptom_vocab(n_symptoms)
+    rules = synthetic_rules(n_rules, vocab, seed)
+    facts = synthetic_facts(vocab, n_queries, seed + 1)
+
+    t = time.perf_counter()
+    engine = RuleEngine(rules, compiled=True)
+    metrics = {"compile_s": time.perf_counter() - t}
+    metrics.update(_summary("evaluate", _latencies(engine.evaluate, facts)))
+    metrics.update(_summary("rank", _latencies(lambda f: engine.rank(f, top_k=5), facts)))
+
+    F = engine.fact_matrix(synthetic_facts(vocab, batch_rows, seed + 2))
+    t = time.perf_counter()
+    engine.match_matrix(F)
+    metrics["match_matrix_rows_per_sec"] = batch_rows / (time.perf_counter() - t)
+    return {"params": {"n_rules": n_rules, "n_symptoms": len(vocab)}, "metrics": metrics}
+
+
+def case_rag(n_passages: int, index_type: str, query_modes: List[str], n_queries: int,
+             embedder: str, dim: int, seed: int) -> dict:
+    from rag import EmbeddingCache
+
+    rag, build_s = build_rag(n_passages, index_type, embedder, dim, seed)
+    queries = synthetic_queries(n_queries, seed + 1)
+    metrics = {"build_s": build_s, "build_passages_per_sec": n_passages / build_s}
+    for mode in query_modes:
+        rag.query_cache = EmbeddingCache(rag.query_cache.max_size)  # every mode starts cold
+        metrics.update(_summary(f"{mode}_query", _latencies(lambda q: rag.query(q, top_k=5, mode=mode), queries)))
+        batches = [queries[i:i + 64] for i in range(0, len(queries), 64)]
+        rag.query_cache = EmbeddingCache(rag.query_cache.max_size)
+        t = time.perf_counter()
+        for b in batches:
+            rag.query_many(b, top_k=5, mode=mode)
+        metrics[f"{mode}_batch64_queries_per_sec"] = len(queries) / (time.perf_counter() - t)
+    return {"params": {"n_passages": n_passages, "index_type": index_type, "embedder": embedder},
+            "metrics": metrics}
+
+
+def case_hybrid(n_passages: int, n_queries: int, llm_latency_ms: float, concurrency: int,
+                embedder: str, dim: int, seed: int) -> dict:
+    from hybrid_engine import HybridEngine
+
+    install_fake_llm(llm_latency_ms)
+    rag, build_s = build_rag(n_passages, "flat", embedder, dim, seed)
+    # fast path and semantic cache off: measure the full pipeline for every request
+    # (explain_fast_path opts in per call)
+    engine = HybridEngine(rag=rag, rules=RuleEngine(compiled=True), llm_cache=no_llm_cache(),
+                          fast_path="off", fast_path_llm="deferred", semantic_cache=False)
+    facts = synthetic_facts(SYMPTOMS, n_queries, seed + 1, min_true=1, max_true=5)
+    texts = synthetic_queries(n_queries, seed + 2)
+    requests = [(f, texts[i] if i % 2 else "") for i, f in enumerate(facts)]
+
+    metrics = _summary("explain", _latencies(lambda r: engine.explain(*r), requests))
+    emergency = {"chest_pain": True, "shortness_breath": True, "fatigue": True}
+    metrics.update(_summary("explain_fast_path", _latencies(
+        lambda r: engine.explain(emergency, "", "emergency"), range(n_queries))))
+
+    async def run_async():
+        sem = asyncio.Semaphore(concurrency)
+        samples = []
+
+        async def one(r):
+            async with sem:
+                t = time.perf_counter()
+                await engine.explain_async(*r)
+                samples.append(time.perf_counter() - t)
+
+        t = time.perf_counter()
+        await asyncio.gather(*(one(r) for r in requests))
+        return samples, time.perf_counter() - t
+
+    samples, wall = asyncio.run(run_async())
+    metrics.update(_summary("explain_async", samples))
+    metrics["explain_async_requests_per_sec"] = len(requests) / wall
+    return {"params": {"n_passages": n_passages, "llm_latency_ms": llm_latency_ms, "concurrency": concurrency,
+                       "embedder": embedder}, "metrics": metrics}
+
+
+def case_api(n_passages: int, n_queries: int, llm_latency_ms: float, embedder: str, dim: int, seed: int) -> dict:
+    os.environ["WARM_UP"] = "0"
+    import resources
+    from fastapi.testclient import TestClient
+    from hybrid_engine import HybridEngine
+
+    install_fake_llm(llm_latency_ms)
+    rag, _ = build_rag(n_passages, "flat", embedder, dim, seed)
+    resources._rule_engine = RuleEngine(compiled=True)
+    resources._answer_table = False  # measure live computation, not a precomputed table
+    resources._hybrid_engine = HybridEngine(rag=rag, rules=resources._rule_engine, llm_cache=no_llm_cache(),
+                                            fast_path="off", fast_path_llm="deferred", semantic_cache=False)
+    import api
+
+    facts = synthetic_facts(SYMPTOMS, n_queries, seed + 1, min_true=1, max_true=5)
+    metrics = {}
+    with TestClient(api.app) as client:
+        for mode in ("rules", "scored", "rag", "hybrid"):
+            def post(f):
+                r = client.post("/diagnose", json={"symptoms": f, "mode": mode})
+                r.raise_for_status()
+            metrics.update(_summary(f"{mode}", _latencies(post, facts)))
+    return {"params": {"n_passages": n_passages, "llm_latency_ms": llm_latency_ms, "embedder": embedder},
+            "metrics": metrics}
+
+
+def case_memory(n_rules: int, n_symptoms: int, n_passages: int, seed: int) -> dict:
+    from passage_store import PassageStore
+
+    # through JSON, like rules loaded from a file (no string sharing between rules)
+    rules_json = json.dumps(synthetic_rules(n_rules, symptom_vocab(n_symptoms), seed))
+    rules, rules_dict_mb = _heap_mb(lambda: json.loads(rules_json))
+    _, rules_compact_mb = _heap_mb(lambda: compact_rules(json.loads(rules_json)))
+    del rules
+    texts = synthetic_passages(n_passages, seed + 3)
+    passages, passages_dict_mb = _heap_mb(lambda: [{"id": i, "text": t.encode("utf-8").decode("utf-8")}
+                                                    for i, t in enumerate(texts)])
+    del passages
+    _, passages_columnar_mb = _heap_mb(lambda: PassageStore.from_texts(range(len(texts)), texts))
+    return {"params": {"n_rules": n_rules, "n_passages": n_passages},
+            "metrics": {"rules_dict_mb": rules_dict_mb, "rules_compact_mb": rules_compact_mb,
+                        "passages_dict_mb": passages_dict_mb, "passages_columnar_mb": passages_columnar_mb}}
+
+
+CASES = {"rules": case_rules, "rag": case_rag, "hybrid": case_hybrid, "api": case_api, "memory": case_memory}
+
+
+def _run_case(case: str, kwargs: dict) -> dict:
+    base_rss = _rss_mb()
+    out = CASES[case](**kwargs)
+    out["case"] = case
+    out["metrics"]["base_rss_mb"] = base_rss  # after imports, before building anything
+    out["metrics"]["peak_rss_mb"] = _rss_mb()
+    return out
+
+
+def run_isolated(case: str, kwargs: dict, inline: bool = False) -> dict:
+    if inline:
+        return _run_case(case, kwargs)
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        return pool.submit(_run_case, case, kwargs).result()
+
+
+def environment() -> dict:
+    env = {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+    try:
+        import faiss
+        env["faiss"] = faiss.__version__
+    except Exception:
+        pass
+    try:
+        env["commit"] = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SRC_DIR,
+                                       capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        env["commit"] = None
+    return env
+
+
+def _headline(result: dict) -> str:
+    m = result["metrics"]
+    keys = [k for k in m if k.endswith("_p50_ms")][:4]
+    parts = [f"{k[:-7]} p50 {m[k]:.3f} ms" for k in keys]
+    parts += [f"{k[:-3]} {m[k]:.1f} MB" for k in m if k.endswith("_mb") and not k.endswith("rss_mb")]
+    parts.append(f"peak {m['peak_rss_mb']:.0f} MB")
+    return f"{result['case']:<7} {json.dumps(result['params'])}: " + ", ".join(parts)
+
+
+def run(args) -> dict:
+    plan = []
+    if "rules" in args.modes:
+        plan += [("rules", dict(n_rules=n, n_symptoms=args.symptoms, n_queries=args.queries,
+                                batch_rows=args.batch_rows, seed=args.seed)) for n in args.rules]
+    common = dict(embedder=args.embedder, dim=args.dim, seed=args.seed)
+    if "rag" in args.modes:
+        plan += [("rag", dict(n_passages=n, index_type=args.index_type, query_modes=args.query_modes,
+                              n_queries=args.queries, **common)) for n in args.passages]
+    if "hybrid" in args.modes:
+        plan.append(("hybrid", dict(n_passages=args.hybrid_passages, n_queries=args.queries,
+                                    llm_latency_ms=args.llm_latency_ms, concurrency=args.concurrency, **common)))
+    if "api" in args.modes:
+        plan.append(("api", dict(n_passages=args.hybrid_passages, n_queries=args.queries,
+                                 llm_latency_ms=args.llm_latency_ms, **common)))
+    if "memory" in args.modes:
+        plan.append(("memory", dict(n_rules=args.memory_rules, n_symptoms=args.symptoms,
+                                    n_passages=args.memory_passages, seed=args.seed)))
+
+    results = []
+    for case, kwargs in plan:
+        result = run_isolated(case, kwargs, inline=args.inline)
+        print(_headline(result), flush=True)
+        results.append(result)
+    report = {"environment": environment(), "args": vars(args), "results": results}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results → {args.json}")
+    return report
+
+
+def compare(base_path: str, new_path: str):
+    """Side-by-side latency / throughput / memory of two result files (ratio = new / base)."""
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def key(r):
+        return r["case"], json.dumps(r["params"], sort_keys=True)
+
+    base_by_key = {key(r): r for r in base["results"]}
+    print(f"base {base['environment'].get('commit')}  vs  new {new['environment'].get('commit')}")
+    for r in new["results"]:
+        old = base_by_key.get(key(r))
+        if old is None:
+            continue
+        print(f"\n{r['case']} {r['params']}")
+        for name, v in r["metrics"].items():
+            if not (name.endswith(("_p50_ms", "_p95_ms", "_per_sec", "_mb")) or name == "base_rss_mb"):
+                continue
+            b = old["metrics"].get(name)
+            if b:
+                print(f"  {name:<40} {b:>12.3f} → {v:>12.3f}   x{v / b:.2f}")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark rules, retrieval, hybrid and API paths.")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    r = sub.add_parser("run")
+    r.add_argument("--modes", nargs="+", choices=list(CASES), default=list(CASES))
+    r.add_argument("--rules", nargs="+", type=int, default=RULE_SIZES, help="rule set sizes")
+    r.add_argument("--symptoms", type=int, default=200, help="symptom vocabulary of the synthetic rules")
+    r.add_argument("--passages", nargs="+", type=int, default=PASSAGE_SIZES, help="corpus sizes for the rag case")
+    r.add_argument("--hybrid-passages", type=int, default=10_000, help="corpus size for the hybrid/api cases")
+    r.add_argument("--index-type", default="flat")
+    r.add_argument("--query-modes", nargs="+", default=["dense", "fused"])
+    r.add_argument("--queries", type=int, default=200, help="timed calls per measurement")
+    r.add_argument("--batch-rows", type=int, default=1_000,
+                   help="patients per match_matrix call (the hit matrix is rows x rules floats)")
+    r.add_argument("--embedder", default="hash", help='"hash" (no model) or an embedding backend')
+    r.add_argument("--dim", type=int, default=384, help="vector size of the hash embedder")
+    r.add_argument("--llm-latency-ms", type=float, default=200.0)
+    r.add_argument("--memory-rules", type=int, default=100_000, help="rule set size for the memory case")
+    r.add_argument("--memory-passages", type=int, default=1_000_000, help="corpus size for the memory case")
+    r.add_argument("--concurrency", type=int, default=16)
+    r.add_argument("--seed", type=int, default=0)
+    r.add_argument("--inline", action="store_true", help="run cases in this process (peak RSS accumulates)")
+    r.add_argument("--json", default=None, help="write environment, args and results to this file")
+
+    c = sub.add_parser("compare")
+    c.add_argument("base")
+    c.add_argument("new")
+
+    args = p.parse_args(argv)
+    if args.command == "compare":
+        compare(args.base, args.new)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+In-process BM25 (Okapi) inverted index over the RAG passages.
+
+Exact clinical terms ("platelet", "malaria test") are matched lexically, which
+the dense embeddings sometimes rank below vaguely related passages. Doc ids are
+passage positions, so results line up with the PassageStore.
+
+Postings are stored CSR-style next to the FAISS index and opened memory-mapped:
+term t owns doc_ids[offsets[t]:offsets[t + 1]] (and the matching tfs).
+
+Run `python bm25.py build data/rag_index` once to add BM25 files to an index
+directory built before lexical retrieval existed.
+"""
+
+import json
+import os
+import re
+import sys
+from array import array
+from collections import Counter
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+from passage_store import save_npy
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+VOCAB_FILE = "bm25_vocab.json"
+DOC_IDS_FILE = "bm25_doc_ids.npy"
+TFS_FILE = "bm25_tfs.npy"
+OFFSETS_FILE = "bm25_offsets.npy"
+DOC_LEN_FILE = "bm25_doc_len.npy"
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")  # also splits sore_throat -> sore, throat
+STOPWORDS = frozenset(
+    "a an and are as at be by do does for from has have i if in is it its me my no not of on or "
+    "should so that the their there this to was what when which who will with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+class BM25Index:
+    def __init__(self, vocab: List[str], doc_ids: np.ndarray, tfs: np.ndarray, offsets: np.ndarray,
+                 doc_len: np.ndarray, k1: float = BM25_K1, b: float = BM25_B):
+        self.terms = vocab
+        self.vocab = {t: i for i, t in enumerate(vocab)}
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.offsets = offsets
+        self.doc_len = doc_len
+        self.k1 = k1
+        self.b = b
+        n_docs = len(doc_len)
+        self.avgdl = (float(doc_len.mean()) if n_docs else 0.0) or 1.0  # 1.0: every document empty
+        df = np.diff(offsets).astype(np.float64)
+        self.idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+    @classmethod
+    def build(cls, texts: Iterable[str], k1: float = BM25_K1, b: float = BM25_B) -> "BM25Index":
+        vocab = {}
+        terms, docs, tfs = array("i"), array("i"), array("i")  # compact while streaming the corpus
+        doc_len = array("i")
+        for d, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_len.append(len(tokens))
+            for tok, tf in Counter(tokens).items():
+                terms.append(vocab.setdefault(tok, len(vocab)))
+                docs.append(d)
+                tfs.append(tf)
+        terms = np.frombuffer(terms, dtype=np.int32)
+        order = np.argsort(terms, kind="stable")  # group by term, docs stay ascending
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(terms, minlength=len(vocab)))
+        return cls(list(vocab), np.frombuffer(docs, dtype=np.int32)[order],
+                   np.minimum(np.frombuffer(tfs, dtype=np.int32)[order], np.iinfo(np.uint16).max).astype(np.uint16),
+                   offsets, np.frombuffer(doc_len, dtype=np.int32).astype(np.uint32), k1=k1, b=b)
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def search(self, query: str, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns (scores, doc positions), best first; fewer than top_k when few docs match."""
+        term_ids = [self.vocab[t] for t in dict.fromkeys(tokenize(query)) if t in self.vocab]
+        if not term_ids or top_k <= 0:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        spans = [(self.offsets[t], self.offsets[t + 1]) for t in term_ids]
+        docs = np.concatenate([self.doc_ids[s:e] for s, e in spans])
+        tf = np.concatenate([self.tfs[s:e] for s, e in spans]).astype(np.float32)
+        idf = np.repeat(self.idf[term_ids], [e - s for s, e in spans])
+
+        norm = self.k1 * (1 - self.b + self.b * self.doc_len[docs] / self.avgdl)
+        uniq, inv = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inv, weights=idf * tf * (self.k1 + 1) / (tf + norm))
+        top = np.lexsort((uniq, -scores))[:top_k]
+        return scores[top].astype(np.float32), uniq[top].astype(np.int64)
+
+    def save(self, path_dir: str):
+        os.makedirs(path_dir, exist_ok=True)
+        # the arrays may be mappings of these very files (a loaded index saved back)
+        save_npy(os.path.join(path_dir, DOC_IDS_FILE), self.doc_ids)
+        save_npy(os.path.join(path_dir, TFS_FILE), self.tfs)
+        save_npy(os.path.join(path_dir, OFFSETS_FILE), self.offsets)
+        save_npy(os.path.join(path_dir, DOC_LEN_FILE), self.doc_len)
+        with open(os.path.join(path_dir, VOCAB_FILE), "w") as f:
+            json.dump({"k1": self.k1, "b": self.b, "terms": self.terms}, f)
+
+    @classmethod
+    def load(cls, path_dir: str, mmap: bool = True) -> "BM25Index":
+        mode = "r" if mmap else None
+        with open(os.path.join(path_dir, VOCAB_FILE)) as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(path_dir, name), mmap_mode=mode)
+                  for name in (DOC_IDS_FILE, TFS_FILE, OFFSETS_FILE, DOC_LEN_FILE)]
+        return cls(meta["terms"], *arrays, k1=meta["k1"], b=meta["b"])
+
+    @staticmethod
+    def exists(path_dir: str) -> bool:
+        return os.path.exists(os.path.join(path_dir, VOCAB_FILE))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "build":
+        print("usage: python bm25.py build <index_dir>")
+        sys.exit(1)
+    from passage_store import PassageStore
+    store = PassageStore.open(sys.argv[2])
+    BM25Index.build(store.text(i) for i in range(len(store))).save(sys.argv[2])
+    print(f"BM25 index over {len(store)} passages → {sys.argv[2]}")
@@ -1,29 +1,397 @@
+import argparse
+import glob
+import json
+import multiprocessing as mp
+import shutil
+import tempfile
+import time
+from collections import deque
+import numpy as np
 import pandas as pd
-from rag import RAGIndex
+import faiss
+from rag import (RAGIndex, INDEX_TYPES, TRAIN_SAMPLE_SIZE, LABELS_FILE, EMBEDDINGS_FILE,
+                 LabelSet, content_labels, encode_normalized, make_faiss_index, stream_labels)
+from passage_store import PassageStore, PassageStoreWriter
+from embedders import BACKENDS, OnnxEmbedder, make_embedder, onnx_model_dir
 import os
 
 DATA_PATH = "data/passages.csv"   # your dataset
 INDEX_DIR = "data/rag_index"                # output folder
 
-def main():
-    if not os.path.exists(DATA_PATH):
-        raise FileNotFoundError(f"Missing data file: {DATA_PATH}")
+NPROBE_SWEEP = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+EF_SEARCH_SWEEP = [16, 32, 64, 128, 256, 512]
+CHECKPOINT_DIR = ".build_checkpoint"  # inside the index dir; removed after a successful build
+CHECKPOINT_ROWS = 2048                # passages embedded per checkpoint chunk
+STREAM_CHUNK_ROWS = 4096  # CSV rows per chunk in the streaming pipeline
+
+
+def _timed_search(index, queries, top_k):
+    start = time.perf_counter()
+    _, I = index.search(queries, top_k)
+    elapsed = time.perf_counter() - start
+    return I, elapsed * 1000.0 / len(queries)
+
+
+def recall_latency_report(rag: RAGIndex, embeddings: np.ndarray, top_k: int = 5, n_queries: int = 1000):
+    """
+    Compare rag.index against an exact flat index over the same vectors.
+    Queries are sampled passage embeddings; recall@k is the overlap with flat top-k.
+    Sweeps nprobe (IVF) or ef_search (HNSW) so settings can be picked from real numbers.
+    """
+    rng = np.random.default_rng(0)
+    queries = embeddings[rng.choice(len(embeddings), min(n_queries, len(embeddings)), replace=False)]
+    top_k = min(top_k, len(embeddings))
+
+    flat = faiss.IndexFlatIP(embeddings.shape[1])
+    flat.add(embeddings)
+    truth, flat_ms = _timed_search(flat, queries, top_k)
+    rows = [{"index_type": "flat", "param": None, "recall": 1.0, "ms_per_query": flat_ms}]
+
+    if rag.index_type.startswith("ivf"):
+        name, sweep = "nprobe", [p for p in NPROBE_SWEEP if p <= faiss.extract_index_ivf(rag.index).nlist]
+    elif rag.index_type == "hnsw":
+        name, sweep = "ef_search", EF_SEARCH_SWEEP
+    else:
+        return rows
+
+    saved = dict(rag.search_params)
+    for value in sweep:
+        rag.set_search_params(**{name: value})
+        found, ms = _timed_search(rag.index, queries, top_k)
+        found = rag._positions(found)
+        hits = sum(len(set(t) & set(f)) for t, f in zip(truth.tolist(), found.tolist()))
+        rows.append({"index_type": rag.index_type, "param": f"{name}={value}",
+                     "recall": hits / (len(queries) * top_k), "ms_per_query": ms})
+    rag.search_params = saved
+    rag.set_search_params()
+    return rows
+
+
+def _load_checkpoint(ckpt_dir: str) -> dict:
+    """label -> embedding for every chunk a previous (killed) run finished."""
+    done = {}
+    for path in sorted(glob.glob(os.path.join(ckpt_dir, "chunk_*.npz"))):
+        with np.load(path) as chunk:
+            done.update(zip(chunk["labels"].tolist(), chunk["embeddings"]))
+    return done
+
+
+def incremental_build(rag: RAGIndex, df: pd.DataFrame, out_dir: str, index_type: str = "flat",
+                      checkpoint_rows: int = CHECKPOINT_ROWS, **build_params):
+    """
+    Re-embed only passages whose content hash is new, reuse stored vectors for the rest
+    and patch the saved faiss index in place (remove_ids for deleted rows, add_with_ids
+    for new ones). Embedded chunks are checkpointed, so a killed run resumes where it stopped.
+    Falls back to a full build when out_dir has no reusable state.
+    """
+    texts = df["text"].astype(str).tolist()
+    ids = list(range(len(texts)))
+    labels = content_labels(texts)
+
+    labels_path = os.path.join(out_dir, LABELS_FILE)
+    emb_path = os.path.join(out_dir, EMBEDDINGS_FILE)
+    have_state = os.path.exists(labels_path) and os.path.exists(emb_path)
+    meta_path = os.path.join(out_dir, "meta.json")
+    if have_state and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        built_with = (meta.get("embed_model", rag.embed_model_name), meta.get("embed_backend", "torch"))
+        if built_with != (rag.embed_model_name, rag.embed_backend):
+            print(f"Stored vectors came from {built_with[0]} ({built_with[1]}); re-embedding everything")
+            have_state = False
+    prev_labels = np.load(labels_path) if have_state else np.zeros(0, dtype=np.int64)
+    prev_emb = np.load(emb_path, mmap_mode="r") if have_state else None
+    prev_pos = {label: i for i, label in enumerate(prev_labels.tolist())}
+
+    ckpt_dir = os.path.join(out_dir, CHECKPOINT_DIR)
+    os.makedirs(ckpt_dir, exist_ok=True)
+    done = _load_checkpoint(ckpt_dir)
+    new = [i for i, label in enumerate(labels.tolist()) if label not in prev_pos]
+    todo = [i for i in new if labels[i] not in done]
+    print(f"{len(texts)} passages: {len(texts) - len(new)} reused, "
+          f"{len(new) - len(todo)} from checkpoint, {len(todo)} to embed")
+
+    n_chunks = len(glob.glob(os.path.join(ckpt_dir, "chunk_*.npz")))
+    for start in range(0, len(todo), checkpoint_rows):
+        rows = todo[start:start + checkpoint_rows]
+        emb = rag.embed_passages([texts[i] for i in rows])
+        tmp = os.path.join(ckpt_dir, "chunk.tmp.npz")
+        np.savez(tmp, labels=labels[rows], embeddings=emb)
+        os.replace(tmp, os.path.join(ckpt_dir, f"chunk_{n_chunks:06d}.npz"))
+        n_chunks += 1
+        done.update(zip(labels[rows].tolist(), emb))
+        print(f"  embedded {min(start + checkpoint_rows, len(todo))}/{len(todo)}")
+
+    embeddings = np.empty((len(texts), rag.dim), dtype=np.float32)
+    for i, label in enumerate(labels.tolist()):
+        embeddings[i] = prev_emb[prev_pos[label]] if label in prev_pos else done[label]
+
+    added = np.array([label not in prev_pos for label in labels.tolist()], dtype=bool)
+    removed = np.setdiff1d(prev_labels, labels)
+    patched = False
+    if have_state and os.path.exists(os.path.join(out_dir, "index.faiss")):
+        rag.load(out_dir, mmap=False)
+        if rag.index_type == index_type and isinstance(rag.index, faiss.IndexIDMap):
+            try:
+                if len(removed):
+                    rag.index.remove_ids(removed)
+                if added.any():
+                    rag.index.add_with_ids(embeddings[added], labels[added])
+                patched = True
+            except RuntimeError as e:  # e.g. HNSW cannot remove vectors
+                print(f"In-place update not supported ({e}); rebuilding from stored vectors")
+    if patched:
+        rag.set_labels(labels)
+        rag.set_search_params(nprobe=build_params.get("nprobe"), ef_search=build_params.get("ef_search"))
+    else:
+        rag.build_index(embeddings, labels, index_type=index_type, **build_params)
+    print(f"  +{int(added.sum())} added, -{len(removed)} removed, "
+          f"{'patched index' if patched else 'rebuilt index (no re-embedding)'}")
+
+    rag.passages = PassageStore.from_texts(ids, texts)
+    rag.bm25 = None  # rebuilt from the new passages by save()
+    del prev_emb  # release the mapping before embeddings.npy is replaced
+    rag.save(out_dir, embeddings=embeddings)
+    shutil.rmtree(ckpt_dir, ignore_errors=True)
+    return embeddings
+
+
+_worker_embedder = None
+
+
+def _init_embed_worker(model_name: str, backend: str):
+    global _worker_embedder
+    try:
+        import torch
+        torch.set_num_threads(1)  # one core per process; parallelism comes from the pool
+    except ImportError:
+        pass
+    if backend.startswith("onnx"):
+        _worker_embedder = OnnxEmbedder(onnx_model_dir(model_name), quantized=backend == "onnx-int8",
+                                        intra_op_threads=1)
+    else:
+        _worker_embedder = make_embedder(model_name, backend)
+
+
+def _embed_chunk(texts):
+    return encode_normalized(_worker_embedder, texts)
+
+
+def _publish(stage_dir: str, out_dir: str):
+    """
+    Move a finished build into out_dir file by file. os.replace leaves files that running
+    workers have mapped intact (they keep the old inode); the index files go last.
+    """
+    last = ["index.faiss", "meta.json"]
+    names = sorted(os.listdir(stage_dir))
+    for name in [n for n in names if n not in last] + [n for n in last if n in names]:
+        os.replace(os.path.join(stage_dir, name), os.path.join(out_dir, name))
+    os.rmdir(stage_dir)
+
+
+class _Done:
+    """apply_async-like result for chunks embedded in the calling process."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def streaming_build(rag: RAGIndex, data_path: str, out_dir: str, index_type: str = "flat",
+                    chunksize: int = STREAM_CHUNK_ROWS, workers: int = None, train_size: int = TRAIN_SAMPLE_SIZE,
+                    nprobe: int = None, ef_search: int = None, seed: int = 0, **index_params):
+    """
+    Build the index without loading the whole corpus: the CSV is read in chunks, chunks
+    are embedded by a process pool (one model copy per core) and each finished chunk is
+    appended to the passage store and to raw embedding / label files on disk. At most
+    2*workers chunks are in flight. Flat / HNSW indexes get each chunk as it finishes;
+    IVF / PQ indexes are trained afterwards on train_size vectors sampled at random from
+    the whole corpus, then filled block by block from the memory-mapped embeddings.
+    In memory beyond the in-flight chunks: the duplicate-text set (8 bytes per passage).
+    Everything is written to a staging directory inside out_dir and moved into place once
+    complete, so rebuilding a live index never truncates files API workers have mapped and
+    an interrupted build leaves the previous index as it was.
+    """
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(out_dir, exist_ok=True)
+    stage = tempfile.mkdtemp(prefix=".build-", dir=out_dir)  # same filesystem: os.replace works
+    try:
+        _streaming_build(rag, data_path, stage, index_type, chunksize, workers, train_size, nprobe, ef_search,
+                         seed, **index_params)
+    except BaseException:
+        shutil.rmtree(stage, ignore_errors=True)
+        raise
+    _publish(stage, out_dir)
+
+
+def _streaming_build(rag: RAGIndex, data_path: str, out_dir: str, index_type: str, chunksize: int, workers: int,
+                     train_size: int, nprobe: int, ef_search: int, seed: int, **index_params):
+    raw_path = os.path.join(out_dir, EMBEDDINGS_FILE + ".raw")
+    raw_labels_path = os.path.join(out_dir, LABELS_FILE + ".raw")
+    seen = LabelSet()
+    n_rows = 0
+    streamed = None  # flat / hnsw need no training: filled while embedding
+    if index_type in ("flat", "hnsw"):
+        streamed = faiss.IndexIDMap2(make_faiss_index(index_type, rag.dim, 0, **index_params))
+    state = {"done": 0}
+    start = time.perf_counter()
+
+    def finish(lab, result, raw, raw_labels):
+        emb = result.get()
+        raw.write(emb.tobytes())
+        raw_labels.write(lab.tobytes())
+        if streamed is not None:
+            streamed.add_with_ids(emb, lab)
+        state["done"] += len(emb)
+        elapsed = time.perf_counter() - start
+        print(f"  {state['done']} passages embedded ({state['done'] / elapsed:.1f} passages/sec)")
+
+    pool = None
+    if workers > 1:
+        pool = mp.get_context("spawn").Pool(workers, _init_embed_worker, (rag.embed_model_name, rag.embed_backend))
+    try:
+        with PassageStoreWriter(out_dir) as writer, open(raw_path, "wb") as raw, \
+                open(raw_labels_path, "wb") as raw_labels:
+            inflight = deque()
+            for chunk in pd.read_csv(data_path, chunksize=chunksize):
+                if "text" not in chunk.columns:
+                    raise ValueError("Data must contain a 'text' column.")
+                texts = chunk["text"].astype(str).tolist()
+                writer.append(range(n_rows, n_rows + len(texts)), texts)
+                n_rows += len(texts)
+                lab = stream_labels(texts, seen)
+                if pool is None:
+                    inflight.append((lab, _Done(rag.embed_passages(texts))))
+                else:
+                    inflight.append((lab, pool.apply_async(_embed_chunk, (texts,))))
+                while len(inflight) >= 2 * workers:
+                    finish(*inflight.popleft(), raw, raw_labels)
+            while inflight:
+                finish(*inflight.popleft(), raw, raw_labels)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if not state["done"]:
+        raise ValueError(f"No passages found in {data_path}")
+    del seen
+
+    raw_emb = np.memmap(raw_path, dtype=np.float32, mode="r", shape=(state["done"], rag.dim))
+    labels = np.fromfile(raw_labels_path, dtype=np.int64)
+    index = streamed
+    if index is None:
+        base = make_faiss_index(index_type, rag.dim, len(raw_emb), **index_params)
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(len(raw_emb), min(train_size, len(raw_emb)), replace=False))
+        base.train(np.ascontiguousarray(raw_emb[sample]))
+        index = faiss.IndexIDMap2(base)
+        for i in range(0, len(raw_emb), chunksize):
+            index.add_with_ids(np.ascontiguousarray(raw_emb[i:i + chunksize]), labels[i:i + chunksize])
+
+    # raw float32 rows -> embeddings.npy, copied block by block to keep memory bounded
+    out = np.lib.format.open_memmap(os.path.join(out_dir, EMBEDDINGS_FILE), mode="w+",
+                                    dtype=np.float32, shape=raw_emb.shape)
+    for i in range(0, len(raw_emb), chunksize):
+        out[i:i + chunksize] = raw_emb[i:i + chunksize]
+    out.flush()
+    del out, raw_emb
+    os.remove(raw_path)
+    os.remove(raw_labels_path)
+
+    rag.index = index
+    rag.index_type = index_type
+    rag.set_labels(labels)
+    rag.set_search_params(nprobe=nprobe, ef_search=ef_search)
+    rag.save_index(out_dir)
+    rag.passages = PassageStore.open(out_dir)
+    rag.save_lexical(out_dir)
+    elapsed = time.perf_counter() - start
+    print(f"Embedded {state['done']} passages in {elapsed:.1f}s ({state['done'] / elapsed:.1f} passages/sec, "
+          f"{workers} worker{'s' if workers > 1 else ''})")
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Build the RAG FAISS index from a passages CSV.")
+    p.add_argument("--data", default=DATA_PATH)
+    p.add_argument("--out", default=INDEX_DIR)
+    p.add_argument("--index-type", choices=INDEX_TYPES, default="flat")
+    p.add_argument("--backend", choices=BACKENDS, default=None,
+                   help="embedding backend (default: EMBED_BACKEND env var, else torch); recorded in meta.json")
+    p.add_argument("--nlist", type=int, default=None, help="IVF lists (default ~4*sqrt(n))")
+    p.add_argument("--pq-m", type=int, default=16, help="PQ sub-quantizers (must divide dim)")
+    p.add_argument("--pq-bits", type=int, default=8)
+    p.add_argument("--hnsw-m", type=int, default=32)
+    p.add_argument("--train-size", type=int, default=TRAIN_SAMPLE_SIZE)
+    p.add_argument("--nprobe", type=int, default=None)
+    p.add_argument("--ef-search", type=int, default=None)
+    p.add_argument("--incremental", action="store_true",
+                   help="re-embed only new/changed passages, reusing vectors saved in --out; resumes killed runs")
+    p.add_argument("--stream", action="store_true",
+                   help="read the CSV in chunks and embed them in a process pool (bounded memory)")
+    p.add_argument("--chunksize", type=int, default=STREAM_CHUNK_ROWS)
+    p.add_argument("--workers", type=int, default=None, help="embedding processes for --stream (default: all cores)")
+    p.add_argument("--report", action="store_true", help="print recall@k vs latency against a flat index")
+    p.add_argument("--report-json", default=None, help="also write the report rows to this file")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.exists(args.data):
+        raise FileNotFoundError(f"Missing data file: {args.data}")
+    if args.stream and args.incremental:
+        raise ValueError("--stream and --incremental cannot be combined")
+
+    index_params = {}
+    if args.index_type.startswith("ivf"):
+        index_params["nlist"] = args.nlist
+    if args.index_type == "ivf_pq":
+        index_params.update(pq_m=args.pq_m, pq_bits=args.pq_bits)
+    if args.index_type == "hnsw":
+        index_params["hnsw_m"] = args.hnsw_m
+
+    if args.stream:
+        print(f"Streaming RAG index build ({args.index_type})...")
+        rag = RAGIndex(backend=args.backend)
+        streaming_build(rag, args.data, args.out, index_type=args.index_type, chunksize=args.chunksize,
+                        workers=args.workers, train_size=args.train_size, nprobe=args.nprobe,
+                        ef_search=args.ef_search, **index_params)
+        print(f"RAG index built successfully → {args.out}")
+        if args.report:
+            print("--report is skipped for streaming builds (it needs every embedding in memory)")
+        return
 
     print("Loading data...")
-    df = pd.read_csv(DATA_PATH)
+    df = pd.read_csv(args.data)
 
     if "text" not in df.columns:
         raise ValueError("Data must contain a 'text' column.")
 
-    print("Building RAG index...")
-    rag = RAGIndex()
+    print(f"Building RAG index ({args.index_type})...")
+    rag = RAGIndex(backend=args.backend)
+
+    if args.incremental:
+        embeddings = incremental_build(rag, df, args.out, index_type=args.index_type, train_size=args.train_size,
+                                       nprobe=args.nprobe, ef_search=args.ef_search, **index_params)
+    else:
+        embeddings = rag.build_from_df(df, text_col="text", index_type=args.index_type, train_size=args.train_size,
+                                       nprobe=args.nprobe, ef_search=args.ef_search, **index_params)
 
-    rag.build_from_df(df, text_col="text")
+        print("Saving index...")
+        rag.save(args.out, embeddings=embeddings)
 
-    print("Saving index...")
-    rag.save(INDEX_DIR)
+    print(f"RAG index built successfully → {args.out}")
 
-    print(f"RAG index built successfully → {INDEX_DIR}")
+    if args.report:
+        rows = recall_latency_report(rag, embeddings)
+        print(f"{'index':<10} {'param':<14} {'recall@5':>9} {'ms/query':>9}")
+        for r in rows:
+            print(f"{r['index_type']:<10} {r['param'] or '-':<14} {r['recall']:>9.3f} {r['ms_per_query']:>9.3f}")
+        if args.report_json:
+            with open(args.report_json, "w") as f:
+                json.dump(rows, f, indent=2)
 
 if __name__ == "__main__":
     main()
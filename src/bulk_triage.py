@@ -0,0 +1,499 @@
+"""
+Offline bulk triage over exported cohort files (CSV / XLSX / Parquet).
+
+    python src/bulk_triage.py data/cohort.csv --out results.parquet --workers 4
+    python src/bulk_triage.py data/questions.xlsx --text-column Question --out answers.jsonl --llm
+
+Input: one column per symptom (bool / 0-1 / yes-no), optionally an id column and
+a free-text column. Rows are read in chunks, never the whole file at once.
+
+ - Every chunk goes to a worker process holding its own rule engine and mmap RAG
+   index (or a retrieval_pool.py client when RETRIEVAL_POOL is set): one
+   match_matrix() matmul for the rules, one query_many() call (a single encode +
+   search) for retrieval and, with --llm, one encode for all prompt sentences.
+ - With --llm the main process calls Gemini for the budgeted prompts, at most
+   --llm-concurrency at a time and through the LLM cache, so a rerun is free.
+   Rows the fast path answers (emergency matches by default) get the rule summary.
+ - Results are written in input order as each chunk finishes: JSONL lines, or
+   one Parquet part file per chunk in the --out directory. A checkpoint file then
+   records the rows done; running the same command again resumes from there.
+ - A progress line on stderr shows rows/s and the ETA.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from multiprocessing import get_context
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from prompt_budget import PROMPT_TOKEN_BUDGET, build_prompt, split_sentences
+from rules_engine import symptom_query
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+TRIAGE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+CHUNK_ROWS = 500           # rows per worker task (one rules matmul + one retrieval batch)
+TRIAGE_TOP_K = 3           # passages kept per row
+LLM_CONCURRENCY = 8        # Gemini calls in flight
+THREADS_PER_WORKER = 1     # torch / faiss threads per worker process
+PROGRESS_INTERVAL = 1.0    # seconds between progress line updates
+
+_state: Dict[str, Any] = {}  # per worker process: rule engine, rag index
+
+
+# ---------------------------------------------------------------- input
+
+def count_rows(path: str, sheet: str = None) -> Optional[int]:
+    """Data rows in the file (cheap, approximate for CSV cells with line breaks), None if unknown."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    if ext in (".xlsx", ".xlsm"):
+        import openpyxl
+        wb = openpyxl.load_workbook(path, read_only=True)
+        ws = wb[sheet] if sheet else wb.active
+        n = ws.max_row
+        wb.close()
+        return n - 1 if n else None
+    n, last = 0, b""
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            n += block.count(b"\n")
+            last = block
+    return max(0, n - 1 + (0 if n == 0 or last.endswith(b"\n") else 1))
+
+
+def read_chunks(path: str, chunk_rows: int = CHUNK_ROWS, skip_rows: int = 0,
+                sheet: str = None) -> Iterator["pd.DataFrame"]:
+    """DataFrames of up to chunk_rows rows, after skipping the first skip_rows data rows."""
+    import pandas as pd
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            if skip_rows >= batch.num_rows:
+                skip_rows -= batch.num_rows
+                continue
+            yield batch.slice(skip_rows).to_pandas()
+            skip_rows = 0
+    elif ext in (".xlsx", ".xlsm"):
+        import openpyxl  # pandas' xlsx engine; read_only streams the sheet
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = (wb[sheet] if sheet else wb.active).iter_rows(values_only=True)
+            header = [str(c) for c in next(rows, ())]
+            rows = islice(rows, skip_rows, None)
+            while True:
+                block = list(islice(rows, chunk_rows))
+                if not block:
+                    break
+                yield pd.DataFrame(block, columns=header)
+        finally:
+            wb.close()
+    else:
+        # skip data rows, not lines: a quoted cell may span several lines
+        for chunk in pd.read_csv(path, chunksize=chunk_rows):
+            if skip_rows >= len(chunk):
+                skip_rows -= len(chunk)
+                continue
+            yield chunk.iloc[skip_rows:]
+            skip_rows = 0
+
+
+# ---------------------------------------------------------------- workers
+
+def _init_worker(index_dir: Optional[str], threads: int):
+    # before torch / faiss are imported, so each worker stays on its own cores
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    from rules_engine import RuleEngine
+
+    _state["rules"] = RuleEngine(compiled=True, compact=True)
+    _state["rag"] = None
+    if index_dir:
+        from retrieval_pool import RETRIEVAL_POOL, PooledRAGIndex
+        if RETRIEVAL_POOL:
+            _state["rag"] = PooledRAGIndex(RETRIEVAL_POOL, index_dir)
+        else:
+            from rag import RAGIndex
+            rag = RAGIndex()
+            rag.load(index_dir, mmap=True)
+            _state["rag"] = rag
+
+
+def _batched_embed(rag, queries: List[str], sentences: List[str]) -> Callable[[List[str]], np.ndarray]:
+    """
+    Embed a chunk's queries (from the query LRU, where retrieval left them) and prompt
+    sentences (straight through the embedder) up front; the returned embed() only looks vectors up.
+    """
+    queries, sentences = list(dict.fromkeys(queries)), list(dict.fromkeys(sentences))
+    empty = np.zeros((0, rag.dim), dtype=np.float32)
+    vecs = np.concatenate([rag.embed_queries(queries) if queries else empty,
+                           rag.embed_passages(sentences) if sentences else empty])
+    rows = {t: i for i, t in enumerate(queries + sentences)}
+    return lambda batch: vecs[[rows[t] for t in batch]]
+
+
+def triage_chunk(df: "pd.DataFrame", start: int, text_column: str = None, id_column: str = None,
+                 top_k: int = TRIAGE_TOP_K, prompts: bool = False,
+                 prompt_budget: int = PROMPT_TOKEN_BUDGET) -> List[dict]:
+    """
+    Rules (+ retrieval, + prompt) for one chunk, in the calling worker. One dict per row;
+    "_rules" / "_prompt" are for the LLM stage and are not written out.
+    """
+    engine, rag = _state["rules"], _state["rag"]
+    names = list(engine.symptom_index)
+    F = engine.frame_matrix(df)
+    hits = engine.match_matrix(F)
+    texts = [""] * len(df)
+    if text_column and text_column in df.columns:
+        texts = ["" if v is None or v != v else str(v).strip() for v in df[text_column].tolist()]
+    ids = df[id_column].tolist() if id_column and id_column in df.columns else None
+
+    out = []
+    for n in range(len(df)):
+        present = [names[j] for j in np.flatnonzero(F[n])]
+        matches = [engine.rules[i] for i in np.flatnonzero(hits[n])]
+        row = {"row": start + n}
+        if ids is not None:
+            row["id"] = None if ids[n] is None else str(ids[n])
+        if text_column:
+            row["text"] = texts[n]
+        row.update(symptoms=present, matches=[m["name"] for m in matches],
+                   emergency=any(m["emergency"] for m in matches),
+                   _rules=[dict(m, conditions=list(m["conditions"])) for m in matches],
+                   _query=symptom_query(dict.fromkeys(present, True), texts[n]))
+        out.append(row)
+
+    if rag is not None:
+        queries = list(dict.fromkeys(r["_query"] for r in out if r["_query"]))
+        retrieved = dict(zip(queries, rag.query_many(queries, top_k=top_k)))  # one encode + search
+        for r in out:
+            found = retrieved.get(r["_query"], [])
+            r["retrieved"] = [p["text"] for _, p in found]
+            r["retrieved_scores"] = [round(float(s), 4) for s, _ in found]
+
+    if prompts:
+        embed = None
+        if rag is not None:
+            embed = _batched_embed(rag, [r["_query"] for r in out],
+                                   [s for r in out for c in r["retrieved"] for s in split_sentences(c)])
+        for r, text in zip(out, texts):
+            r["_prompt"], stats = build_prompt({s: True for s in r["symptoms"]}, r["_rules"],
+                                               r.get("retrieved", []), text, query=r["_query"],
+                                               embed=embed, budget=prompt_budget)
+            r["prompt_tokens"] = stats["tokens"]
+    for r in out:
+        del r["_query"]
+    return out
+
+
+# ---------------------------------------------------------------- LLM stage
+
+class LLMStage:
+    """Summaries for one chunk's rows: fast-path rule summary, or Gemini through the LLM cache."""
+
+    def __init__(self, concurrency: int = LLM_CONCURRENCY, fast_path: str = "emergency"):
+        from hybrid_engine import fast_path_reason
+        from llm_cache import default_llm_cache
+
+        fast_path_reason([], fast_path)  # validate early
+        self.fast_path = fast_path
+        self.cache = default_llm_cache()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="triage-llm")
+        self.errors = 0
+
+    def _summary(self, prompt: str):
+        from llm_cache import prompt_key
+        from llm_wrapper import MODEL_NAME, generate_with_llm
+
+        key = prompt_key(prompt, MODEL_NAME)
+        cached, tier = self.cache.lookup(key)
+        if cached is not None:
+            return cached, tier
+        text = generate_with_llm(prompt)
+        self.cache.put(key, text)
+        return text, "miss"
+
+    def submit(self, rows: List[dict]) -> List[Tuple[dict, Future]]:
+        from hybrid_engine import fast_path_reason, rule_summary
+
+        pending = []
+        for r in rows:
+            rules = r["_rules"]
+            if fast_path_reason(rules, self.fast_path):
+                r.update(summary=rule_summary({s: True for s in r["symptoms"]}, rules), path="fast",
+                         llm_cache="skipped")
+            else:
+                pending.append((r, self.executor.submit(self._summary, r["_prompt"])))
+        return pending
+
+    def collect(self, pending: List[Tuple[dict, Future]]):
+        """Wait for a chunk's calls and put the summaries (or errors) on their rows."""
+        for row, fut in pending:
+            try:
+                summary, tier = fut.result()
+                row.update(summary=summary, path="full", llm_cache=tier)
+            except Exception as e:
+                self.errors += 1
+                row.update(summary=None, path="full", llm_cache="error", llm_error=str(e))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+# ---------------------------------------------------------------- output
+
+class JsonlSink:
+    def __init__(self, path: str, resume_bytes: int = 0):
+        self.path = path
+        self.f = open(path, "r+b" if resume_bytes else "wb")
+        self.f.truncate(resume_bytes)  # drop lines written after the last checkpoint
+        self.f.seek(resume_bytes)
+
+    def write(self, chunk_index: int, rows: List[dict]):
+        self.f.write("".join(json.dumps(r, default=str) + "\n" for r in rows).encode("utf-8"))
+        self.f.flush()
+
+    def position(self) -> int:
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetSink:
+    """A directory of part-NNNNN.parquet files (pandas.read_parquet(dir) reads them all)."""
+
+    def __init__(self, path: str, resume_chunks: int = 0):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name.startswith("part-") and int(name[5:10]) >= resume_chunks:
+                os.remove(os.path.join(path, name))
+        self.schema = None
+
+    def write(self, chunk_index: int, rows: List[dict]):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.schema is None:
+            self.schema = _schema(rows[0])
+        table = pa.Table.from_pylist(rows, schema=self.schema)
+        final = os.path.join(self.path, f"part-{chunk_index:05d}.parquet")
+        pq.write_table(table, final + ".tmp")
+        os.replace(final + ".tmp", final)
+
+    def position(self) -> int:
+        return 0
+
+    def close(self):
+        pass
+
+
+def _schema(row: dict):
+    """Fixed column types, so parts with only empty lists / None still read as one dataset."""
+    import pyarrow as pa
+
+    types = {"row": pa.int64(), "emergency": pa.bool_(), "prompt_tokens": pa.int64(),
+             "retrieved_scores": pa.list_(pa.float32())}
+    lists = ("symptoms", "matches", "retrieved")
+    fields = [pa.field(k, types.get(k, pa.list_(pa.string()) if k in lists else pa.string()))
+              for k in list(row) + (["llm_error"] if "summary" in row and "llm_error" not in row else [])]
+    return pa.schema(fields)
+
+
+# ---------------------------------------------------------------- checkpoint / progress
+
+def load_checkpoint(path: str, identity: dict) -> Optional[dict]:
+    """The checkpoint of an earlier run of the same job, None if there is none."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        ckpt = json.load(f)
+    if ckpt.get("job") != identity:
+        raise SystemExit(f"[triage] {path} belongs to a different input / options; pass --restart to start over")
+    return ckpt
+
+
+def save_checkpoint(path: str, ckpt: dict):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(ckpt, f)
+    os.replace(tmp, path)
+
+
+class Progress:
+    def __init__(self, total: Optional[int], done: int = 0, stream=sys.stderr):
+        self.total = total
+        self.base = done
+        self.done = done
+        self.started = time.monotonic()
+        self.last = 0.0
+        self.stream = stream
+
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return (self.done - self.base) / elapsed if elapsed > 0 else 0.0
+
+    def update(self, done: int, force: bool = False):
+        self.done = done
+        now = time.monotonic()
+        if not force and now - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = now
+        rate = self.rate()
+        line = f"[triage] {done:,}"
+        if self.total:
+            line += f"/{self.total:,} rows ({100.0 * done / self.total:.1f}%)"
+        else:
+            line += " rows"
+        line += f"  {rate:,.1f} rows/s"
+        if self.total and rate > 0:
+            line += f"  ETA {_hms(max(0, self.total - done) / rate)}"
+        self.stream.write("\r" + line + "   ")
+        self.stream.flush()
+
+    def close(self):
+        self.update(self.done, force=True)
+        self.stream.write("\n")
+
+
+def _hms(seconds: float) -> str:
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return f"{h:d}:{m:02d}:{s:02d}"
+
+
+# ---------------------------------------------------------------- driver
+
+def run(input_path: str, out: str, workers: int = TRIAGE_WORKERS, chunk_rows: int = CHUNK_ROWS,
+        index_dir: Optional[str] = "data/rag_index", text_column: str = None, id_column: str = "id",
+        top_k: int = TRIAGE_TOP_K, llm: bool = False, llm_concurrency: int = LLM_CONCURRENCY,
+        fast_path: str = "emergency", checkpoint: str = None, restart: bool = False, sheet: str = None,
+        threads_per_worker: int = THREADS_PER_WORKER) -> dict:
+    """Triage every row of input_path into out (.jsonl, or a Parquet directory). Returns run stats."""
+    checkpoint = checkpoint or out.rstrip("/") + ".checkpoint.json"
+    st = os.stat(input_path)
+    identity = {"input": os.path.abspath(input_path), "size": st.st_size, "mtime": int(st.st_mtime),
+                "output": os.path.abspath(out), "chunk_rows": chunk_rows, "text_column": text_column,
+                "id_column": id_column, "index": index_dir, "top_k": top_k, "llm": llm, "sheet": sheet}
+    if restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    ckpt = load_checkpoint(checkpoint, identity) or {"job": identity, "rows_done": 0, "chunks_done": 0,
+                                                     "output_bytes": 0}
+    if ckpt["rows_done"]:
+        print(f"[triage] resuming after {ckpt['rows_done']:,} rows ({checkpoint})")
+
+    parquet = not out.endswith((".jsonl", ".ndjson"))
+    sink = ParquetSink(out, ckpt["chunks_done"]) if parquet else JsonlSink(out, ckpt["output_bytes"])
+    stage = LLMStage(llm_concurrency, fast_path) if llm else None
+    progress = Progress(count_rows(input_path, sheet), ckpt["rows_done"])
+    task_args = (text_column, id_column, top_k, llm)
+
+    if workers > 0:
+        pool = ProcessPoolExecutor(workers, mp_context=get_context("spawn"), initializer=_init_worker,
+                                   initargs=(index_dir, threads_per_worker))
+    else:  # in this process (debugging, tiny files)
+        _init_worker(index_dir, threads_per_worker)
+        pool = None
+
+    retrieving = deque()  # (chunk index, first row, Future of the rows), input order
+    summarizing = deque()  # (chunk index, rows, [(row, LLM future)])
+    max_ahead = max(2, 2 * workers)
+    emergencies = 0
+
+    def finish_oldest():
+        nonlocal emergencies
+        index, rows, pending = summarizing.popleft()
+        if stage is not None:
+            stage.collect(pending)
+        for r in rows:
+            r.pop("_rules", None)
+            r.pop("_prompt", None)
+        sink.write(index, rows)
+        emergencies += sum(r["emergency"] for r in rows)
+        ckpt.update(rows_done=rows[-1]["row"] + 1, chunks_done=index + 1, output_bytes=sink.position())
+        save_checkpoint(checkpoint, ckpt)
+        progress.update(ckpt["rows_done"])
+
+    def advance(block: bool):
+        # move finished retrievals to the LLM stage, then write whatever is complete, in order
+        while retrieving and (block or retrieving[0][2].done()):
+            index, _, fut = retrieving.popleft()
+            rows = fut.result()
+            summarizing.append((index, rows, stage.submit(rows) if stage else []))
+            block = False
+        while summarizing and (all(f.done() for _, f in summarizing[0][2]) or len(summarizing) > max_ahead):
+            finish_oldest()
+
+    try:
+        index, start = ckpt["chunks_done"], ckpt["rows_done"]
+        for df in read_chunks(input_path, chunk_rows, start, sheet):
+            if pool is not None:
+                fut = pool.submit(triage_chunk, df, start, *task_args)
+            else:
+                fut = Future()
+                fut.set_result(triage_chunk(df, start, *task_args))
+            retrieving.append((index, start, fut))
+            index, start = index + 1, start + len(df)
+            advance(block=len(retrieving) >= max_ahead)
+        while retrieving or summarizing:
+            advance(block=True)
+            if summarizing:
+                finish_oldest()
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        if stage is not None:
+            stage.close()
+        sink.close()
+        progress.close()
+
+    stats = {"rows": ckpt["rows_done"], "rows_this_run": ckpt["rows_done"] - progress.base,
+             "rows_per_s": round(progress.rate(), 2), "emergencies": emergencies,
+             "llm_errors": stage.errors if stage else 0, "output": out, "checkpoint": checkpoint}
+    print("[triage] " + ", ".join(f"{k}={v}" for k, v in stats.items()))
+    return stats
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Bulk rule + RAG (+ LLM) triage of a CSV / XLSX / Parquet cohort.")
+    p.add_argument("input")
+    p.add_argument("--out", required=True, help="results: *.jsonl, otherwise a Parquet directory")
+    p.add_argument("--workers", type=int, default=TRIAGE_WORKERS, help="worker processes (0: in this process)")
+    p.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    p.add_argument("--index", default="data/rag_index")
+    p.add_argument("--no-rag", action="store_true", help="rules only, no retrieval")
+    p.add_argument("--text-column", default=None, help="free-text column used as the retrieval query")
+    p.add_argument("--id-column", default="id")
+    p.add_argument("--sheet", default=None, help="XLSX sheet (default: the active one)")
+    p.add_argument("--top-k", type=int, default=TRIAGE_TOP_K)
+    p.add_argument("--llm", action="store_true", help="add an LLM summary per row")
+    p.add_argument("--llm-concurrency", type=int, default=LLM_CONCURRENCY)
+    p.add_argument("--fast-path", default="emergency", help='rows answered by the rule summary: "off" | '
+                                                            '"emergency" | "confident"')
+    p.add_argument("--checkpoint", default=None, help="default: <out>.checkpoint.json")
+    p.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    p.add_argument("--threads-per-worker", type=int, default=THREADS_PER_WORKER)
+    args = p.parse_args(argv)
+
+    run(args.input, args.out, workers=args.workers, chunk_rows=args.chunk_rows,
+        index_dir=None if args.no_rag else args.index, text_column=args.text_column, id_column=args.id_column,
+        top_k=args.top_k, llm=args.llm, llm_concurrency=args.llm_concurrency, fast_path=args.fast_path,
+        checkpoint=args.checkpoint, restart=args.restart, sheet=args.sheet,
+        threads_per_worker=args.threads_per_worker)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Embedding backends for the RAG index.
+
+Every backend exposes the slice of the SentenceTransformer API that rag.py uses:
+encode(texts, convert_to_numpy=True, ...) and get_sentence_embedding_dimension().
+
+ - "torch"     : sentence-transformers on PyTorch (full precision, the reference)
+ - "onnx"      : the same transformer exported to ONNX, run with ONNX Runtime
+ - "onnx-int8" : the ONNX export with int8 dynamic quantization (fastest on CPU)
+
+The ONNX backends need a one-off export, which still uses torch:
+
+    python src/embedders.py export --model all-MiniLM-L6-v2
+
+At query time they only need onnxruntime + tokenizers, not torch.
+"""
+
+import argparse
+import inspect
+import json
+import os
+from typing import List, Union
+
+import numpy as np
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")
+ONNX_DIR = "data/onnx"
+ONNX_FP32_FILE = "model.onnx"
+ONNX_INT8_FILE = "model.int8.onnx"
+ONNX_CONFIG_FILE = "embedder.json"
+ONNX_BATCH_SIZE = 32
+
+
+def onnx_model_dir(model_name: str, root: str = ONNX_DIR) -> str:
+    return os.path.join(root, model_name.replace("/", "__"))
+
+
+def make_embedder(model_name: str, backend: str = None, onnx_root: str = ONNX_DIR):
+    backend = backend or EMBED_BACKEND
+    if backend == "torch":
+        from sentence_transformers import SentenceTransformer  # pulls in torch
+        return SentenceTransformer(model_name)
+    if backend in ("onnx", "onnx-int8"):
+        return OnnxEmbedder(onnx_model_dir(model_name, onnx_root), quantized=backend == "onnx-int8")
+    raise ValueError(f"Unknown embedding backend: {backend} (expected one of {BACKENDS})")
+
+
+class OnnxEmbedder:
+    """Transformer forward pass in ONNX Runtime, then mean pooling (as in sentence-transformers)."""
+
+    def __init__(self, model_dir: str, quantized: bool = True, intra_op_threads: int = None):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_file = ONNX_INT8_FILE if quantized else ONNX_FP32_FILE
+        model_path = os.path.join(model_dir, model_file)
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Missing {model_path}; run `python src/embedders.py export` first.")
+        with open(os.path.join(model_dir, ONNX_CONFIG_FILE)) as f:
+            self.config = json.load(f)
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            opts.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(model_path, opts, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_token_id"], pad_token=self.config["pad_token"])
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.config["dim"]
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        enc = self.tokenizer.encode_batch(texts)
+        feeds = {
+            "input_ids": np.array([e.ids for e in enc], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in enc], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in enc], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {n: feeds[n] for n in self.input_names})[0]
+        mask = feeds["attention_mask"][..., None].astype(np.float32)
+        return (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+    def encode(self, texts: Union[str, List[str]], batch_size: int = ONNX_BATCH_SIZE,
+               convert_to_numpy: bool = True, show_progress_bar: bool = False, **_) -> np.ndarray:
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        out = np.zeros((len(texts), self.get_sentence_embedding_dimension()), dtype=np.float32)
+        # length-sorted batches keep padding (and wasted compute) small
+        order = np.argsort([len(t) for t in texts], kind="stable")
+        for start in range(0, len(texts), batch_size):
+            idx = order[start:start + batch_size]
+            out[idx] = self._encode_batch([texts[i] for i in idx])
+        if self.config.get("normalize"):
+            out /= np.clip(np.linalg.norm(out, axis=1, keepdims=True), 1e-12, None)
+        return out[0] if single else out
+
+
+def export_onnx(model_name: str, out_root: str = ONNX_DIR, quantize: bool = True, opset: int = 17) -> str:
+    """Export the sentence-transformers model to ONNX (+ int8 dynamic quantization)."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    out_dir = onnx_model_dir(model_name, out_root)
+    os.makedirs(out_dir, exist_ok=True)
+    st_model = SentenceTransformer(model_name, device="cpu")
+    transformer = st_model[0]
+    hf_model = transformer.auto_model.eval()
+    tokenizer = transformer.tokenizer
+
+    dummy = tokenizer(["fever and cough"], return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in dummy]
+    axes = {n: {0: "batch", 1: "seq"} for n in input_names + ["last_hidden_state"]}
+    fp32_path = os.path.join(out_dir, ONNX_FP32_FILE)
+
+    class HiddenStates(torch.nn.Module):
+        # keyword call: positional order of HF forward() differs between versions
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs)))[0]
+
+    # TorchScript exporter: newer torch defaults to the dynamo exporter
+    legacy = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(HiddenStates(hf_model), tuple(dummy[n] for n in input_names), fp32_path,
+                          input_names=input_names, output_names=["last_hidden_state"],
+                          dynamic_axes=axes, opset_version=opset, **legacy)
+
+    tokenizer.save_pretrained(out_dir)
+    normalize = any(type(m).__name__ == "Normalize" for m in st_model)
+    with open(os.path.join(out_dir, ONNX_CONFIG_FILE), "w") as f:
+        json.dump({
+            "model_name": model_name,
+            "dim": st_model.get_sentence_embedding_dimension(),
+            "max_seq_length": st_model.max_seq_length,
+            "pad_token": tokenizer.pad_token,
+            "pad_token_id": tokenizer.pad_token_id,
+            "normalize": normalize,
+        }, f, indent=2)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(fp32_path, os.path.join(out_dir, ONNX_INT8_FILE), weight_type=QuantType.QInt8)
+    print(f"Exported {model_name} → {out_dir}")
+    return out_dir
+
+
+if __name__ == "__main__":
+    from rag import EMBED_MODEL_NAME
+
+    p = argparse.ArgumentParser(description="Export the embedding model for the ONNX backends.")
+    p.add_argument("command", choices=["export"])
+    p.add_argument("--model", default=EMBED_MODEL_NAME)
+    p.add_argument("--out", default=ONNX_DIR)
+    p.add_argument("--no-quantize", action="store_true")
+    args = p.parse_args()
+    export_onnx(args.model, args.out, quantize=not args.no_quantize)
@@ -0,0 +1,125 @@
+"""
+Local stand-in for the Gemini REST API, for testing the LLM client offline.
+
+Serves generateContent / streamGenerateContent with configurable latency and
+injected transient failures (HTTP 503), and counts upstream calls on /stats so
+retries and single-flight coalescing can be checked:
+
+    python src/fake_llm_server.py --port 8089 --latency-ms 300 --fail-rate 0.2
+    GEMINI_API_ENDPOINT=http://127.0.0.1:8089 GOOGLE_API_KEY=fake uvicorn api:app --app-dir src
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import threading
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="Fake Gemini")
+config = {"latency_ms": 200.0, "fail_rate": 0.0, "empty_rate": 0.0, "chunks": 4}
+counts = {"generate": 0, "stream": 0, "failed": 0}
+_lock = threading.Lock()
+
+
+def _count(name: str):
+    with _lock:
+        counts[name] += 1
+
+
+def _prompt(body: dict) -> str:
+    return "".join(p.get("text", "") for c in body.get("contents", []) for p in c.get("parts", []))
+
+
+def _answer(prompt: str) -> str:
+    digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+    return (f"Possible conditions: see rule matches (confidence: low). Prompt {digest}. "
+            "This is not a diagnosis; please seek professional medical care.")
+
+
+def _response(text: str, finish: bool = True) -> dict:
+    candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+    if finish:
+        candidate["finishReason"] = "STOP"
+    return {"candidates": [candidate]}
+
+
+def _empty() -> dict:
+    """What a thinking model sends when max_output_tokens ran out before any text."""
+    return {"candidates": [{"content": {"role": "model"}, "finishReason": "MAX_TOKENS", "index": 0}]}
+
+
+def _failure():
+    if random.random() < config["fail_rate"]:
+        _count("failed")
+        return JSONResponse(status_code=503, content={
+            "error": {"code": 503, "message": "The model is overloaded.", "status": "UNAVAILABLE"}})
+    return None
+
+
+@app.post("/v1beta/models/{model}:generateContent")
+async def generate(model: str, request: Request):
+    _count("generate")
+    body = await request.json()
+    await asyncio.sleep(config["latency_ms"] / 1000.0)
+    if random.random() < config["empty_rate"]:
+        return _empty()
+    return _failure() or _response(_answer(_prompt(body)))
+
+
+@app.post("/v1beta/models/{model}:streamGenerateContent")
+async def stream(model: str, request: Request):
+    _count("stream")
+    body = await request.json()
+    failed = _failure()
+    if failed:
+        return failed
+    if random.random() < config["empty_rate"]:
+        return StreamingResponse(iter(["[" + json.dumps(_empty()) + "]"]), media_type="application/json")
+    words = _answer(_prompt(body)).split(" ")
+    n = config["chunks"]
+    parts = [" ".join(words[i * len(words) // n:(i + 1) * len(words) // n]) + " " for i in range(n)]
+
+    async def events():
+        # the REST transport reads a streamed JSON array
+        yield "["
+        for i, part in enumerate(parts):
+            await asyncio.sleep(config["latency_ms"] / 1000.0 / n)
+            yield ("," if i else "") + json.dumps(_response(part, finish=i == n - 1))
+        yield "]"
+
+    return StreamingResponse(events(), media_type="application/json")
+
+
+@app.get("/stats")
+def stats():
+    with _lock:
+        return dict(counts)
+
+
+@app.post("/reset")
+def reset():
+    with _lock:
+        for k in counts:
+            counts[k] = 0
+    return dict(counts)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    p = argparse.ArgumentParser(description="Fake Gemini REST server.")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8089)
+    p.add_argument("--latency-ms", type=float, default=config["latency_ms"])
+    p.add_argument("--fail-rate", type=float, default=config["fail_rate"], help="share of calls answered with 503")
+    p.add_argument("--empty-rate", type=float, default=config["empty_rate"],
+                   help="share of calls answered with no text (finishReason MAX_TOKENS)")
+    p.add_argument("--chunks", type=int, default=config["chunks"])
+    args = p.parse_args()
+    config.update(latency_ms=args.latency_ms, fail_rate=args.fail_rate, empty_rate=args.empty_rate,
+                  chunks=args.chunks)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -4,70 +4,568 @@ Hybrid engine that:
 2. Runs RAG to fetch top-k supporting context passages.
 3. Calls LLM to produce a human-readable, safe reasoning summary,
    combining facts, matched rules, and retrieved context.
+
+Fast path: when the rules alone give an emergency (or, by policy, a single
+unambiguous) match, a templated rule summary is returned right away and the
+LLM elaboration runs in the background (or is deferred) -- see FAST_PATH.
+
+Free-text requests also go through a semantic cache (semantic_cache.py): a close
+paraphrase with the same symptom flags reuses the earlier retrieval and summary.
+
+Prompts are built under a token budget (prompt_budget.py): only present symptoms,
+deduplicated passages trimmed to their sentences closest to the query.
 """
 
-from typing import Dict, Any, List
-from rag import RAGIndex
-from rules_engine import RuleEngine
-from llm_wrapper import generate_with_llm
-import pandas as pd
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Any, List, AsyncIterator, Iterator
+from rules_engine import RuleEngine, symptom_query
+from llm_wrapper import (generate_with_llm, generate_with_llm_async, stream_with_llm, stream_with_llm_async,
+                         MODEL_NAME)
+from llm_cache import default_llm_cache, prompt_key
+from metrics import CACHE_LOOKUPS, HYBRID_PATHS, LLM_ERRORS, PROMPT_TOKENS, collect_timings, record_stage, timed
+from prompt_budget import PROMPT_TOKEN_BUDGET, build_prompt
 import os
+import time
+
+if TYPE_CHECKING:
+    from rag import RAGIndex
+
+# async pipeline limits: a slow upstream times out instead of piling up requests
+RETRIEVAL_WORKERS = 8        # threads doing embedding + faiss search
+RETRIEVAL_CONCURRENCY = 64   # retrievals admitted at once (the rest wait, under the timeout)
+RETRIEVAL_TIMEOUT = 10.0     # seconds
+LLM_CONCURRENCY = 32         # in-flight Gemini calls per process
+LLM_TIMEOUT = 60.0           # seconds
+
+# fast path policy: "off" | "emergency" (any emergency rule matched) |
+# "confident" (emergency, or exactly one full rule match)
+FAST_PATH_POLICIES = ("off", "emergency", "confident")
+FAST_PATH = os.getenv("HYBRID_FAST_PATH", "emergency")
+# what happens to the LLM elaboration on the fast path: "background" (started now,
+# result lands in the LLM cache) | "deferred" (not run; ask again with fast_path="off")
+FAST_PATH_LLM = os.getenv("HYBRID_FAST_PATH_LLM", "background")
+BACKGROUND_LLM_WORKERS = 2   # threads running sync background elaborations
+# set while a background elaboration runs: HYBRID_PATHS counts requests, not elaborations
+_ELABORATING = contextvars.ContextVar("hybrid_elaborating", default=False)
 
 # instantiate components (you can pass prebuilt objects)
 rag_index = None
 
+
+class StageTimeout(Exception):
+    """A pipeline stage (retrieval / llm) did not finish within its timeout."""
+
+    def __init__(self, stage: str, timeout: float):
+        super().__init__(f"{stage} stage timed out after {timeout:.1f}s")
+        self.stage = stage
+        self.timeout = timeout
+
 def load_rag_index(index_dir="data/rag_index"):
     global rag_index
     if rag_index is None:
+        from rag import RAGIndex  # faiss + embedder are only imported once RAG is used
         r = RAGIndex()
         r.load(index_dir)
         rag_index = r
     return rag_index
 
+
+def fast_path_reason(rule_matches: List[dict], policy: str = FAST_PATH):
+    """"emergency" / "confident" when the rules alone should answer, else None."""
+    if policy not in FAST_PATH_POLICIES:
+        raise ValueError(f"Unknown fast path policy {policy!r}; expected one of {FAST_PATH_POLICIES}")
+    if policy == "off" or not rule_matches:
+        return None
+    if any(r.get("emergency") for r in rule_matches):
+        return "emergency"
+    if policy == "confident" and len(rule_matches) == 1:
+        return "confident"
+    return None
+
+
+def rule_summary(symptoms: Dict[str,bool], rule_matches: List[dict]) -> str:
+    """Templated, LLM-free summary of the rule matches (fast path)."""
+    lines = []
+    urgent = [r for r in rule_matches if r.get("emergency")]
+    if urgent:
+        lines.append("URGENT: " + "; ".join(f"{r['name']} — {r['explanation']}" for r in urgent) + ".")
+        lines.append("Seek emergency medical care now (call your local emergency number).")
+    for r in rule_matches:
+        if not r.get("emergency"):
+            lines.append(f"Possible condition: {r['name']} (severity: {r['severity']}) — {r['explanation']}.")
+    lines.append("Based on: " + (", ".join(k.replace("_", " ") for k, v in symptoms.items() if v) or "N/A") + ".")
+    lines.append("This is a rule-based screening result, not a diagnosis; please seek professional medical care.")
+    return "\n".join(lines)
+
+
 class HybridEngine:
-    def __init__(self, rag: RAGIndex = None, rules: RuleEngine = None):
+    def __init__(self, rag: "RAGIndex" = None, rules: RuleEngine = None, llm_cache=None, answer_table=None,
+                 fast_path: str = FAST_PATH, fast_path_llm: str = FAST_PATH_LLM, semantic_cache=None,
+                 prompt_budget: int = PROMPT_TOKEN_BUDGET):
         self.rag = rag or load_rag_index()
         self.rules = rules or RuleEngine()
+        # precomputed checklist answers (answer_table.AnswerTable); None -> always compute live
+        self.answer_table = answer_table
+        # any object with get(key)/put(key, value); see llm_cache.py
+        self.llm_cache = llm_cache if llm_cache is not None else default_llm_cache()
+        # semantic_cache.SemanticCache for paraphrased free text; False disables it
+        if semantic_cache is None:
+            from semantic_cache import default_semantic_cache
+            semantic_cache = default_semantic_cache(self.rag)
+        self.semantic_cache = semantic_cache if semantic_cache is not False else None
+        self.executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+        self._retrieval_sem = None
+        self._llm_sem = None
+        fast_path_reason([], fast_path)  # validate early
+        self.fast_path = fast_path
+        self.fast_path_llm = fast_path_llm
+        self._background = None  # executor for sync background elaborations, created on first use
+        self._background_tasks = set()  # strong refs to async background elaborations
+        self.prompt_budget = prompt_budget  # estimated tokens per LLM prompt, see prompt_budget.py
+
+    def _semaphores(self):
+        # created lazily so they belong to the running event loop
+        if self._retrieval_sem is None:
+            self._retrieval_sem = asyncio.Semaphore(RETRIEVAL_CONCURRENCY)
+            self._llm_sem = asyncio.Semaphore(LLM_CONCURRENCY)
+        return self._retrieval_sem, self._llm_sem
+
+    async def _run_stage(self, stage: str, sem: asyncio.Semaphore, timeout: float, coro_fn):
+        async def guarded():
+            async with sem:
+                return await coro_fn()
+        try:
+            return await asyncio.wait_for(guarded(), timeout)
+        except asyncio.TimeoutError:
+            raise StageTimeout(stage, timeout)
+
+    async def retrieve_async(self, query_text: str, top_k: int = 5):
+        """rag.query on the bounded retrieval executor, under the retrieval limits."""
+        retrieval_sem, _ = self._semaphores()
+        loop = asyncio.get_running_loop()
+        return await self._run_stage(
+            "retrieval", retrieval_sem, RETRIEVAL_TIMEOUT,
+            # copied context: stage timers inside rag.query report to this request
+            lambda: loop.run_in_executor(self.executor, contextvars.copy_context().run,
+                                         self.rag.query, query_text, top_k),
+        )
+
+    async def retrieve_symptoms_async(self, symptoms: Dict[str,bool], user_text: str = "", top_k: int = 5):
+        """Precomputed top-k for checklist-only requests, otherwise retrieve_async() on the query text."""
+        with timed("retrieval"):
+            retrieved = self._table_retrieved(symptoms, user_text, top_k)
+            if retrieved is not None:
+                return retrieved
+            return await self.retrieve_async(symptom_query(symptoms, user_text), top_k)
 
-    def explain(self, symptoms: Dict[str,bool], user_text: str = "") -> Dict[str, Any]:
+    def explain(self, symptoms: Dict[str,bool], user_text: str = "", fast_path: str = None) -> Dict[str, Any]:
         """
         Returns:
          - rule_matches: list
          - retrieved_context: list of passages (text + score)
          - llm_summary: string
+         - llm_cache: "memory"/"sqlite" tier that served the summary, or "miss"
+           ("skipped" on the fast path)
+         - path: "full", or "fast" when the rule summary was returned (see _fast_result)
+         - prompt: prompt-size stats (prompt_budget.build_prompt) when a prompt was built
+
+        fast_path overrides the engine's policy for this call.
+        """
+        rule_matches = self._rule_matches(symptoms)
+        fast = self._fast_result(symptoms, user_text, rule_matches, fast_path)
+        if fast is not None:
+            if fast["llm_elaboration"] == "background":
+                fast["elaboration"] = self._background_executor().submit(self._elaborate, symptoms, user_text)
+            return fast
+        semantic_key = self._semantic_key(symptoms, user_text)
+        hit = self._semantic_lookup(semantic_key)
+        if hit is not None:
+            return {"rule_matches": rule_matches, "retrieved": hit[0], "llm_summary": hit[1],
+                    "llm_cache": "semantic", "path": "full"}
+        rule_matches, retrieved, prompt, prompt_stats = self._gather(symptoms, user_text, rule_matches)
+        llm_resp, cache_status = self._cached_llm(prompt)
+        self._semantic_put(semantic_key, retrieved, llm_resp)
+
+        return {
+            "rule_matches": rule_matches,
+            "retrieved": retrieved,
+            "llm_summary": llm_resp,
+            "llm_cache": cache_status,
+            "path": "full",
+            "prompt": prompt_stats
+        }
+
+    def explain_stream(self, symptoms: Dict[str,bool], user_text: str = "", fast_path: str = None) -> Dict[str, Any]:
+        """
+        Like explain(), but "llm_stream" replaces "llm_summary": a generator of text
+        chunks (e.g. for st.write_stream). The full text is cached once it is consumed.
+        On the fast path the stream is the rule summary as a single chunk.
         """
-        rule_matches = self.rules.evaluate(symptoms)
-        # RAG retrieve using either user question or symptom list
-        query_text = user_text if user_text else ", ".join([k for k,v in symptoms.items() if v])
-        retrieved = self.rag.query(query_text, top_k=5)  # list of (score, passage)
+        rule_matches = self._rule_matches(symptoms)
+        fast = self._fast_result(symptoms, user_text, rule_matches, fast_path)
+        if fast is not None:
+            if fast["llm_elaboration"] == "background":
+                fast["elaboration"] = self._background_executor().submit(self._elaborate, symptoms, user_text)
+            fast["llm_stream"] = iter([fast.pop("llm_summary")])
+            return fast
+        semantic_key = self._semantic_key(symptoms, user_text)
+        hit = self._semantic_lookup(semantic_key)
+        if hit is not None:
+            return {"rule_matches": rule_matches, "retrieved": hit[0], "llm_stream": iter([hit[1]]),
+                    "llm_cache": "semantic", "path": "full"}
+        rule_matches, retrieved, prompt, prompt_stats = self._gather(symptoms, user_text, rule_matches)
+        key = prompt_key(prompt, MODEL_NAME)
+        cached, tier = self._cache_lookup(key)
+        if cached is not None:
+            self._semantic_put(semantic_key, retrieved, cached)
+            stream, cache_status = iter([cached]), tier
+        else:
+            stream = self._caching_stream(key, stream_with_llm(prompt), lambda text: self._semantic_put(
+                semantic_key, retrieved, text))
+            cache_status = "miss"
+        return {
+            "rule_matches": rule_matches,
+            "retrieved": retrieved,
+            "llm_stream": stream,
+            "llm_cache": cache_status,
+            "path": "full",
+            "prompt": prompt_stats
+        }
+
+    def _fast_result(self, symptoms: Dict[str,bool], user_text: str, rule_matches: List[dict], fast_path: str = None):
+        """
+        The fast-path response, or None when the policy wants the full pipeline.
+        Keys as explain(), plus "fast_reason" ("emergency"/"confident") and
+        "llm_elaboration" ("background"/"deferred"); the caller attaches the
+        background job as "elaboration" (a Future / Task of the full explain() result).
+        """
+        reason = fast_path_reason(rule_matches, self.fast_path if fast_path is None else fast_path)
+        counted = not _ELABORATING.get()  # a background elaboration is part of its fast-path request
+        if reason is None:
+            if counted:
+                HYBRID_PATHS.inc(path="full")
+            return None
+        if counted:
+            HYBRID_PATHS.inc(path="fast")
+        with timed("prompt_build"):
+            summary = rule_summary(symptoms, rule_matches)
+        return {
+            "rule_matches": rule_matches,
+            # no live retrieval on the fast path; precomputed passages are free to include
+            "retrieved": self._table_retrieved(symptoms, user_text) or [],
+            "llm_summary": summary,
+            "llm_cache": "skipped",
+            "path": "fast",
+            "fast_reason": reason,
+            "llm_elaboration": self.fast_path_llm,
+        }
+
+    def _background_executor(self) -> ThreadPoolExecutor:
+        if self._background is None:
+            self._background = ThreadPoolExecutor(max_workers=BACKGROUND_LLM_WORKERS, thread_name_prefix="llm-background")
+        return self._background
+
+    def _elaborate(self, symptoms: Dict[str,bool], user_text: str) -> Dict[str, Any]:
+        """explain(fast_path="off") on the background executor, not counted as a request of its own."""
+        token = _ELABORATING.set(True)  # executor threads keep their context between jobs
+        try:
+            return self.explain(symptoms, user_text, "off")
+        finally:
+            _ELABORATING.reset(token)
+
+    def _start_background_async(self, symptoms: Dict[str,bool], user_text: str) -> asyncio.Task:
+        async def elaborate():
+            _ELABORATING.set(True)  # the task runs in its own copy of the context
+            with collect_timings():  # keep these stages out of the triggering request's timings
+                try:
+                    return await self.explain_async(symptoms, user_text, fast_path="off")
+                except Exception as e:
+                    print(f"[hybrid] background elaboration failed: {e}")
+                    raise
+
+        task = asyncio.get_running_loop().create_task(elaborate())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_done)
+        return task
+
+    def _background_done(self, task: asyncio.Task):
+        self._background_tasks.discard(task)
+        if not task.cancelled():
+            task.exception()  # logged in elaborate(); nobody may await it
+
+    def _caching_stream(self, key: str, chunks: Iterator[str], on_done=None) -> Iterator[str]:
+        # the "llm" stage is the time spent waiting on upstream, not on the consumer between chunks
+        parts, waited = [], 0.0
+        chunks = iter(chunks)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                except Exception:
+                    LLM_ERRORS.inc(kind="error")
+                    raise
+                finally:
+                    waited += time.perf_counter() - start
+                parts.append(chunk)
+                yield chunk
+        finally:
+            record_stage("llm", waited)
+        text = "".join(parts)
+        if not text:
+            return  # nothing to cache (the LLM client raises on empty answers)
+        self.llm_cache.put(key, text)
+        if on_done is not None:
+            on_done(text)
+
+    def _semantic_key(self, symptoms: Dict[str,bool], user_text: str):
+        """(query embedding, symptoms) for free-text requests when the semantic cache is on, else None."""
+        if self.semantic_cache is None or not user_text or not user_text.strip():
+            return None
+        # an in-process RAGIndex keeps this vector in its embedding LRU; a retrieval pool
+        # (PooledRAGIndex) has no local LRU, so retrieval there embeds the text again
+        return self.rag.embed_queries([user_text])[0], symptoms
+
+    def _semantic_lookup(self, semantic_key):
+        """(retrieved, summary) of a near-duplicate earlier request, or None."""
+        if semantic_key is None:
+            return None
+        with timed("semantic_cache"):
+            return self.semantic_cache.lookup(*semantic_key)[0]
+
+    def _semantic_put(self, semantic_key, retrieved, summary: str):
+        if semantic_key is not None:
+            self.semantic_cache.put(*semantic_key, (retrieved, summary))
+
+    def _gather(self, symptoms: Dict[str,bool], user_text: str, rule_matches: List[dict] = None):
+        """Rules + retrieval + prompt: everything the LLM call depends on."""
+        if rule_matches is None:
+            rule_matches = self._rule_matches(symptoms)
+        with timed("retrieval"):
+            retrieved = self._table_retrieved(symptoms, user_text)
+            if retrieved is None:
+                # RAG retrieve using either user question or symptom list
+                retrieved = self.rag.query(symptom_query(symptoms, user_text), top_k=5)  # list of (score, passage)
         context_texts = [p["text"] for _, p in retrieved]
 
         # Build LLM prompt
-        prompt = self._build_prompt(symptoms, rule_matches, context_texts, user_text)
-        llm_resp = generate_with_llm(prompt)
+        prompt, prompt_stats = self._build_prompt(symptoms, rule_matches, context_texts, user_text)
+        return rule_matches, retrieved, prompt, prompt_stats
+
+    def _rule_matches(self, symptoms: Dict[str,bool]):
+        with timed("rules"):
+            if self.answer_table is not None:
+                matches = self.answer_table.rule_matches(symptoms)
+                if matches is not None:
+                    return matches
+            return self.rules.evaluate(symptoms)
+
+    def _table_retrieved(self, symptoms: Dict[str,bool], user_text: str = "", top_k: int = 5):
+        """Precomputed top-k for checklist-only requests, None when retrieval must run live."""
+        if self.answer_table is None:
+            return None
+        return self.answer_table.retrieved(symptoms, self.rag, user_text, top_k)
+
+    def _cache_lookup(self, key: str):
+        with timed("llm_cache"):
+            if hasattr(self.llm_cache, "lookup"):
+                cached, tier = self.llm_cache.lookup(key)
+            else:
+                cached = self.llm_cache.get(key)
+                tier = "hit" if cached is not None else None
+        CACHE_LOOKUPS.inc(cache="llm", result=tier or "miss")
+        return cached, tier
+
+    async def _cache_lookup_async(self, key: str):
+        """_cache_lookup() with in-memory tiers answered inline and disk tiers (SQLite) on a thread."""
+        if hasattr(self.llm_cache, "lookup_nonblocking"):
+            with timed("llm_cache"):
+                cached, tier = self.llm_cache.lookup_nonblocking(key)
+            if cached is not None:
+                CACHE_LOOKUPS.inc(cache="llm", result=tier)
+                return cached, tier
+            if not self.llm_cache.has_blocking_tiers():
+                return self._cache_lookup(key)
+        return await asyncio.to_thread(self._cache_lookup, key)
+
+    async def _cache_put_async(self, key: str, value: str):
+        await asyncio.to_thread(self.llm_cache.put, key, value)
+
+    def _cached_llm(self, prompt: str):
+        key = prompt_key(prompt, MODEL_NAME)
+        cached, tier = self._cache_lookup(key)
+        if cached is not None:
+            return cached, tier
+        with timed("llm"):
+            try:
+                resp = generate_with_llm(prompt)
+            except Exception:
+                LLM_ERRORS.inc(kind="error")
+                raise
+        self.llm_cache.put(key, resp)
+        return resp, "miss"
+
+    async def explain_async(self, symptoms: Dict[str,bool], user_text: str = "", fast_path: str = None) -> Dict[str, Any]:
+        """
+        Async version of explain(): the rules are evaluated first (deciding the fast
+        path), then retrieval runs on the bounded executor and the LLM is awaited
+        through the async client.
+        Raises StageTimeout if retrieval or the LLM exceed their timeouts.
+        """
+        rule_matches = self._rule_matches(symptoms)
+        fast = self._fast_result(symptoms, user_text, rule_matches, fast_path)
+        if fast is not None:
+            if fast["llm_elaboration"] == "background":
+                fast["elaboration"] = self._start_background_async(symptoms, user_text)
+            return fast
+        semantic_key = await self._semantic_key_async(symptoms, user_text)
+        hit = self._semantic_lookup(semantic_key)
+        if hit is not None:
+            return {"rule_matches": rule_matches, "retrieved": hit[0], "llm_summary": hit[1],
+                    "llm_cache": "semantic", "path": "full"}
+        rule_matches, retrieved, prompt, prompt_stats = await self._gather_async(symptoms, user_text, rule_matches)
+        llm_resp, cache_status = await self._cached_llm_async(prompt)
+        self._semantic_put(semantic_key, retrieved, llm_resp)
 
         return {
             "rule_matches": rule_matches,
             "retrieved": retrieved,
-            "llm_summary": llm_resp
+            "llm_summary": llm_resp,
+            "llm_cache": cache_status,
+            "path": "full",
+            "prompt": prompt_stats
         }
 
+    async def explain_stream_async(self, symptoms: Dict[str,bool], user_text: str = "", fast_path: str = None) -> Dict[str, Any]:
+        """
+        Async version of explain_stream(): "llm_stream" is an async generator of text chunks.
+        Each chunk must arrive within LLM_TIMEOUT, otherwise StageTimeout is raised mid-stream.
+        """
+        rule_matches = self._rule_matches(symptoms)
+        fast = self._fast_result(symptoms, user_text, rule_matches, fast_path)
+        if fast is not None:
+            if fast["llm_elaboration"] == "background":
+                fast["elaboration"] = self._start_background_async(symptoms, user_text)
+            fast["llm_stream"] = self._single_chunk(fast.pop("llm_summary"))
+            return fast
+        semantic_key = await self._semantic_key_async(symptoms, user_text)
+        hit = self._semantic_lookup(semantic_key)
+        if hit is not None:
+            return {"rule_matches": rule_matches, "retrieved": hit[0], "llm_stream": self._single_chunk(hit[1]),
+                    "llm_cache": "semantic", "path": "full"}
+        rule_matches, retrieved, prompt, prompt_stats = await self._gather_async(symptoms, user_text, rule_matches)
+        key = prompt_key(prompt, MODEL_NAME)
+        cached, tier = await self._cache_lookup_async(key)
+        if cached is not None:
+            self._semantic_put(semantic_key, retrieved, cached)
+            stream, cache_status = self._single_chunk(cached), tier
+        else:
+            stream = self._llm_stream_async(key, prompt, lambda text: self._semantic_put(
+                semantic_key, retrieved, text))
+            cache_status = "miss"
+        return {
+            "rule_matches": rule_matches,
+            "retrieved": retrieved,
+            "llm_stream": stream,
+            "llm_cache": cache_status,
+            "path": "full",
+            "prompt": prompt_stats
+        }
+
+    @staticmethod
+    async def _single_chunk(text: str) -> AsyncIterator[str]:
+        yield text
+
+    async def _llm_stream_async(self, key: str, prompt: str, on_done=None) -> AsyncIterator[str]:
+        _, llm_sem = self._semaphores()
+        parts, waited = [], 0.0
+        async with llm_sem:
+            chunks = stream_with_llm_async(prompt).__aiter__()
+            try:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), LLM_TIMEOUT)
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        LLM_ERRORS.inc(kind="timeout")
+                        raise StageTimeout("llm", LLM_TIMEOUT)
+                    except Exception:
+                        LLM_ERRORS.inc(kind="error")
+                        raise
+                    finally:
+                        waited += time.perf_counter() - start
+                    parts.append(chunk)
+                    yield chunk
+            finally:
+                record_stage("llm", waited)  # upstream waits only, as in _caching_stream()
+        text = "".join(parts)
+        if not text:
+            return
+        await self._cache_put_async(key, text)
+        if on_done is not None:
+            on_done(text)
+
+    async def _semantic_key_async(self, symptoms: Dict[str,bool], user_text: str):
+        """_semantic_key() on the retrieval executor, under the retrieval limits."""
+        if self.semantic_cache is None or not user_text or not user_text.strip():
+            return None
+        retrieval_sem, _ = self._semaphores()
+        loop = asyncio.get_running_loop()
+        return await self._run_stage(
+            "retrieval", retrieval_sem, RETRIEVAL_TIMEOUT,
+            lambda: loop.run_in_executor(self.executor, contextvars.copy_context().run,
+                                         self._semantic_key, symptoms, user_text),
+        )
+
+    async def _gather_async(self, symptoms: Dict[str,bool], user_text: str, rule_matches: List[dict] = None):
+        retrieval = asyncio.ensure_future(self.retrieve_symptoms_async(symptoms, user_text, top_k=5))
+        if rule_matches is None:
+            rule_matches = self._rule_matches(symptoms)
+        retrieved = await retrieval
+        context_texts = [p["text"] for _, p in retrieved]
+
+        # sentence embeddings for the context budget run on the retrieval executor, under its limits
+        retrieval_sem, _ = self._semaphores()
+        loop = asyncio.get_running_loop()
+        prompt, prompt_stats = await self._run_stage(
+            "retrieval", retrieval_sem, RETRIEVAL_TIMEOUT,
+            lambda: loop.run_in_executor(self.executor, contextvars.copy_context().run,
+                                         self._build_prompt, symptoms, rule_matches, context_texts, user_text),
+        )
+        return rule_matches, retrieved, prompt, prompt_stats
+
+    async def _cached_llm_async(self, prompt: str):
+        key = prompt_key(prompt, MODEL_NAME)
+        cached, tier = await self._cache_lookup_async(key)
+        if cached is not None:
+            return cached, tier
+        _, llm_sem = self._semaphores()
+        with timed("llm"):
+            try:
+                resp = await self._run_stage("llm", llm_sem, LLM_TIMEOUT, lambda: generate_with_llm_async(prompt))
+            except StageTimeout:
+                LLM_ERRORS.inc(kind="timeout")
+                raise
+            except Exception:
+                LLM_ERRORS.inc(kind="error")
+                raise
+        await self._cache_put_async(key, resp)
+        return resp, "miss"
+
     def _build_prompt(self, symptoms, rules, contexts, user_text):
-        # Construct a careful, limited prompt
-        s_list = [k for k,v in symptoms.items() if v]
-        prompt = []
-        prompt.append("User symptoms (boolean):")
-        prompt.append(str(symptoms))
-        prompt.append("\nRule-based matches (if any):")
-        prompt.append("\n".join([f"- {r['name']}: {r['explanation']}" for r in rules]) or "None")
-        prompt.append("\nRetrieved medical knowledge (short snippets):")
-        prompt.extend([f"- {c}" for c in contexts[:5]])
-        prompt.append("\nUser text / question:")
-        prompt.append(user_text or "N/A")
-        prompt.append("\nTask: Using the above, produce a concise, cautious medical reasoning summary with:")
-        prompt.append("- Possible conditions (with confidence level: low/moderate/high)")
-        prompt.append("- Short justification")
-        prompt.append("- Tests to consider")
-        prompt.append("- Urgent flags (if any) - be explicit and conservative")
-        prompt.append("- A clear disclaimer to seek professional medical care and that this is not definitive.")
-        return "\n".join(prompt)
+        """(prompt, stats): a careful, limited prompt within self.prompt_budget tokens."""
+        with timed("prompt_build"):
+            query = symptom_query(symptoms, user_text)
+            # sentences skip the query LRU (and its hit/miss metrics); the query itself is
+            # usually already there from retrieval
+            prompt, stats = build_prompt(symptoms, rules, contexts, user_text, query=query,
+                                         embed=self.rag.embed_passages, embed_query=self.rag.embed_queries,
+                                         budget=self.prompt_budget)
+        PROMPT_TOKENS.observe(stats["tokens"])
+        return prompt, stats
@@ -0,0 +1,159 @@
+"""
+Response cache for LLM summaries.
+
+Keys are a SHA-256 of the model name plus the final prompt, so identical triage
+presentations reuse the earlier answer. Two tiers:
+ - MemoryCache: in-process LRU (microsecond hits)
+ - SQLiteCache: on-disk, shared between processes, with TTL and size-based eviction
+TieredCache checks them in order and promotes lower-tier hits upward.
+Any object with get(key) -> Optional[str] and put(key, value) can be plugged in.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "data/llm_cache.sqlite")
+LLM_CACHE_TTL = 7 * 24 * 3600  # seconds
+LLM_CACHE_MEMORY_ENTRIES = 512
+LLM_CACHE_DISK_ENTRIES = 50_000
+
+
+def prompt_key(prompt: str, model_name: str, max_tokens: int = None) -> str:
+    h = hashlib.sha256()
+    h.update(f"{model_name}\x00{max_tokens}\x00".encode("utf-8"))
+    h.update(prompt.encode("utf-8"))
+    return h.hexdigest()
+
+
+class MemoryCache:
+    name = "memory"
+    blocking = False  # safe to call from an event loop
+
+    def __init__(self, max_entries: int = LLM_CACHE_MEMORY_ENTRIES, ttl: float = LLM_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if self.ttl and time.time() - item[0] > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def put(self, key: str, value: str):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+class SQLiteCache:
+    name = "sqlite"
+    blocking = True  # disk I/O and lock waits: keep off the event loop
+
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl: float = LLM_CACHE_TTL,
+                 max_entries: int = LLM_CACHE_DISK_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5.0)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache(accessed)")
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl and now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE llm_cache SET accessed = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def put(self, key: str, value: str):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            if self.ttl:
+                self._conn.execute("DELETE FROM llm_cache WHERE created < ?", (now - self.ttl,))
+            # size-based eviction: drop least recently used rows beyond max_entries
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                " SELECT key FROM llm_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+
+class TieredCache:
+    def __init__(self, tiers: List):
+        self.tiers = tiers
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key: str) -> Tuple[Optional[str], Optional[str]]:
+        """Returns (value, name of the tier that answered) or (None, None)."""
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                for upper in self.tiers[:i]:
+                    upper.put(key, value)
+                self.hits += 1
+                return value, getattr(tier, "name", type(tier).__name__)
+        self.misses += 1
+        return None, None
+
+    def lookup_nonblocking(self, key: str) -> Tuple[Optional[str], Optional[str]]:
+        """lookup() over the leading in-memory tiers only; a miss here is not counted."""
+        for tier in self.tiers:
+            if getattr(tier, "blocking", True):
+                break
+            value = tier.get(key)
+            if value is not None:
+                self.hits += 1
+                return value, getattr(tier, "name", type(tier).__name__)
+        return None, None
+
+    def has_blocking_tiers(self) -> bool:
+        return any(getattr(tier, "blocking", True) for tier in self.tiers)
+
+    def get(self, key: str) -> Optional[str]:
+        return self.lookup(key)[0]
+
+    def put(self, key: str, value: str):
+        for tier in self.tiers:
+            tier.put(key, value)
+
+
+def default_llm_cache() -> TieredCache:
+    """Memory LRU in front of SQLite; memory only if the cache file can't be opened."""
+    tiers = [MemoryCache()]
+    try:
+        tiers.append(SQLiteCache())
+    except (sqlite3.Error, OSError) as e:
+        print(f"[LLM cache] SQLite tier disabled: {e}")
+    return TieredCache(tiers)
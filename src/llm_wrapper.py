@@ -4,52 +4,105 @@ Supports:
  - google.generativeai (Gemini)
 
 Loads API keys from Streamlit secrets (cloud) or environment variables (local).
+
+One GenerativeModel is reused per process. Calls are bounded (LLM_MAX_CONCURRENCY),
+transient failures (429 / 5xx / timeouts) are retried with jittered exponential
+backoff until LLM_DEADLINE, and concurrent identical prompts share one in-flight
+call. Set GEMINI_API_ENDPOINT to point the client at fake_llm_server.py.
 """
 
+import asyncio
+import logging
 import os
-from typing import Optional
+import queue
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Iterator, Optional, TypeVar
+
+from metrics import LLM_COALESCED, LLM_RETRIES
+
+T = TypeVar("T")
 
-# --- Try Streamlit secrets first ---
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))  # in-flight Gemini calls per process
+LLM_REQUEST_TIMEOUT = 30.0  # seconds, one attempt
+LLM_DEADLINE = 50.0         # seconds, all attempts incl. backoff (below hybrid_engine.LLM_TIMEOUT)
+LLM_MAX_ATTEMPTS = 4
+BACKOFF_BASE = 0.5          # seconds; attempt n sleeps uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**n))
+BACKOFF_CAP = 8.0
+RETRY_STATUS = frozenset({408, 429, 500, 502, 503, 504})
+# gemini-2.5 models spend output tokens on thinking before the answer; the SDK in use has no
+# thinking_config, so those models get this much headroom on top of the requested max_tokens
+LLM_THINKING_TOKENS = int(os.getenv("LLM_THINKING_TOKENS", "1024"))
+# e.g. http://127.0.0.1:8089 (fake_llm_server.py); uses the REST transport
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+
+# Key lookup, the Gemini SDK import and configuration all happen on the first LLM
+# call (see _genai), so rules/RAG-only processes never pay for them.
 GENAI_KEY: Optional[str] = None
-try:
-    import streamlit as st
-    GENAI_KEY = st.secrets.get("GOOGLE_API_KEY")
-    if GENAI_KEY:
-        print(f"[DEBUG] Loaded GOOGLE_API_KEY from Streamlit secrets (ending in ...{GENAI_KEY[-4:]})")
-except Exception as e:
-    print(f"[DEBUG] Could not load from Streamlit secrets: {e}")
-
-# --- Fallback to environment variables (.env locally) ---
-if not GENAI_KEY:
-    print("[DEBUG] Key not in secrets, trying environment variables...")
+GENAI_AVAILABLE: Optional[bool] = None  # None = not probed yet
+genai = None
+_init_lock = threading.Lock()
+log = logging.getLogger(__name__)
+
+
+def _load_key() -> Optional[str]:
+    # --- Try Streamlit secrets first ---
+    key = None
     try:
-        from dotenv import load_dotenv
-        load_dotenv()
-    except Exception:
-        pass
-    GENAI_KEY = os.getenv("GOOGLE_API_KEY")
-    if GENAI_KEY:
-        print(f"[DEBUG] Loaded GOOGLE_API_KEY from environment variables (ending in ...{GENAI_KEY[-4:]})")
+        import streamlit as st
+        key = st.secrets.get("GOOGLE_API_KEY")
+    except Exception as e:
+        log.debug("GOOGLE_API_KEY not read from Streamlit secrets: %s", e)
+
+    # --- Fallback to environment variables (.env locally) ---
+    if not key:
+        try:
+            from dotenv import load_dotenv
+            load_dotenv()
+        except Exception:
+            pass
+        key = os.getenv("GOOGLE_API_KEY")
+        log.debug("GOOGLE_API_KEY %s in environment variables", "found" if key else "not found")
     else:
-        print("[DEBUG] GOOGLE_API_KEY not found in environment variables.")
+        log.debug("GOOGLE_API_KEY loaded from Streamlit secrets")
+    return key
 
 
-# --- Import Gemini ---
-GENAI_AVAILABLE = False
-try:
-    import google.generativeai as genai
-    GENAI_AVAILABLE = True
-except Exception:
-    GENAI_AVAILABLE = False
+def _genai():
+    """Import and configure the Gemini SDK once, on first use."""
+    global GENAI_KEY, GENAI_AVAILABLE, genai
+    if GENAI_AVAILABLE is not None:
+        return genai
+    with _init_lock:
+        if GENAI_AVAILABLE is not None:
+            return genai
+        GENAI_KEY = _load_key()
 
+        # --- Import Gemini ---
+        try:
+            import google.generativeai as sdk
+            available = True
+        except Exception:
+            sdk, available = None, False
 
-# --- Configure Gemini ---
-if GENAI_AVAILABLE and GENAI_KEY:
-    try:
-        genai.configure(api_key=GENAI_KEY)
-    except Exception as e:
-        GENAI_AVAILABLE = False
-        print(f"[Gemini] Configuration error: {e}")
+        # --- Configure Gemini ---
+        if available and GENAI_KEY:
+            try:
+                if GEMINI_API_ENDPOINT:
+                    sdk.configure(api_key=GENAI_KEY, transport="rest",
+                                  client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+                else:
+                    sdk.configure(api_key=GENAI_KEY)
+            except Exception as e:
+                available = False
+                print(f"[Gemini] Configuration error: {e}")
+
+        genai = sdk
+        GENAI_AVAILABLE = available
+    return genai
 
 
 # --- Model ---
@@ -62,10 +115,8 @@ SAFETY_PREFIX = (
 )
 
 
-def generate_with_llm(prompt: str, max_tokens: int = 500) -> str:
-    """
-    Call Gemini with safety prefix.
-    """
+def _full_prompt(prompt: str) -> str:
+    _genai()
     if not GENAI_AVAILABLE:
         raise RuntimeError("Gemini SDK not available.")
 
@@ -75,17 +126,320 @@ def generate_with_llm(prompt: str, max_tokens: int = 500) -> str:
             "Set it in Streamlit Secrets or as an environment variable."
         )
 
-    full_prompt = SAFETY_PREFIX + "\n\n" + prompt
+    return SAFETY_PREFIX + "\n\n" + prompt
+
+
+class EmptyResponseError(RuntimeError):
+    """The model returned no text (output budget spent on thinking, safety block, ...)."""
+
 
+def _is_thinking_model(model_name: str) -> bool:
+    return model_name.startswith("gemini-2.5")
+
+
+def _generation_config(max_tokens: int):
+    # cap generation upstream instead of slicing the text afterwards
+    if _is_thinking_model(MODEL_NAME):
+        max_tokens += LLM_THINKING_TOKENS
+    return genai.GenerationConfig(max_output_tokens=max_tokens)
+
+
+def _response_text(resp) -> str:
     try:
-        model = genai.GenerativeModel(MODEL_NAME)
-        resp = model.generate_content(full_prompt)
+        text = resp.text
+    except (AttributeError, ValueError):  # no text parts (e.g. blocked or empty chunk)
+        text = None
+    return text or ""
 
-        text = getattr(resp, "text", None)
-        if not text:
-            text = str(resp)
 
-        return text[:max_tokens]
+def _finish_reason(resp) -> str:
+    try:
+        reason = resp.candidates[0].finish_reason
+    except (AttributeError, IndexError, TypeError):
+        return "unknown"
+    return getattr(reason, "name", str(reason))
 
-    except Exception as e:
-        raise RuntimeError(f"Gemini error: {e}")
+
+def _require_text(resp) -> str:
+    """The response text; never the raw response, which must not end up as a cached summary."""
+    text = _response_text(resp)
+    if not text:
+        raise EmptyResponseError(f"Gemini returned no text (finish_reason={_finish_reason(resp)})")
+    return text
+
+
+_model = None
+_sync_slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+_async_slots: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+
+def _client():
+    """The process-wide GenerativeModel (channels and auth are set up once)."""
+    global _model
+    if _model is None:
+        with _init_lock:
+            if _model is None:
+                _model = genai.GenerativeModel(MODEL_NAME)
+    return _model
+
+
+def _async_slot() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    sem = _async_slots.get(loop)
+    if sem is None:
+        sem = _async_slots[loop] = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+    return sem
+
+
+def _request_options(timeout: float) -> dict:
+    # retry=None: the SDK would otherwise retry 503s on its own for up to 600s
+    return {"timeout": timeout, "retry": None}
+
+
+def _is_retryable(e: Exception) -> bool:
+    # OSError covers connection resets and socket / requests timeouts
+    return isinstance(e, OSError) or getattr(e, "code", None) in RETRY_STATUS
+
+
+def _retry_delay(e: Exception, attempt: int, started: float) -> Optional[float]:
+    """Seconds to wait before the next attempt, None to give up."""
+    if attempt + 1 >= LLM_MAX_ATTEMPTS or not _is_retryable(e):
+        return None
+    delay = random.uniform(0.0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))  # full jitter
+    if time.monotonic() - started + delay >= LLM_DEADLINE:
+        return None
+    LLM_RETRIES.inc(reason=type(e).__name__)
+    return delay
+
+
+def _with_retries(call: Callable[[float], T]) -> T:
+    """call(timeout) until it succeeds, a non-retryable error, or LLM_DEADLINE."""
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        remaining = LLM_DEADLINE - (time.monotonic() - started)
+        try:
+            return call(max(0.1, min(LLM_REQUEST_TIMEOUT, remaining)))
+        except Exception as e:
+            delay = _retry_delay(e, attempt, started)
+            if delay is None:
+                raise RuntimeError(f"Gemini error: {e}") from e
+        time.sleep(delay)
+        attempt += 1
+
+
+async def _with_retries_async(call: Callable[[float], Awaitable[T]]) -> T:
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        remaining = LLM_DEADLINE - (time.monotonic() - started)
+        try:
+            return await call(max(0.1, min(LLM_REQUEST_TIMEOUT, remaining)))
+        except Exception as e:
+            delay = _retry_delay(e, attempt, started)
+            if delay is None:
+                raise RuntimeError(f"Gemini error: {e}") from e
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one execution and its result (or error)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> Future of the in-flight sync call
+        self._tasks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = weakref.WeakKeyDictionary()
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        with self._lock:
+            fut = self._calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._calls[key] = Future()
+        if not leader:
+            LLM_COALESCED.inc()
+            return fut.result()
+        try:
+            fut.set_result(fn())
+        except BaseException as e:
+            fut.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return fut.result()
+
+    async def do_async(self, key: Hashable, coro_fn: Callable[[], Awaitable[T]]) -> T:
+        loop = asyncio.get_running_loop()
+        tasks = self._tasks.get(loop)
+        if tasks is None:
+            tasks = self._tasks[loop] = {}
+        task = tasks.get(key)
+        if task is None:
+            task = tasks[key] = loop.create_task(coro_fn())
+            task.add_done_callback(lambda t: self._finished(tasks, key, t))
+        else:
+            LLM_COALESCED.inc()
+        # shield: a caller that times out or disconnects doesn't cancel the call for the others
+        return await asyncio.shield(task)
+
+    @staticmethod
+    def _finished(tasks: dict, key: Hashable, task: asyncio.Task):
+        if tasks.get(key) is task:
+            del tasks[key]
+        if not task.cancelled():
+            task.exception()  # retrieved, even if every waiter went away
+
+
+_inflight = SingleFlight()
+
+
+def _generate(full_prompt: str, max_tokens: int, timeout: float) -> str:
+    resp = _client().generate_content(full_prompt, generation_config=_generation_config(max_tokens),
+                                      request_options=_request_options(timeout))
+    return _require_text(resp)
+
+
+async def _generate_async(full_prompt: str, max_tokens: int, timeout: float) -> str:
+    if GEMINI_API_ENDPOINT:
+        # the SDK's async client does not work over REST; keep the loop free with a thread
+        return await asyncio.to_thread(_generate, full_prompt, max_tokens, timeout)
+    resp = await _client().generate_content_async(full_prompt, generation_config=_generation_config(max_tokens),
+                                                  request_options=_request_options(timeout))
+    return _require_text(resp)
+
+
+def generate_with_llm(prompt: str, max_tokens: int = 500) -> str:
+    """
+    Call Gemini with safety prefix. max_tokens limits the answer (thinking models get
+    LLM_THINKING_TOKENS more). Raises RuntimeError, also when no text comes back.
+    """
+    full_prompt = _full_prompt(prompt)
+
+    def call() -> str:
+        with _sync_slots:
+            return _with_retries(lambda timeout: _generate(full_prompt, max_tokens, timeout))
+
+    return _inflight.do((MODEL_NAME, max_tokens, full_prompt), call)
+
+
+async def generate_with_llm_async(prompt: str, max_tokens: int = 500) -> str:
+    """
+    Same as generate_with_llm, through the SDK's async client so the event loop
+    is never blocked while waiting on Gemini.
+    """
+    full_prompt = _full_prompt(prompt)
+
+    async def call() -> str:
+        async with _async_slot():
+            return await _with_retries_async(lambda timeout: _generate_async(full_prompt, max_tokens, timeout))
+
+    return await _inflight.do_async((MODEL_NAME, max_tokens, full_prompt), call)
+
+
+def _open_stream(full_prompt: str, max_tokens: int, timeout: float):
+    """Start a streamed call and read its first chunk, so failures before any text can be retried."""
+    chunks = iter(_client().generate_content(full_prompt, generation_config=_generation_config(max_tokens),
+                                             stream=True, request_options=_request_options(timeout)))
+    return next(chunks, None), chunks
+
+
+def _pump_stream(full_prompt: str, max_tokens: int, out: "queue.Queue", stop: threading.Event):
+    """Open and drain one upstream stream under a sync slot, handing chunks over through out."""
+    with _sync_slots:
+        try:
+            first, chunks = _with_retries(lambda timeout: _open_stream(full_prompt, max_tokens, timeout))
+        except Exception as e:
+            out.put(("error", e))
+            return
+        try:
+            while first is not None and not stop.is_set():
+                out.put(("chunk", first))
+                first = next(chunks, None)
+            out.put(("end", None))
+        except Exception as e:
+            out.put(("error", RuntimeError(f"Gemini error: {e}")))
+        finally:
+            if stop.is_set() and hasattr(chunks, "close"):
+                chunks.close()
+
+
+def stream_with_llm(prompt: str, max_tokens: int = 500) -> Iterator[str]:
+    """
+    Yield text chunks as Gemini produces them.
+    Retried only until the first chunk; streams are not coalesced.
+    The concurrency slot is held by a pump thread while Gemini's stream is open,
+    so a slow or abandoned consumer doesn't keep it.
+    """
+    full_prompt = _full_prompt(prompt)
+    chunks, stop = queue.Queue(), threading.Event()
+    threading.Thread(target=_pump_stream, args=(full_prompt, max_tokens, chunks, stop),
+                     name="llm-stream", daemon=True).start()
+    emitted, last = False, None
+    try:
+        while True:
+            kind, value = chunks.get()
+            if kind == "error":
+                raise value
+            if kind == "end":
+                break
+            last = value
+            text = _response_text(value)
+            if text:
+                emitted = True
+                yield text
+    finally:
+        stop.set()  # also on GeneratorExit: the pump stops reading and frees the slot
+    if not emitted:
+        raise EmptyResponseError(f"Gemini returned no text (finish_reason={_finish_reason(last)})")
+
+
+async def _open_stream_async(full_prompt: str, max_tokens: int, timeout: float):
+    if GEMINI_API_ENDPOINT:
+        first, chunks = await asyncio.to_thread(_open_stream, full_prompt, max_tokens, timeout)
+
+        async def rest():
+            while True:
+                chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+
+        return first, rest()
+    resp = await _client().generate_content_async(full_prompt, generation_config=_generation_config(max_tokens),
+                                                  stream=True, request_options=_request_options(timeout))
+    chunks = resp.__aiter__()
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = None
+    return first, chunks
+
+
+async def stream_with_llm_async(prompt: str, max_tokens: int = 500) -> AsyncIterator[str]:
+    """
+    Async version of stream_with_llm.
+    """
+    full_prompt = _full_prompt(prompt)
+
+    async with _async_slot():
+        first, chunks = await _with_retries_async(
+            lambda timeout: _open_stream_async(full_prompt, max_tokens, timeout))
+        emitted, last = False, first
+        try:
+            if first is not None:
+                text = _response_text(first)
+                if text:
+                    emitted = True
+                    yield text
+                async for chunk in chunks:
+                    last = chunk
+                    text = _response_text(chunk)
+                    if text:
+                        emitted = True
+                        yield text
+
+        except Exception as e:
+            raise RuntimeError(f"Gemini error: {e}")
+        if not emitted:
+            raise EmptyResponseError(f"Gemini returned no text (finish_reason={_finish_reason(last)})")
@@ -0,0 +1,184 @@
+"""
+Lightweight, dependency-free instrumentation for the diagnosis pipeline.
+
+ - Counter / Histogram with labels, rendered in the Prometheus text format
+   (exposition 0.0.4) by render(); api.py serves it on /metrics.
+ - timed(stage): context manager that records a stage duration into
+   STAGE_SECONDS and, inside collect_timings(), into a per-request dict
+   (record_stage() does the same for a duration measured by hand).
+
+An observation is a perf_counter() pair, a lock and a bisect (a few µs), so
+the rules-only path stays effectively free.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# seconds: sub-ms rules/cache lookups up to slow LLM calls
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry: List["_Metric"] = []
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("stage_timings", default=None)
+
+
+def _label_str(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> Iterator[str]:
+        yield from super().render()
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, v in items:
+            yield f"{self.name}{_label_str(self.labelnames, key)} {v}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], list] = {}  # key -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, **labels):
+        self.observe_key(self._key(labels), value)
+
+    def observe_key(self, key: Tuple[str, ...], value: float):
+        """observe() with the label values already in labelnames order (hot paths)."""
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def render(self) -> Iterator[str]:
+        yield from super().render()
+        with self._lock:
+            items = sorted((k, list(s)) for k, s in self._series.items())
+        for key, series in items:
+            cumulative = 0
+            for le, n in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += n
+                bound = "+Inf" if le == float("inf") else repr(le)
+                labels = _label_str(self.labelnames, key, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{_label_str(self.labelnames, key)} {series[-1]}"
+            yield f"{self.name}_count{_label_str(self.labelnames, key)} {cumulative}"
+
+
+REQUESTS = Counter("diagnosis_requests_total", "Diagnosis API requests.", ("mode", "status"))
+REQUEST_SECONDS = Histogram("diagnosis_request_seconds", "End-to-end request latency.", ("mode",))
+STAGE_SECONDS = Histogram("diagnosis_stage_seconds", "Latency of one pipeline stage.", ("stage",))
+CACHE_LOOKUPS = Counter("diagnosis_cache_lookups_total", "Cache lookups by cache and outcome.",
+                        ("cache", "result"))
+LLM_ERRORS = Counter("diagnosis_llm_errors_total", "Failed LLM calls.", ("kind",))
+LLM_RETRIES = Counter("diagnosis_llm_retries_total", "LLM attempts retried after a transient error.", ("reason",))
+HYBRID_PATHS = Counter("diagnosis_hybrid_paths_total", "Hybrid requests by path (fast rule summary / full).",
+                       ("path",))
+LLM_COALESCED = Counter("diagnosis_llm_coalesced_total", "LLM calls that joined an identical in-flight call.")
+PROMPT_TOKENS = Histogram("diagnosis_prompt_tokens", "Estimated LLM prompt size after context budgeting.",
+                          buckets=(64, 128, 256, 512, 768, 1024, 1536, 2048, 4096, 8192))
+
+
+class timed:
+    """with timed("rules"): ... -- a plain class, @contextmanager costs several times more per use."""
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_stage(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def merge_timings(timings: Dict[str, float]):
+    """
+    Add stage durations measured in another context (e.g. a batch answered on a worker
+    thread) to this request's timings; STAGE_SECONDS already has them.
+    """
+    current = _timings.get()
+    if current is not None:
+        for stage, elapsed in timings.items():
+            current[stage] = current.get(stage, 0.0) + elapsed
+
+
+def record_stage(stage: str, elapsed: float):
+    """What timed() records, for durations summed by hand (e.g. only the upstream waits of a stream)."""
+    STAGE_SECONDS.observe_key((stage,), elapsed)
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+@contextmanager
+def collect_timings(timings: Dict[str, float] = None):
+    """Stage timings recorded by timed() in this context (and tasks/threads it copies) land in the dict."""
+    timings = {} if timings is None else timings
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def timings_ms(timings: Dict[str, float]) -> Dict[str, float]:
+    return {stage: round(seconds * 1000.0, 3) for stage, seconds in timings.items()}
+
+
+def render() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
@@ -0,0 +1,206 @@
+"""
+Pickle-free passage storage for the RAG index.
+
+Passage text lives in one contiguous UTF-8 file (passages.bin) with an int64
+offsets array; ids live in a NumPy array. All three are opened memory-mapped,
+so N API workers share one page-cached copy and opening the store costs the
+same regardless of corpus size.
+
+PassageStore.from_texts() builds the same layout in memory for freshly built
+indexes, so RAGIndex.passages is columnar either way.
+
+Run `python passage_store.py migrate data/rag_index` once to convert an
+index directory that still has a legacy passages.pkl.
+"""
+
+import hashlib
+import os
+import sys
+import numpy as np
+from typing import Iterable, List, Sequence
+
+TEXT_FILE = "passages.bin"
+OFFSETS_FILE = "passages_offsets.npy"
+IDS_FILE = "passages_ids.npy"
+LEGACY_PICKLE = "passages.pkl"
+# written under these names first, then renamed over the live files (which may be mapped)
+_TMP_NAMES = {TEXT_FILE: TEXT_FILE + ".tmp", OFFSETS_FILE: OFFSETS_FILE + ".tmp.npy", IDS_FILE: IDS_FILE + ".tmp.npy"}
+
+
+def _ids_array(ids: Sequence) -> np.ndarray:
+    """int64 when every id is an integer, otherwise fixed-width unicode."""
+    if all(isinstance(i, (int, np.integer)) and not isinstance(i, bool) for i in ids):
+        return np.asarray(ids, dtype=np.int64)
+    return np.asarray([str(i) for i in ids], dtype=str)
+
+
+def save_npy(path: str, array: np.ndarray):
+    """
+    np.save() through a temp file and a rename. The target may be memory-mapped by this
+    process (writing it in place would truncate the mapping) and readers never see half a file.
+    """
+    tmp = path + ".tmp.npy"
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+
+def _tmp_path(path_dir: str, name: str) -> str:
+    return os.path.join(path_dir, _TMP_NAMES[name])
+
+
+def _replace_store(path_dir: str):
+    """Rename the three temp files over the store: mappings of the old files stay valid."""
+    for name in (TEXT_FILE, OFFSETS_FILE, IDS_FILE):
+        os.replace(_tmp_path(path_dir, name), os.path.join(path_dir, name))
+
+
+class PassageStoreWriter:
+    """
+    Appends passages chunk by chunk to temp files; close() writes the offsets and ids arrays
+    and renames all three into place. A failed write (exception inside `with`) leaves an
+    existing store untouched.
+    """
+
+    def __init__(self, path_dir: str):
+        os.makedirs(path_dir, exist_ok=True)
+        self.path_dir = path_dir
+        self._text = open(_tmp_path(path_dir, TEXT_FILE), "wb")
+        self._offsets = [0]
+        self._ids = []
+
+    def append(self, ids: Sequence, texts: Iterable[str]):
+        for pid, text in zip(ids, texts):
+            data = str(text).encode("utf-8")
+            self._text.write(data)
+            self._offsets.append(self._offsets[-1] + len(data))
+            self._ids.append(pid)
+
+    def close(self):
+        self._text.close()
+        np.save(_tmp_path(self.path_dir, OFFSETS_FILE), np.asarray(self._offsets, dtype=np.int64))
+        np.save(_tmp_path(self.path_dir, IDS_FILE), _ids_array(self._ids))
+        _replace_store(self.path_dir)
+
+    def abort(self):
+        self._text.close()
+        for name in _TMP_NAMES:
+            try:
+                os.remove(_tmp_path(self.path_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class PassageStore:
+    """
+    Read-only passage table. Indexing returns the same {"id", "text"} dicts the
+    rest of the code expects, decoded on demand from the mapped buffer.
+    """
+
+    def __init__(self, text: np.ndarray, offsets: np.ndarray, ids: np.ndarray):
+        self._text = text
+        self._offsets = offsets
+        self._ids = ids
+
+    @classmethod
+    def open(cls, path_dir: str, mmap: bool = True) -> "PassageStore":
+        text_path = os.path.join(path_dir, TEXT_FILE)
+        if not os.path.exists(text_path):
+            if os.path.exists(os.path.join(path_dir, LEGACY_PICKLE)):
+                raise FileNotFoundError(
+                    f"{path_dir} only has a legacy {LEGACY_PICKLE}; "
+                    f"run `python passage_store.py migrate {path_dir}` or rebuild the index."
+                )
+            raise FileNotFoundError(f"Missing passage store: {text_path}")
+        mode = "r" if mmap else None
+        offsets = np.load(os.path.join(path_dir, OFFSETS_FILE), mmap_mode=mode)
+        ids = np.load(os.path.join(path_dir, IDS_FILE), mmap_mode=mode)
+        if offsets[-1] == 0:  # np.memmap refuses empty files
+            text = np.zeros(0, dtype=np.uint8)
+        elif mmap:
+            text = np.memmap(text_path, dtype=np.uint8, mode="r")
+        else:
+            text = np.fromfile(text_path, dtype=np.uint8)
+        return cls(text, offsets, ids)
+
+    @classmethod
+    def from_texts(cls, ids: Sequence, texts: Iterable[str]) -> "PassageStore":
+        """In-memory store (one bytes buffer + offsets + ids) instead of a list of dicts."""
+        encoded = [str(t).encode("utf-8") for t in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        text = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(text, offsets, _ids_array(list(ids)))
+
+    @staticmethod
+    def write(path_dir: str, passages: Iterable[dict]):
+        if isinstance(passages, PassageStore):
+            passages.save(path_dir)
+            return
+        passages = list(passages)
+        with PassageStoreWriter(path_dir) as w:
+            w.append([p["id"] for p in passages], [p["text"] for p in passages])
+
+    def save(self, path_dir: str):
+        """Write the buffers as they are (no per-passage decoding)."""
+        os.makedirs(path_dir, exist_ok=True)
+        # all three go to temp files first: this store may map the files being replaced
+        # (saving over them in place would truncate them under the mapping)
+        with open(_tmp_path(path_dir, TEXT_FILE), "wb") as f:
+            f.write(np.ascontiguousarray(self._text).tobytes())
+        np.save(_tmp_path(path_dir, OFFSETS_FILE), np.asarray(self._offsets, dtype=np.int64))
+        np.save(_tmp_path(path_dir, IDS_FILE), np.asarray(self._ids))
+        _replace_store(path_dir)
+
+    def text(self, i: int) -> str:
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return self._text[start:end].tobytes().decode("utf-8")
+
+    def id(self, i: int):
+        return self._ids[i].item()
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> dict:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return {"id": self.id(i), "text": self.text(i)}
+
+    def checksum(self) -> str:
+        """SHA-1 of the ids and offsets arrays (cheap: text bytes are not read)."""
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(self._offsets).tobytes())
+        h.update(np.ascontiguousarray(self._ids).tobytes())
+        return h.hexdigest()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def migrate(path_dir: str):
+    """One-off conversion of a legacy passages.pkl directory to the mapped store."""
+    import pickle
+    with open(os.path.join(path_dir, LEGACY_PICKLE), "rb") as f:
+        passages: List[dict] = pickle.load(f)
+    PassageStore.write(path_dir, passages)
+    os.remove(os.path.join(path_dir, LEGACY_PICKLE))
+    print(f"Migrated {len(passages)} passages → {path_dir}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "migrate":
+        print("usage: python passage_store.py migrate <index_dir>")
+        sys.exit(1)
+    migrate(sys.argv[2])
@@ -0,0 +1,166 @@
+"""
+Context budgeting for the hybrid LLM prompt.
+
+Input tokens (and so LLM latency and cost) used to grow with passage length:
+every false symptom flag, all rule matches and five full passages went in as is.
+build_prompt() instead
+ - lists only the symptoms that are present,
+ - drops duplicate passages and sentences,
+ - keeps the CONTEXT_SENTENCES sentences of each passage most similar to the query
+   (cosine over the RAG embedder's vectors; word overlap without an embedder),
+ - fills PROMPT_TOKEN_BUDGET with the best sentences first, using a fast local
+   token estimate (no tokenizer download, a regex pass per string),
+and returns size stats next to the prompt.
+"""
+
+import os
+import re
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from bm25 import tokenize
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1200"))  # whole prompt, estimated tokens
+CONTEXT_PASSAGES = 5       # retrieved passages considered
+CONTEXT_SENTENCES = 3      # sentences kept per passage
+USER_TEXT_TOKENS = 300     # longer free text is cut to this many tokens
+
+_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_RE = re.compile(r"(?<=[.!?;])\s+|\n+")
+
+TASK_LINES = [
+    "\nTask: Using the above, produce a concise, cautious medical reasoning summary with:",
+    "- Possible conditions (with confidence level: low/moderate/high)",
+    "- Short justification",
+    "- Tests to consider",
+    "- Urgent flags (if any) - be explicit and conservative",
+    "- A clear disclaimer to seek professional medical care and that this is not definitive.",
+]
+
+
+def estimate_tokens(text: str) -> int:
+    """BPE-like estimate: one token per word / punctuation mark, plus one per 8 extra characters."""
+    return sum(1 + (len(p) - 1) // 8 for p in _PIECE_RE.findall(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    used = 0
+    for m in _PIECE_RE.finditer(text):
+        used += 1 + (len(m.group()) - 1) // 8
+        if used > max_tokens:
+            return text[:m.start()].rstrip() + " ..."
+    return text
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in _SENTENCE_RE.split(text) if s.strip()]
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def select_sentences(query: str, contexts: Sequence[str], embed: Optional[Callable] = None,
+                     per_passage: int = CONTEXT_SENTENCES,
+                     embed_query: Optional[Callable] = None) -> Tuple[List[List[Tuple[float, str]]], int, int]:
+    """
+    Per unique passage (retrieval order), its best per_passage sentences as (score, sentence)
+    in their original order; also the number of duplicate passages / sentences dropped and
+    of unique sentences seen.
+    embed(list of texts) -> normalized vectors for the sentences; embed_query (default: embed)
+    for the query, e.g. RAGIndex.embed_queries, whose LRU already holds it from retrieval.
+    """
+    seen_passages, seen_sentences = set(), set()
+    passages: List[List[str]] = []
+    duplicates = 0
+    for text in contexts:
+        key = _normalize(text)
+        if key in seen_passages:
+            duplicates += 1
+            continue
+        seen_passages.add(key)
+        sentences = []
+        for s in split_sentences(text):
+            skey = _normalize(s)
+            if skey in seen_sentences:
+                duplicates += 1
+                continue
+            seen_sentences.add(skey)
+            sentences.append(s)
+        if sentences:
+            passages.append(sentences)
+
+    flat = [s for sentences in passages for s in sentences]
+    if not flat:
+        return [], duplicates, 0
+    if embed is not None:
+        q = (embed_query or embed)([query])[0]
+        scores = (embed(flat) @ q).tolist()
+    else:
+        q = set(tokenize(query))
+        scores = [len(q.intersection(tokenize(s))) / (1 + len(q)) for s in flat]
+
+    out, start = [], 0
+    for sentences in passages:
+        scored = list(zip(scores[start:start + len(sentences)], range(len(sentences))))
+        start += len(sentences)
+        keep = sorted(i for _, i in sorted(scored, key=lambda t: -t[0])[:per_passage])
+        out.append([(scored[i][0], sentences[i]) for i in keep])
+    return out, duplicates, len(flat)
+
+
+def build_prompt(symptoms: Dict[str, bool], rules: List[dict], contexts: Sequence[str], user_text: str = "",
+                 query: str = "", embed: Optional[Callable] = None, budget: int = PROMPT_TOKEN_BUDGET,
+                 per_passage: int = CONTEXT_SENTENCES, embed_query: Optional[Callable] = None) -> Tuple[str, dict]:
+    """(prompt, stats). query: the retrieval query (user text or the joined symptoms)."""
+    present = [k for k, v in symptoms.items() if v]
+    user = truncate_tokens(user_text.strip(), USER_TEXT_TOKENS) if user_text and user_text.strip() else "N/A"
+    head = ["User symptoms (present):", ", ".join(present) or "None reported", "\nRule-based matches (if any):"]
+    tail = ["\nUser text / question:", user] + TASK_LINES
+
+    # rules are kept before context; emergency matches first so they survive a tight budget
+    fixed = estimate_tokens("\n".join(head + tail)) + 8  # + the context heading
+    rule_lines, rules_dropped = [], 0
+    for r in sorted(rules, key=lambda r: not r.get("emergency")):
+        line = f"- {r['name']}: {r['explanation']}"
+        cost = estimate_tokens(line)
+        if fixed + cost > budget and rule_lines:
+            rules_dropped += 1
+            continue
+        rule_lines.append(line)
+        fixed += cost
+
+    contexts = list(contexts)[:CONTEXT_PASSAGES]
+    passages, duplicates, n_sentences = select_sentences(query or user_text or ", ".join(present),
+                                                         contexts, embed, per_passage, embed_query)
+    # fill the remaining budget with the best sentences overall, then print them in passage order
+    ranked = sorted(((score, p, j) for p, sentences in enumerate(passages) for j, (score, _) in enumerate(sentences)),
+                    key=lambda t: -t[0])
+    remaining = budget - fixed
+    chosen = set()
+    for _, p, j in ranked:
+        cost = estimate_tokens(passages[p][j][1]) + 2  # "- " / joining space
+        if cost <= remaining:
+            chosen.add((p, j))
+            remaining -= cost
+    context_lines = []
+    for p, sentences in enumerate(passages):
+        kept = [s for j, (_, s) in enumerate(sentences) if (p, j) in chosen]
+        if kept:
+            context_lines.append("- " + " ".join(kept))
+
+    prompt = "\n".join(head + (rule_lines or ["None"]) + ["\nRetrieved medical knowledge (short snippets):"]
+                       + context_lines + tail)
+    stats = {
+        "tokens": estimate_tokens(prompt),
+        "budget": budget,
+        "chars": len(prompt),
+        "context_tokens_in": sum(estimate_tokens(c) for c in contexts),
+        "context_tokens": sum(estimate_tokens(line) for line in context_lines),
+        "passages": len(contexts),
+        "passages_used": len(context_lines),
+        "sentences": n_sentences,
+        "sentences_used": len(chosen),
+        "duplicates_removed": duplicates,
+        "rules_dropped": rules_dropped,
+    }
+    return prompt, stats
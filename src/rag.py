@@ -3,57 +3,521 @@ RAG module: build index from knowledge passages, query for relevant context.
 Uses sentence-transformers for embeddings and FAISS for vector index.
 """
 
-from sentence_transformers import SentenceTransformer
 import faiss
 import numpy as np
-import pandas as pd
 import os
-import pickle
-from typing import List, Tuple
+import json
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, List, Tuple
+from passage_store import PassageStore, save_npy
+from bm25 import BM25Index
+from metrics import CACHE_LOOKUPS, collect_timings, merge_timings, timed
+import embedders
+from embedders import make_embedder
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 EMBED_MODEL_NAME = "all-MiniLM-L6-v2"  # small, faast. Swap for higher quality if needed.
+QUERY_CACHE_SIZE = 2048  # normalized query text -> embedding
+# map index data instead of copying it into RAM (IO_FLAG_MMAP_IFC covers flat codes on faiss >= 1.8)
+MMAP_FLAGS = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+TRAIN_SAMPLE_SIZE = 100_000  # vectors used to train IVF/PQ quantizers
+MIN_POINTS_PER_CENTROID = 39  # below this faiss k-means training is unreliable
+LABELS_FILE = "passages_labels.npy"  # faiss id per passage (aligned with the passage store)
+EMBEDDINGS_FILE = "embeddings.npy"   # normalized passage vectors, reused by incremental builds
+QUERY_MODES = ("dense", "lexical", "fused")
+# "fused" / "lexical" are opt-in: their scores are RRF / BM25 values, not cosine similarities
+QUERY_MODE = os.getenv("RAG_QUERY_MODE", "dense")
+RRF_K = 60           # reciprocal-rank fusion: score = sum 1 / (RRF_K + rank)
+FUSION_DEPTH = 50    # candidates taken from each ranking before fusing
+
+
+def _text_label(key: str) -> int:
+    digest = hashlib.sha1(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little") & 0x7FFF_FFFF_FFFF_FFFF
+
+
+def content_labels(texts: List[str], seen: dict = None) -> np.ndarray:
+    """
+    Stable 63-bit faiss ids derived from a SHA-1 of each passage text.
+    Repeated texts get an occurrence suffix so labels stay unique; pass the same
+    `seen` dict across calls when labelling a corpus chunk by chunk.
+    """
+    seen = {} if seen is None else seen
+    labels = np.empty(len(texts), dtype=np.int64)
+    for i, text in enumerate(texts):
+        label = _text_label(text)
+        n = seen.get(label, 0)
+        seen[label] = n + 1
+        labels[i] = label if n == 0 else _text_label(f"{text}\x00{n}")
+    return labels
+
+
+class LabelSet:
+    """
+    Set of int64 labels kept as a few sorted NumPy arrays (8 bytes per label instead of
+    a dict entry), merged like an LSM tree so adding a chunk stays cheap.
+    """
+
+    def __init__(self):
+        self.levels: List[np.ndarray] = []
+
+    def contains(self, labels: np.ndarray) -> np.ndarray:
+        found = np.zeros(len(labels), dtype=bool)
+        for level in self.levels:
+            pos = np.minimum(np.searchsorted(level, labels), len(level) - 1)
+            found |= level[pos] == labels
+        return found
+
+    def add(self, labels: np.ndarray):
+        run = np.unique(labels)
+        while self.levels and len(self.levels[-1]) <= len(run):
+            run = np.union1d(self.levels.pop(), run)
+        self.levels.append(run)
+
+
+def stream_labels(texts: List[str], seen: LabelSet) -> np.ndarray:
+    """
+    content_labels() for one chunk of a corpus labelled chunk by chunk: the n-th repeat of
+    a text gets the same occurrence suffix, found by probing seen instead of counting.
+    """
+    labels = np.array([_text_label(t) for t in texts], dtype=np.int64)
+    repeated = seen.contains(labels) if len(labels) else np.zeros(0, dtype=bool)
+    chunk = set()
+    for i, text in enumerate(texts):
+        label, n = int(labels[i]), 0
+        if repeated[i] or label in chunk:
+            while label in chunk or seen.contains(np.array([label], dtype=np.int64))[0]:
+                n += 1
+                label = _text_label(f"{text}\x00{n}")
+            labels[i] = label
+        chunk.add(label)
+    seen.add(labels)
+    return labels
+
+
+def encode_normalized(embedder, texts: List[str], show_progress_bar: bool = False) -> np.ndarray:
+    """Normalized float32 embeddings (cosine similarity == inner product)."""
+    embeddings = embedder.encode(texts, show_progress_bar=show_progress_bar, convert_to_numpy=True)
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    # Normalize embeddiings for cosine similarity
+    faiss.normalize_L2(embeddings)
+    return embeddings
+
+
+def default_nlist(n_vectors: int) -> int:
+    """~4*sqrt(n) inverted lists, capped so every centroid gets enough training points."""
+    nlist = int(4 * np.sqrt(max(n_vectors, 1)))
+    return max(1, min(nlist, n_vectors // MIN_POINTS_PER_CENTROID))
+
+
+def make_faiss_index(index_type: str, dim: int, n_vectors: int, nlist: int = None,
+                     pq_m: int = 16, pq_bits: int = 8, hnsw_m: int = 32):
+    """
+    Build an (untrained) inner-product index. Vectors are L2-normalized, so
+    inner product == cosine similarity for every index type.
+      flat      exact brute-force scan
+      ivf_flat  inverted lists over full vectors (tune nprobe)
+      ivf_pq    inverted lists over product-quantized codes, pq_m bytes/vector at 8 bits (tune nprobe)
+      hnsw      graph index, no training (tune ef_search)
+    """
+    if index_type == "flat":
+        return faiss.IndexFlatIP(dim)
+    if index_type == "hnsw":
+        return faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+    if index_type in ("ivf_flat", "ivf_pq"):
+        nlist = nlist or default_nlist(n_vectors)
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf_flat":
+            return faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        if dim % pq_m != 0:
+            raise ValueError(f"pq_m={pq_m} must divide embedding dim {dim}")
+        if n_vectors < 2 ** pq_bits:
+            raise ValueError(f"ivf_pq needs at least {2 ** pq_bits} vectors to train, got {n_vectors}; use 'flat'")
+        return faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, pq_bits, faiss.METRIC_INNER_PRODUCT)
+    raise ValueError(f"Unknown index type: {index_type} (expected one of {INDEX_TYPES})")
+
+
+def rrf_fuse(rankings: List[np.ndarray], top_k: int, k: int = RRF_K) -> Tuple[np.ndarray, np.ndarray]:
+    """Reciprocal-rank fusion of position lists (best first, -1 = empty). Returns (scores, positions)."""
+    fused = {}
+    for ranking in rankings:
+        for rank, pos in enumerate(ranking.tolist()):
+            if pos >= 0:
+                fused[pos] = fused.get(pos, 0.0) + 1.0 / (k + rank + 1)
+    best = sorted(fused.items(), key=lambda kv: (-kv[1], kv[0]))[:top_k]
+    scores = np.zeros(top_k, dtype=np.float32)
+    positions = np.full(top_k, -1, dtype=np.int64)
+    for i, (pos, score) in enumerate(best):
+        scores[i], positions[i] = score, pos
+    return scores, positions
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(str(text).lower().split())
+
+
+class EmbeddingCache:
+    """Thread-safe LRU of normalized query text -> normalized embedding."""
+
+    def __init__(self, max_size: int = QUERY_CACHE_SIZE):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        with self._lock:
+            vec = self._data.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def put(self, key: str, vec: np.ndarray):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = vec
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class QueryBatcher:
+    """
+    Collects queries arriving within max_wait_ms of each other and answers them
+    with one encode() call and one multi-row index.search(). The batch's stage timings
+    (embed, faiss_search, ...) are handed back to every waiting request's timings.
+    """
+
+    def __init__(self, rag: "RAGIndex", max_batch: int = 32, max_wait_ms: float = 3.0):
+        self.rag = rag
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self.batches = 0
+        self.batched_queries = 0
+        self.max_batch_seen = 0
+        self._thread = threading.Thread(target=self._run, name="rag-query-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, query_text: str, top_k: int, mode: str = None) -> List[Tuple[float, dict]]:
+        fut = Future()
+        self._queue.put((query_text, top_k, mode, fut))
+        result, timings = fut.result()
+        merge_timings(timings)  # recorded on the batcher thread, outside this request's context
+        return result
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.batches += 1
+            self.batched_queries += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            try:
+                for mode in {m for _, _, m, _ in batch}:
+                    group = [item for item in batch if item[2] == mode]
+                    top_k = max(k for _, k, _, _ in group)
+                    with collect_timings() as timings:
+                        results = self.rag.query_many([q for q, _, _, _ in group], top_k=top_k, mode=mode)
+                    for (_, k, _, fut), res in zip(group, results):
+                        fut.set_result((res[:k], timings))
+            except Exception as e:
+                for _, _, _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
 
 class RAGIndex:
-    def __init__(self, embed_model_name=EMBED_MODEL_NAME, dim: int = None):
-        self.embedder = SentenceTransformer(embed_model_name)
+    def __init__(self, embed_model_name=EMBED_MODEL_NAME, dim: int = None, cache_size: int = QUERY_CACHE_SIZE,
+                 backend: str = None, embedder=None):
+        """
+        backend: "torch" | "onnx" | "onnx-int8" (default: EMBED_BACKEND env var, else torch)
+        embedder: prebuilt object with the SentenceTransformer encode API (skips model loading)
+        """
+        self.embedder = embedder if embedder is not None else make_embedder(embed_model_name, backend)
+        self.embed_model_name = embed_model_name
+        self.embed_backend = backend or ("custom" if embedder is not None else embedders.EMBED_BACKEND)
         self.index = None
-        self.passages = []  # store passages metadata
+        self.passages = []  # passage table: {"id", "text"} per position (a PassageStore once built/loaded)
         self.dim = dim or self.embedder.get_sentence_embedding_dimension()
+        self.query_cache = EmbeddingCache(cache_size)
+        self.batcher = None
+        self.index_type = "flat"
+        self.search_params = {}  # nprobe (IVF) / ef_search (HNSW)
+        self.labels = None       # faiss id per passage; None = ids are passage positions
+        self._label_lookup = None
+        self.bm25 = None         # lexical index over the same passage positions (bm25.py)
+        self.query_mode = QUERY_MODE
+
+    def enable_batching(self, max_batch: int = 32, max_wait_ms: float = 3.0):
+        """Route query() through a micro-batcher (useful when many threads query concurrently)."""
+        if self.batcher is None:
+            self.batcher = QueryBatcher(self, max_batch=max_batch, max_wait_ms=max_wait_ms)
+        return self.batcher
 
-    def build_from_df(self, df: pd.DataFrame, text_col="text", id_col=None):
+    def embed_passages(self, texts: List[str], show_progress_bar: bool = False) -> np.ndarray:
+        return encode_normalized(self.embedder, texts, show_progress_bar=show_progress_bar)
+
+    def build_from_df(self, df: "pd.DataFrame", text_col="text", id_col=None, index_type: str = "flat",
+                      train_size: int = TRAIN_SAMPLE_SIZE, nprobe: int = None, ef_search: int = None,
+                      **index_params) -> np.ndarray:
         """
         df: pandas DataFrame with at least a column containing text snippets
+        index_type: one of INDEX_TYPES; index_params go to make_faiss_index (nlist, pq_m, pq_bits, hnsw_m)
+        Returns the normalized passage embeddings (handy for recall reports).
         """
         texts = df[text_col].astype(str).tolist()
         ids = df[id_col].tolist() if id_col and id_col in df.columns else list(range(len(texts)))
-        embeddings = self.embedder.encode(texts, show_progress_bar=True, convert_to_numpy=True)
+        embeddings = self.embed_passages(texts, show_progress_bar=True)
+        self.build_index(embeddings, content_labels(texts), index_type=index_type, train_size=train_size,
+                         nprobe=nprobe, ef_search=ef_search, **index_params)
+        self.passages = PassageStore.from_texts(ids, texts)
+        self.bm25 = BM25Index.build(texts)
+        return embeddings
+
+    def build_index(self, embeddings: np.ndarray, labels: np.ndarray, index_type: str = "flat",
+                    train_size: int = TRAIN_SAMPLE_SIZE, nprobe: int = None, ef_search: int = None,
+                    **index_params):
+        """
+        (Re)build the faiss index from already-normalized embeddings. Vectors are
+        added under their content labels through an IndexIDMap2, so incremental
+        builds can remove_ids() deleted passages later.
+        """
+        base = make_faiss_index(index_type, self.dim, len(embeddings), **index_params)
+        if not base.is_trained:
+            # train quantizers on a random sample rather than the whole corpus
+            rng = np.random.default_rng(0)
+            n_train = min(train_size, len(embeddings))
+            sample = embeddings[np.sort(rng.choice(len(embeddings), n_train, replace=False))]
+            base.train(sample)
+        self.index = faiss.IndexIDMap2(base)
+        self.index.add_with_ids(embeddings, labels)
+        self.index_type = index_type
+        self.set_labels(labels)
+        self.set_search_params(nprobe=nprobe, ef_search=ef_search)
+
+    def set_labels(self, labels: np.ndarray = None):
+        """Register the faiss id of each passage position; sorted once for vectorized lookups."""
+        self.labels = labels
+        if labels is None:
+            self._label_lookup = None
+            return
+        order = np.argsort(labels, kind="stable")
+        self._label_lookup = (labels[order], order)
+
+    def _positions(self, I: np.ndarray) -> np.ndarray:
+        """Map faiss result ids to passage positions (-1 when unknown)."""
+        if self._label_lookup is None:
+            return I
+        sorted_labels, order = self._label_lookup
+        if len(sorted_labels) == 0:
+            return np.full_like(I, -1)
+        j = np.searchsorted(sorted_labels, I).clip(0, len(sorted_labels) - 1)
+        return np.where(sorted_labels[j] == I, order[j], -1)
 
-        # build faiss index
-        self.index = faiss.IndexFlatIP(self.dim)  # cosine via normalized vecters or inner product after normalize
-        # Normalize embeddiings for cosine similarity
-        faiss.normalize_L2(embeddings)
-        self.index.add(embeddings)
+    def set_search_params(self, nprobe: int = None, ef_search: int = None):
+        """Speed/recall knobs: nprobe for IVF indexes, ef_search for HNSW."""
+        if nprobe is not None:
+            self.search_params["nprobe"] = int(nprobe)
+        if ef_search is not None:
+            self.search_params["ef_search"] = int(ef_search)
+        if self.index is None:
+            return
+        ps = faiss.ParameterSpace()
+        if "nprobe" in self.search_params and self.index_type.startswith("ivf"):
+            ps.set_index_parameter(self.index, "nprobe", self.search_params["nprobe"])
+        if "ef_search" in self.search_params and self.index_type == "hnsw":
+            ps.set_index_parameter(self.index, "efSearch", self.search_params["ef_search"])
 
-        self.passages = [{"id": ids[i], "text": texts[i]} for i in range(len(texts))]
+    def save(self, path_dir="data/rag_index", embeddings: np.ndarray = None):
+        """embeddings: optionally persist the normalized passage vectors for incremental rebuilds."""
+        self.save_index(path_dir)
+        PassageStore.write(path_dir, self.passages)
+        self.save_lexical(path_dir)
+        if embeddings is not None:
+            save_npy(os.path.join(path_dir, EMBEDDINGS_FILE), embeddings)
 
-    def save(self, path_dir="data/rag_index"):
+    def save_index(self, path_dir="data/rag_index"):
+        """Write the faiss index, labels and meta.json (passages are written separately)."""
         os.makedirs(path_dir, exist_ok=True)
-        faiss.write_index(self.index, os.path.join(path_dir, "index.faiss"))
-        with open(os.path.join(path_dir, "passages.pkl"), "wb") as f:
-            pickle.dump(self.passages, f)
-
-    def load(self, path_dir="data/rag_index"):
-        self.index = faiss.read_index(os.path.join(path_dir, "index.faiss"))
-        with open(os.path.join(path_dir, "passages.pkl"), "rb") as f:
-            self.passages = pickle.load(f)
-
-    def query(self, query_text: str, top_k: int = 5) -> List[Tuple[float, dict]]:
-        q_emb = self.embedder.encode([query_text], convert_to_numpy=True)
-        faiss.normalize_L2(q_emb)
-        D, I = self.index.search(q_emb, top_k)  # D = similarities, I = indices
-        results = []
-        for score, idx in zip(D[0].tolist(), I[0].tolist()):
-            if idx < 0 or idx >= len(self.passages):
-                continue
-            results.append((float(score), self.passages[idx]))
-        return results
+        # write-then-rename: a loaded index maps index.faiss (IO_FLAG_MMAP)
+        tmp = os.path.join(path_dir, "index.faiss.tmp")
+        faiss.write_index(self.index, tmp)
+        os.replace(tmp, os.path.join(path_dir, "index.faiss"))
+        if self.labels is not None:
+            save_npy(os.path.join(path_dir, LABELS_FILE), self.labels)
+        with open(os.path.join(path_dir, "meta.json"), "w") as f:
+            json.dump({"index_type": self.index_type, "search_params": self.search_params,
+                       "embed_model": self.embed_model_name, "embed_backend": self.embed_backend}, f, indent=2)
+
+    def save_lexical(self, path_dir="data/rag_index"):
+        """Write the BM25 index, building it from the current passages if needed."""
+        if self.bm25 is None or len(self.bm25) != len(self.passages):
+            self.bm25 = BM25Index.build(p["text"] for p in self.passages)
+        self.bm25.save(path_dir)
+
+    def load(self, path_dir="data/rag_index", mmap: bool = True):
+        """
+        mmap=True maps the index and passage text read-only, so every worker process
+        shares the OS page cache and startup time does not grow with corpus size.
+        """
+        index_path = os.path.join(path_dir, "index.faiss")
+        if mmap:
+            try:
+                self.index = faiss.read_index(index_path, MMAP_FLAGS)
+            except RuntimeError:  # index type without mmap support in this faiss build
+                self.index = faiss.read_index(index_path)
+        else:
+            self.index = faiss.read_index(index_path)
+        self.passages = PassageStore.open(path_dir, mmap=mmap)
+        labels_path = os.path.join(path_dir, LABELS_FILE)
+        # older indexes were built without an id map: results are passage positions
+        self.set_labels(np.load(labels_path) if os.path.exists(labels_path) else None)
+        # indexes built before BM25 support only answer dense queries
+        self.bm25 = BM25Index.load(path_dir, mmap=mmap) if BM25Index.exists(path_dir) else None
+        meta_path = os.path.join(path_dir, "meta.json")
+        if os.path.exists(meta_path):  # indexes built before meta.json are flat
+            with open(meta_path) as f:
+                meta = json.load(f)
+            self.index_type = meta.get("index_type", "flat")
+            self.set_search_params(**meta.get("search_params", {}))
+            built_with = (meta.get("embed_model", self.embed_model_name), meta.get("embed_backend", "torch"))
+            if built_with != (self.embed_model_name, self.embed_backend):
+                # quantized/exported vectors are close to, not identical with, the torch ones
+                print(f"[RAG] Index vectors came from {built_with[0]} ({built_with[1]}); "
+                      f"querying with {self.embed_model_name} ({self.embed_backend})")
+
+    def embed_queries(self, query_texts: List[str]) -> np.ndarray:
+        """
+        Normalized query embeddings, served from the LRU where possible.
+        All cache misses are encoded together in one encode() call.
+        """
+        keys = [normalize_query(q) for q in query_texts]
+        vecs = [self.query_cache.get(k) for k in keys]
+        missing = sorted({k for k, v in zip(keys, vecs) if v is None})
+        hits = len(keys) - sum(v is None for v in vecs)
+        if hits:
+            CACHE_LOOKUPS.inc(hits, cache="embedding", result="hit")
+        if missing:
+            CACHE_LOOKUPS.inc(len(keys) - hits, cache="embedding", result="miss")
+            with timed("embed"):
+                emb = self.embedder.encode(missing, convert_to_numpy=True).astype(np.float32)
+            faiss.normalize_L2(emb)
+            fresh = dict(zip(missing, emb))
+            for k, v in fresh.items():
+                self.query_cache.put(k, v)
+            vecs = [fresh[k] if v is None else v for k, v in zip(keys, vecs)]
+        return np.ascontiguousarray(np.stack(vecs), dtype=np.float32)
+
+    def resolve_mode(self, mode: str = None) -> str:
+        mode = mode or self.query_mode
+        if mode not in QUERY_MODES:
+            raise ValueError(f"Unknown query mode: {mode} (expected one of {QUERY_MODES})")
+        return mode if self.bm25 is not None else "dense"
+
+    def search(self, query_texts: List[str], top_k: int = 5, mode: str = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (scores, passage positions), both (n_queries, top_k); -1 marks empty slots.
+        Scores are cosine similarities (dense), BM25 scores (lexical) or RRF scores (fused).
+        """
+        mode = self.resolve_mode(mode)
+        if mode == "lexical":
+            D = np.zeros((len(query_texts), top_k), dtype=np.float32)
+            I = np.full((len(query_texts), top_k), -1, dtype=np.int64)
+            with timed("bm25_search"):
+                for n, q in enumerate(query_texts):
+                    scores, positions = self.bm25.search(q, top_k)
+                    D[n, :len(scores)], I[n, :len(positions)] = scores, positions
+            return D, I
+
+        depth = max(top_k, FUSION_DEPTH) if mode == "fused" else top_k
+        q_emb = self.embed_queries(query_texts)
+        with timed("faiss_search"):
+            D, I = self.index.search(q_emb, depth)  # D = similarities, I = faiss ids
+            I = self._positions(I)
+        if mode == "dense":
+            return D, I
+
+        with timed("bm25_search"):
+            lexical = [self.bm25.search(q, depth)[1] for q in query_texts]
+        fused = [rrf_fuse([dense, lex], top_k) for dense, lex in zip(I, lexical)]
+        return np.stack([f[0] for f in fused]), np.stack([f[1] for f in fused])
+
+    def query_many(self, query_texts: List[str], top_k: int = 5, mode: str = None) -> List[List[Tuple[float, dict]]]:
+        """mode: "dense" | "lexical" | "fused" (default: self.query_mode)"""
+        if not query_texts:
+            return []
+        D, I = self.search(query_texts, top_k, mode)
+        out = []
+        for d_row, i_row in zip(D.tolist(), I.tolist()):
+            results = []
+            for score, idx in zip(d_row, i_row):
+                if idx < 0 or idx >= len(self.passages):
+                    continue
+                results.append((float(score), self.passages[idx]))
+            out.append(results)
+        return out
+
+    def query(self, query_text: str, top_k: int = 5, mode: str = None) -> List[Tuple[float, dict]]:
+        if self.batcher is not None:
+            return self.batcher.submit(query_text, top_k, mode)
+        return self.query_many([query_text], top_k, mode)[0]
+
+    def fingerprint(self) -> str:
+        """
+        Content hash of what query results depend on (embedder, index settings, ids and
+        passage layout), so stored results can tell when the index was rebuilt differently.
+        """
+        h = hashlib.sha1()
+        h.update(json.dumps([self.embed_model_name, self.embed_backend, self.index_type, self.search_params,
+                             int(self.index.ntotal), len(self.passages), self.resolve_mode()],
+                            sort_keys=True).encode("utf-8"))
+        if self.labels is not None:
+            h.update(np.ascontiguousarray(self.labels).tobytes())
+        if isinstance(self.passages, PassageStore):
+            h.update(self.passages.checksum().encode("utf-8"))
+        else:
+            for p in self.passages:
+                h.update(p["text"].encode("utf-8") + b"\x00")
+        return h.hexdigest()
+
+    def stats(self) -> dict:
+        out = {
+            "cache_hits": self.query_cache.hits,
+            "cache_misses": self.query_cache.misses,
+            "cache_size": len(self.query_cache),
+        }
+        if self.batcher is not None:
+            b = self.batcher
+            out.update({
+                "batches": b.batches,
+                "batched_queries": b.batched_queries,
+                "avg_batch_size": b.batched_queries / b.batches if b.batches else 0.0,
+                "max_batch_size": b.max_batch_seen,
+            })
+        return out
@@ -0,0 +1,90 @@
+"""
+Process-wide shared resources used by both api.py and streamlit_app.py.
+
+The embedder, FAISS index and engines are created once per process (thread-safe)
+instead of per request / per Streamlit rerun. warm_up() loads everything and runs
+a dummy encode + search so the first real request doesn't pay model-load latency.
+With RETRIEVAL_POOL set, embedding and search go to a retrieval_pool.py server
+instead and this process only maps the passage store.
+"""
+
+import threading
+import time
+from typing import Dict
+
+from answer_table import ANSWER_TABLE_PATH, AnswerTable
+from rules_engine import SYMPTOMS, RuleEngine
+
+INDEX_DIR = "data/rag_index"
+
+_lock = threading.RLock()
+_rule_engine = None
+_answer_table = None
+_hybrid_engine = None
+_pooled_rag = None
+
+
+def get_rule_engine() -> RuleEngine:
+    global _rule_engine
+    if _rule_engine is None:
+        with _lock:
+            if _rule_engine is None:
+                _rule_engine = RuleEngine(compiled=True, compact=True)
+    return _rule_engine
+
+
+def get_answer_table(path: str = ANSWER_TABLE_PATH):
+    """Precomputed checklist answers (see answer_table.py), or None if not built."""
+    global _answer_table
+    if _answer_table is None:
+        with _lock:
+            if _answer_table is None:
+                _answer_table = AnswerTable.load(path, get_rule_engine()) or False
+    return _answer_table or None
+
+
+def get_rag_index(index_dir: str = INDEX_DIR):
+    """The in-process RAGIndex, or a client of the retrieval pool when RETRIEVAL_POOL is set."""
+    global _pooled_rag
+    from retrieval_pool import RETRIEVAL_POOL, PooledRAGIndex
+    if RETRIEVAL_POOL:
+        with _lock:
+            if _pooled_rag is None:
+                _pooled_rag = PooledRAGIndex(RETRIEVAL_POOL, index_dir)
+        return _pooled_rag
+    from hybrid_engine import load_rag_index
+    with _lock:
+        rag = load_rag_index(index_dir)
+        rag.enable_batching()  # concurrent requests/sessions share encode/search calls
+    return rag
+
+
+def get_hybrid_engine():
+    global _hybrid_engine
+    if _hybrid_engine is None:
+        with _lock:
+            if _hybrid_engine is None:
+                from hybrid_engine import HybridEngine
+                _hybrid_engine = HybridEngine(rag=get_rag_index(), rules=get_rule_engine(),
+                                              answer_table=get_answer_table())
+    return _hybrid_engine
+
+
+def warm_up(index_dir: str = INDEX_DIR) -> Dict[str, float]:
+    """Load rules, embedder and index, then run one encode + search. Returns seconds per step."""
+    timings = {}
+    t = time.perf_counter()
+    get_rule_engine()
+    get_answer_table()
+    timings["rules"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    rag = get_rag_index(index_dir)
+    get_hybrid_engine()
+    timings["load_index"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    rag.query_many(["warm up"], top_k=1)
+    timings["first_query"] = time.perf_counter() - t
+    print("[warm-up] " + ", ".join(f"{k}={v:.2f}s" for k, v in timings.items()))
+    return timings
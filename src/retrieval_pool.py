@@ -0,0 +1,524 @@
+"""
+Multi-process retrieval: a fixed pool of worker processes that hold the embedder
+and a memory-mapped RAG index, fed by API processes over local IPC.
+
+With `uvicorn --workers N` every API process would otherwise load its own
+embedder and index. Instead run one pool per host and point the API at it:
+
+    python src/retrieval_pool.py serve --index data/rag_index --workers 4
+    RETRIEVAL_POOL=/tmp/neural-tech-retrieval-$(id -u)/pool.sock uvicorn api:app --app-dir src --workers 8
+
+ - RetrievalPool: spawns the workers. Each loads the index with mmap (the index,
+   passages and BM25 postings are shared through the page cache). The pool hands an
+   idle worker whatever arrived within max_wait_ms as one batch over the worker's own
+   pipe, answered with a single encode() + index.search() call.
+ - serve(): exposes a pool on a unix socket (multiprocessing.connection);
+   requests from all connected API processes are batched together. Messages are
+   pickles, so the socket lives in a 0700 directory and clients must know the
+   authkey: RETRIEVAL_POOL_AUTHKEY, or else a random key serve() writes (0600)
+   to <address>.key for processes of the same user to read.
+ - A worker that dies is replaced; the requests it held fail instead of timing out
+   (no queue is shared between workers, so a killed one cannot leave a lock held).
+ - PooledRAGIndex: RAGIndex stand-in for API processes (query / query_many /
+   search / embed_queries / embed_passages / fingerprint / stats). Only positions,
+   scores and vectors cross the socket; passage text is read from the same mmap PassageStore.
+
+Memory is then one embedder per pool worker, independent of the API worker count,
+and CPU-heavy encoding runs outside the request-handling processes.
+"""
+
+import argparse
+import itertools
+import os
+import secrets
+import stat
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError, get_context
+from multiprocessing.connection import Client, Listener, wait
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+
+from passage_store import PassageStore
+
+RETRIEVAL_POOL = os.getenv("RETRIEVAL_POOL")  # socket address; unset = retrieval in-process
+POOL_AUTHKEY = os.getenv("RETRIEVAL_POOL_AUTHKEY")  # unset: serve() generates one into <address>.key
+POOL_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+POOL_MAX_BATCH = 64        # queries per encode() + search() in a worker
+POOL_MAX_WAIT_MS = 2.0     # how long pending requests wait for a batch to fill
+POOL_TIMEOUT = 30.0        # seconds a client waits for one request
+POOL_THREADS_PER_WORKER = 1  # torch / faiss threads: scale with processes, not threads
+POOL_MONITOR_INTERVAL = 1.0  # seconds between checks for pool shutdown in the results thread
+
+
+def default_address() -> str:
+    """Socket in a per-user directory under the temp dir (computed on use: os.getuid is POSIX-only)."""
+    return os.path.join(tempfile.gettempdir(), f"neural-tech-retrieval-{os.getuid()}", "pool.sock")
+
+
+def _private_dir(path_dir: str):
+    """Create path_dir 0700, or check an existing one is ours and not readable by others."""
+    os.makedirs(path_dir, mode=0o700, exist_ok=True)
+    st = os.lstat(path_dir)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise PermissionError(f"{path_dir} is not a directory owned by this user")
+    if st.st_mode & 0o077:
+        os.chmod(path_dir, 0o700)
+
+
+def _key_path(address: str) -> str:
+    return address + ".key"
+
+
+def load_authkey(address: str) -> bytes:
+    """RETRIEVAL_POOL_AUTHKEY, else the key serve() wrote next to the socket."""
+    if POOL_AUTHKEY:
+        return POOL_AUTHKEY.encode("utf-8")
+    try:
+        with open(_key_path(address), "rb") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        raise RuntimeError(f"No authkey for the retrieval pool at {address}: set RETRIEVAL_POOL_AUTHKEY "
+                           f"or run the client as the user that started the pool") from None
+
+
+def _write_authkey(address: str) -> bytes:
+    key = secrets.token_hex(32).encode("utf-8")
+    path = _key_path(address)
+    if os.path.exists(path):
+        os.remove(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+def _load_index(index_dir: str, backend: str):
+    from rag import RAGIndex
+
+    rag = RAGIndex(backend=backend)
+    rag.load(index_dir, mmap=True)
+    return rag
+
+
+def _worker_main(worker_id: int, index_dir: str, backend: str, conn, threads: int, loader):
+    # before torch / faiss are imported, so each worker stays on its own cores
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    rag = (loader or _load_index)(index_dir, backend)
+    rag.query_many(["warm up"], top_k=1)
+    conn.send({
+        "dim": rag.dim,
+        "query_mode": rag.resolve_mode(),
+        "fingerprint": rag.fingerprint(),
+        "n_passages": len(rag.passages),
+        "passages_checksum": rag.passages.checksum(),
+        "embed_model": rag.embed_model_name,
+        "embed_backend": rag.embed_backend,
+    })
+    # a pipe of its own (no queue locks shared with other workers): one batch in, its results out
+    while True:
+        try:
+            batch = conn.recv()
+        except EOFError:
+            return
+        if batch is None:
+            return
+        conn.send(_answer_batch(rag, batch))
+
+
+def _answer_batch(rag, batch: List[tuple]) -> List[tuple]:
+    """
+    batch items: (request id, kind, args); one encode/search per (kind, top_k, mode) group.
+    Returns (request id, ok, value) per item.
+    """
+    groups: Dict[tuple, list] = {}
+    for req_id, kind, args in batch:
+        key = (kind,) + tuple(args[1:])  # search: (texts, top_k, mode); embed / embed_passages: (texts,)
+        groups.setdefault(key, []).append((req_id, args[0]))
+    results = []
+    for key, items in groups.items():
+        texts = [t for _, ts in items for t in ts]
+        try:
+            if key[0] == "search":
+                D, I = rag.search(texts, key[1], key[2])
+                out = (D, I)
+            elif key[0] == "embed":
+                out = (rag.embed_queries(texts),)
+            elif key[0] == "embed_passages":  # no query LRU: prompt sentences are one-offs
+                out = (rag.embed_passages(texts),)
+            else:
+                raise ValueError(f"Unknown request kind {key[0]!r}")
+        except Exception as e:
+            results.extend((req_id, False, f"{type(e).__name__}: {e}") for req_id, _ in items)
+            continue
+        start = 0
+        for req_id, ts in items:
+            results.append((req_id, True, tuple(a[start:start + len(ts)] for a in out)))
+            start += len(ts)
+    return results
+
+
+class _Worker:
+    __slots__ = ("id", "proc", "conn", "ready", "taken")
+
+    def __init__(self, worker_id: int, proc, conn):
+        self.id = worker_id
+        self.proc = proc
+        self.conn = conn
+        self.ready = False       # index loaded, accepting batches
+        self.taken: List[int] = []  # request ids of the batch it is working on
+
+
+class RetrievalPool:
+    """
+    Requests wait in one pending queue; an idle worker is sent up to max_batch of them
+    (after at most max_wait_ms for a batch to fill) over its own pipe. The pool therefore
+    knows which requests each worker holds: when a worker dies they fail at once and a
+    replacement is started.
+    """
+
+    def __init__(self, index_dir: str = "data/rag_index", workers: int = POOL_WORKERS, backend: str = None,
+                 max_batch: int = POOL_MAX_BATCH, max_wait_ms: float = POOL_MAX_WAIT_MS,
+                 threads_per_worker: int = POOL_THREADS_PER_WORKER, loader: Callable = None):
+        """loader(index_dir, backend) -> RAGIndex, run in each worker (a module-level function)."""
+        self._ctx = get_context("spawn")  # no forked torch / faiss state
+        self.index_dir = index_dir
+        self._n_workers = workers
+        self._worker_args = (index_dir, backend)
+        self._threads_per_worker = threads_per_worker
+        self._loader = loader
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._workers: List[_Worker] = []
+        self._pending = deque()  # (request id, kind, args, enqueued at)
+        self._futures: Dict[int, Future] = {}
+        self._ids = itertools.count()
+        self._cond = threading.Condition()
+        self._closing = False
+        self._scheduler = None
+        self._collector = None
+        self.info: Dict[str, Any] = {}
+        self.requests = 0
+        self.queries = 0
+        self.restarts = 0
+
+    def _spawn(self, worker_id: int) -> _Worker:
+        parent, child = self._ctx.Pipe()
+        proc = self._ctx.Process(target=_worker_main, name=f"retrieval-{worker_id}", daemon=True,
+                                 args=(worker_id,) + self._worker_args + (child, self._threads_per_worker,
+                                                                          self._loader))
+        proc.start()
+        child.close()  # only the worker holds its end now: its death reads as EOF here
+        return _Worker(worker_id, proc, parent)
+
+    def start(self, timeout: float = 600.0) -> "RetrievalPool":
+        """Start the workers and wait until every one has loaded the index."""
+        t = time.perf_counter()
+        self._workers = [self._spawn(i) for i in range(self._n_workers)]
+        for w in self._workers:
+            try:
+                if not w.conn.poll(max(0.0, timeout - (time.perf_counter() - t))):
+                    self.close()
+                    raise TimeoutError(f"retrieval workers not ready after {timeout:.0f}s")
+                self.info = w.conn.recv()
+            except (EOFError, OSError):
+                self.close()
+                raise RuntimeError("a retrieval worker exited while loading the index") from None
+            w.ready = True
+        self._scheduler = threading.Thread(target=self._schedule, name="retrieval-pool-scheduler", daemon=True)
+        self._collector = threading.Thread(target=self._collect, name="retrieval-pool-results", daemon=True)
+        self._scheduler.start()
+        self._collector.start()
+        print(f"[retrieval pool] {len(self._workers)} workers ready in {time.perf_counter() - t:.1f}s "
+              f"({self.info['n_passages']} passages, {self.info['query_mode']})")
+        return self
+
+    def _schedule(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closing:
+                        return
+                    idle = next((w for w in self._workers if w.ready and not w.taken), None)
+                    if idle is None or not self._pending:
+                        self._cond.wait()
+                        continue
+                    fill = self._pending[0][3] + self.max_wait - time.monotonic()
+                    if len(self._pending) >= self.max_batch or fill <= 0:
+                        break
+                    self._cond.wait(fill)
+                batch = [self._pending.popleft()[:3] for _ in range(min(self.max_batch, len(self._pending)))]
+                idle.taken = [req_id for req_id, _, _ in batch]
+            try:
+                idle.conn.send(batch)
+            except OSError:
+                pass  # died: _collect() sees the EOF and fails idle.taken
+
+    def _collect(self):
+        while not self._closing:
+            with self._cond:
+                workers = {w.conn: w for w in self._workers}
+            for conn in wait(list(workers), timeout=POOL_MONITOR_INTERVAL):
+                w = workers[conn]
+                try:
+                    msg = conn.recv()
+                except (EOFError, OSError):
+                    self._replace(w)
+                    continue
+                with self._cond:
+                    if not w.ready:  # a replacement finished loading the index
+                        w.ready = True
+                        self._cond.notify_all()
+                        continue
+                    w.taken = []
+                    done = [(self._futures.pop(req_id, None), ok, value) for req_id, ok, value in msg]
+                    self._cond.notify_all()
+                for fut, ok, value in done:
+                    if fut is None:
+                        continue
+                    if ok:
+                        fut.set_result(value)
+                    else:
+                        fut.set_exception(RuntimeError(value))
+
+    def _replace(self, w: _Worker):
+        """Fail the requests a dead worker held (instead of letting clients time out) and start a new one."""
+        with self._cond:
+            if self._closing:
+                return
+            w.ready = False
+            lost = [self._futures.pop(req_id, None) for req_id in w.taken]
+            self.restarts += 1
+        w.proc.join(timeout=1.0)
+        print(f"[retrieval pool] worker {w.id} died (exit code {w.proc.exitcode}); starting a replacement")
+        for fut in lost:
+            if fut is not None:
+                fut.set_exception(RuntimeError(f"retrieval worker {w.id} died (exit code {w.proc.exitcode})"))
+        new = self._spawn(w.id)
+        with self._cond:
+            self._workers[self._workers.index(w)] = new
+        w.conn.close()
+
+    def submit(self, kind: str, *args) -> Future:
+        """
+        kind "search": (texts, top_k, mode) -> (D, I); "embed" / "embed_passages": (texts,) -> (vectors,)
+        """
+        fut = Future()
+        with self._cond:
+            if self._closing:
+                raise RuntimeError("retrieval pool is closed")
+            req_id = next(self._ids)
+            self._futures[req_id] = fut
+            self._pending.append((req_id, kind, args, time.monotonic()))
+            self.requests += 1
+            self.queries += len(args[0])
+            self._cond.notify_all()
+        return fut
+
+    def stats(self) -> dict:
+        return {"workers": len(self._workers), "alive": sum(w.proc.is_alive() for w in self._workers),
+                "restarts": self.restarts, "requests": self.requests, "queries": self.queries,
+                "pending": len(self._futures)}
+
+    def close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+            workers = list(self._workers)
+        for t in (self._scheduler, self._collector):
+            if t is not None:
+                t.join(timeout=10)
+        self._scheduler = self._collector = None
+        for w in workers:
+            try:
+                w.conn.send(None)
+            except OSError:
+                pass
+        for w in workers:
+            w.proc.join(timeout=10)
+            if w.proc.is_alive():
+                w.proc.terminate()
+            w.conn.close()
+        with self._cond:
+            pending, self._futures = self._futures, {}
+            self._pending.clear()
+        for fut in pending.values():
+            fut.set_exception(RuntimeError("retrieval pool closed"))
+
+
+def serve(pool: RetrievalPool, address: str = None, authkey: bytes = None):
+    """
+    Answer PooledRAGIndex clients on a unix socket until interrupted. authkey defaults to
+    RETRIEVAL_POOL_AUTHKEY, else a fresh random key written to <address>.key (0600).
+    """
+    address = address or default_address()
+    _private_dir(os.path.dirname(os.path.abspath(address)))
+    if authkey is None:
+        authkey = POOL_AUTHKEY.encode("utf-8") if POOL_AUTHKEY else _write_authkey(address)
+    if os.path.exists(address):
+        os.remove(address)
+    listener = Listener(address, family="AF_UNIX", authkey=authkey)
+    os.chmod(address, 0o600)
+    print(f"[retrieval pool] listening on {address}")
+
+    def handle(conn):
+        send_lock = threading.Lock()
+
+        def reply(req_id, fut: Future):
+            try:
+                msg = (req_id, True, fut.result())
+            except Exception as e:
+                msg = (req_id, False, str(e))
+            with send_lock:
+                try:
+                    conn.send(msg)
+                except OSError:
+                    pass  # client went away
+
+        try:
+            while True:
+                req_id, kind, args = conn.recv()
+                if kind == "info":
+                    fut = Future()
+                    fut.set_result(pool.info)
+                elif kind == "stats":
+                    fut = Future()
+                    fut.set_result(pool.stats())
+                else:
+                    fut = pool.submit(kind, *args)
+                fut.add_done_callback(lambda f, r=req_id: reply(r, f))
+        except (EOFError, OSError):
+            conn.close()
+
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, OSError) as e:  # a bad client must not stop the pool
+                print(f"[retrieval pool] rejected connection: {e}")
+                continue
+            threading.Thread(target=handle, args=(conn,), name="retrieval-pool-conn", daemon=True).start()
+    finally:
+        listener.close()
+
+
+class PoolClient:
+    """One connection per process, shared by threads; replies are matched to requests by id."""
+
+    def __init__(self, address: str = None, authkey: bytes = None, timeout: float = POOL_TIMEOUT):
+        address = address or default_address()
+        self.address = address
+        self.timeout = timeout
+        self._conn = Client(address, family="AF_UNIX", authkey=authkey or load_authkey(address))
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._futures: Dict[int, Future] = {}
+        self._ids = itertools.count()
+        threading.Thread(target=self._read, name="retrieval-pool-client", daemon=True).start()
+
+    def _read(self):
+        try:
+            while True:
+                req_id, ok, value = self._conn.recv()
+                with self._lock:
+                    fut = self._futures.pop(req_id, None)
+                if fut is None:
+                    continue
+                if ok:
+                    fut.set_result(value)
+                else:
+                    fut.set_exception(RuntimeError(value))
+        except (EOFError, OSError) as e:
+            with self._lock:
+                pending, self._futures = self._futures, {}
+            for fut in pending.values():
+                fut.set_exception(ConnectionError(f"retrieval pool connection lost: {e}"))
+
+    def call(self, kind: str, *args):
+        fut = Future()
+        req_id = next(self._ids)
+        with self._lock:
+            self._futures[req_id] = fut
+        try:
+            with self._send_lock:
+                self._conn.send((req_id, kind, args))
+            return fut.result(timeout=self.timeout)
+        finally:
+            with self._lock:
+                self._futures.pop(req_id, None)  # still there after a timeout / failed send
+
+
+class PooledRAGIndex:
+    """The parts of RAGIndex the engines use, answered by a retrieval pool."""
+
+    def __init__(self, address: str = None, index_dir: str = "data/rag_index"):
+        self.client = PoolClient(address)
+        info = self.client.call("info")
+        self.dim = info["dim"]
+        self.query_mode = info["query_mode"]
+        self.embed_model_name = info["embed_model"]
+        self.embed_backend = info["embed_backend"]
+        self._fingerprint = info["fingerprint"]
+        self.passages = PassageStore.open(index_dir)
+        if self.passages.checksum() != info["passages_checksum"]:
+            raise RuntimeError(f"{index_dir} is not the index the retrieval pool at {self.client.address} serves")
+        self.batcher = None
+
+    def enable_batching(self, *args, **kwargs):
+        return None  # the pool workers batch across all API processes
+
+    def resolve_mode(self, mode: str = None) -> str:
+        return mode or self.query_mode
+
+    def search(self, query_texts: List[str], top_k: int = 5, mode: str = None) -> Tuple[np.ndarray, np.ndarray]:
+        return self.client.call("search", list(query_texts), top_k, self.resolve_mode(mode))
+
+    def embed_queries(self, query_texts: List[str]) -> np.ndarray:
+        return self.client.call("embed", list(query_texts))[0]
+
+    def embed_passages(self, texts: List[str]) -> np.ndarray:
+        return self.client.call("embed_passages", list(texts))[0]
+
+    def query_many(self, query_texts: List[str], top_k: int = 5, mode: str = None) -> List[List[Tuple[float, dict]]]:
+        if not query_texts:
+            return []
+        D, I = self.search(query_texts, top_k, mode)
+        return [[(float(score), self.passages[idx]) for score, idx in zip(d_row, i_row) if 0 <= idx < len(self.passages)]
+                for d_row, i_row in zip(D.tolist(), I.tolist())]
+
+    def query(self, query_text: str, top_k: int = 5, mode: str = None) -> List[Tuple[float, dict]]:
+        return self.query_many([query_text], top_k, mode)[0]
+
+    def fingerprint(self) -> str:
+        return self._fingerprint
+
+    def stats(self) -> dict:
+        return {"pool": self.client.address, **self.client.call("stats")}
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Serve retrieval from a pool of worker processes.")
+    sub = p.add_subparsers(dest="command", required=True)
+    s = sub.add_parser("serve")
+    s.add_argument("--index", default="data/rag_index")
+    s.add_argument("--address", default=RETRIEVAL_POOL, help="socket path (default: a per-user temp dir)")
+    s.add_argument("--workers", type=int, default=POOL_WORKERS)
+    s.add_argument("--backend", default=None, help="embedding backend (default: EMBED_BACKEND env var)")
+    s.add_argument("--max-batch", type=int, default=POOL_MAX_BATCH)
+    s.add_argument("--max-wait-ms", type=float, default=POOL_MAX_WAIT_MS)
+    s.add_argument("--threads-per-worker", type=int, default=POOL_THREADS_PER_WORKER)
+    args = p.parse_args()
+
+    pool = RetrievalPool(args.index, workers=args.workers, backend=args.backend, max_batch=args.max_batch,
+                         max_wait_ms=args.max_wait_ms, threads_per_worker=args.threads_per_worker).start()
+    try:
+        serve(pool, args.address)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close()
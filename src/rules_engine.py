@@ -1,9 +1,23 @@
 """
 Rule-based inference engine. Rules can be loaded from JSON or defined inline.
 Each rule is a dict with: name, conditions (list), severity, emergency, explanation.
+
+RuleEngine(compact=True) stores them as Rule objects instead: frozen, slotted,
+condition names interned once and kept per rule as packed ids. A Rule reads like
+the dict (r["name"], r.get(...), dict(r), {**r}), so results keep the same shape.
 """
 
-from typing import Dict, List
+import sys
+from array import array
+from collections.abc import Mapping
+from typing import Dict, Iterable, List, Tuple, Union
+import numpy as np
+
+# partial-match scoring (RuleEngine.rank)
+SEVERITY_WEIGHTS = {"Mild": 0.7, "Moderate": 0.85, "Severe": 1.0, "Critical": 1.15}
+EMERGENCY_BOOST = 1.25
+COVERAGE_WEIGHT = 0.7  # score = 0.7 * coverage + 0.3 * Jaccard, before the weights above
+TRUTHY = {"1", "1.0", "true", "yes", "y", "t"}  # text cells counted as a present symptom (frame_matrix)
 
 DEFAULT_RULES = [
     {"name": "Flu", "conditions": ["fever","cough","sore_throat"], "severity":"Moderate", "emergency":False, "explanation":"Viral respiratory infection"},
@@ -29,16 +43,291 @@ DEFAULT_RULES = [
     {"name": "Diabetes Complication", "conditions": ["fatigue","nausea","sweating","headache"], "severity":"Moderate", "emergency":False, "explanation":"Possible hypo/hyperglycemia or related issue"}
 ]
 
+# fixed checklist vocabulary: the Streamlit checkboxes and the if-else-simple.py questions
+SYMPTOMS = [
+    "fever","cough","sore_throat","chills","sweating","headache","body_pain",
+    "runny_nose","nausea","vomiting","abdominal_pain","shortness_breath","chest_pain","fatigue"
+]
+
+_SYMPTOM_ORDER = {s: i for i, s in enumerate(SYMPTOMS)}
+
+
+def symptom_query(symptoms: Mapping, user_text: str = "") -> str:
+    """
+    The RAG query for a request: the free text when it isn't blank, else the present symptoms
+    joined in checklist order (others after them, sorted), whatever order the payload used.
+    """
+    if user_text and user_text.strip():
+        return user_text.strip()
+    present = [k for k, v in symptoms.items() if v]
+    return ", ".join(sorted(present, key=lambda k: (_SYMPTOM_ORDER.get(k, len(SYMPTOMS)), k)))
+
+
+# interned condition vocabulary shared by every Rule in the process
+_CONDITION_IDS: Dict[str, int] = {}
+_CONDITION_NAMES: List[str] = []
+_SEVERITIES: Dict[str, str] = {}
+
+
+def condition_id(name: str) -> int:
+    cid = _CONDITION_IDS.get(name)
+    if cid is None:
+        name = sys.intern(str(name))
+        cid = _CONDITION_IDS.setdefault(name, len(_CONDITION_NAMES))
+        if cid == len(_CONDITION_NAMES):
+            _CONDITION_NAMES.append(name)
+    return cid
+
+
+class Rule(Mapping):
+    """Immutable rule with the dict interface of the plain rule dicts."""
+    __slots__ = ("name", "_condition_ids", "severity", "emergency", "explanation")
+    _KEYS = ("name", "conditions", "severity", "emergency", "explanation")
+
+    def __init__(self, name: str, conditions: Iterable[str], severity: str, emergency: bool, explanation: str):
+        init = object.__setattr__
+        init(self, "name", name)
+        # uint32 ids packed in bytes: ~4 bytes per condition instead of a list slot + a str each
+        init(self, "_condition_ids", array("I", [condition_id(c) for c in conditions]).tobytes())
+        init(self, "severity", _SEVERITIES.setdefault(severity, severity))
+        init(self, "emergency", bool(emergency))
+        init(self, "explanation", explanation)
+
+    @classmethod
+    def from_dict(cls, rule: Union[dict, "Rule"]) -> "Rule":
+        if isinstance(rule, Rule):
+            return rule
+        return cls(rule["name"], rule["conditions"], rule["severity"], rule["emergency"], rule["explanation"])
+
+    @property
+    def condition_ids(self) -> Tuple[int, ...]:
+        return tuple(array("I", self._condition_ids))
+
+    @property
+    def conditions(self) -> Tuple[str, ...]:
+        return tuple(_CONDITION_NAMES[i] for i in array("I", self._condition_ids))
+
+    def __getitem__(self, key: str):
+        if key == "conditions":
+            return self.conditions
+        if key in self._KEYS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self):
+        return len(self._KEYS)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Rule is immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError("Rule is immutable")
+
+    def _astuple(self):
+        return self.name, self.conditions, self.severity, self.emergency, self.explanation
+
+    def __eq__(self, other):
+        # equal to the plain dict form too (conditions compared as a sequence)
+        if isinstance(other, Rule):
+            return self._astuple() == other._astuple()
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return len(other) == len(self._KEYS) and all(k in other for k in self._KEYS) and self._astuple() == (
+            other["name"], tuple(other["conditions"]), other["severity"], other["emergency"], other["explanation"])
+
+    def __hash__(self):
+        return hash(self._astuple())
+
+    def __reduce__(self):
+        # ids are process-local: pickle by condition name
+        return Rule, self._astuple()
+
+    def __repr__(self):
+        return f"Rule({dict(self)!r})"
+
+
+def compact_rules(rules: Iterable[Union[dict, Rule]]) -> List[Rule]:
+    return [Rule.from_dict(r) for r in rules]
+
+
 class RuleEngine:
-    def __init__(self, rules: List[dict] = None):
+    def __init__(self, rules: List[dict] = None, compiled: bool = False, compact: bool = False):
+        """compact: store the rules as Rule objects (a fraction of the dicts' memory at large rule sets)."""
         self.rules = rules or DEFAULT_RULES
+        if compact:
+            self.rules = compact_rules(self.rules)
+        self.symptom_index = {}  # symptom -> bit position
+        self.masks = None        # (n_rules, n_words) uint64 condition bitmasks
+        self.cond_matrix = None  # (n_rules, n_symptoms) 0/1 condition matrix for batches
+        self.cond_counts = None  # number of conditions per rule
+        self.postings = None          # inverted index: rule ids grouped by symptom bit ...
+        self.postings_offsets = None  # ... symptom j owns postings[offsets[j]:offsets[j + 1]]
+        self.rule_weights = None      # severity weight * emergency boost per rule
+        if compiled:
+            self.compile()
+
+    def compile(self):
+        """
+        Assign every symptom a bit once and turn each rule's conditions into a bitmask,
+        so evaluate() matches all rules in one vectorized (mask & facts) == mask pass.
+        """
+        self.symptom_index = {}
+        for r in self.rules:
+            for cond in r["conditions"]:
+                self.symptom_index.setdefault(cond, len(self.symptom_index))
+
+        n_words = max(1, (len(self.symptom_index) + 63) // 64)
+        self.masks = np.zeros((len(self.rules), n_words), dtype=np.uint64)
+        for i, r in enumerate(self.rules):
+            for cond in r["conditions"]:
+                self._set_bit(self.masks[i], self.symptom_index[cond])
+
+        self.cond_matrix = np.zeros((len(self.rules), len(self.symptom_index)), dtype=np.float32)
+        for i, r in enumerate(self.rules):
+            for cond in r["conditions"]:
+                self.cond_matrix[i, self.symptom_index[cond]] = 1.0
+        self.cond_counts = self.cond_matrix.sum(axis=1)
+
+        postings = [[] for _ in self.symptom_index]
+        for i, r in enumerate(self.rules):
+            for cond in dict.fromkeys(r["conditions"]):
+                postings[self.symptom_index[cond]].append(i)
+        self.postings_offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        self.postings_offsets[1:] = np.cumsum([len(p) for p in postings])
+        self.postings = np.array([i for p in postings for i in p], dtype=np.int32)
+        self.rule_weights = np.array([
+            SEVERITY_WEIGHTS.get(r["severity"], 1.0) * (EMERGENCY_BOOST if r["emergency"] else 1.0)
+            for r in self.rules
+        ], dtype=np.float32)
+        return self
+
+    @property
+    def compiled(self) -> bool:
+        return self.masks is not None
+
+    @staticmethod
+    def _set_bit(row: np.ndarray, bit: int):
+        row[bit // 64] |= np.uint64(1) << np.uint64(bit % 64)
+
+    def _fact_mask(self, facts: Dict[str, bool]) -> np.ndarray:
+        mask = np.zeros(self.masks.shape[1], dtype=np.uint64)
+        for k, v in facts.items():
+            bit = self.symptom_index.get(k)
+            if v and bit is not None:
+                self._set_bit(mask, bit)
+        return mask
 
     def evaluate(self, facts: Dict[str, bool]) -> List[dict]:
         """
         facts: mapping of symptom -> boolean
         """
+        if self.compiled:
+            fm = self._fact_mask(facts)
+            hits = np.all((self.masks & fm) == self.masks, axis=1)
+            return [self.rules[i] for i in np.flatnonzero(hits)]
+
         matched = []
         for r in self.rules:
             if all(facts.get(cond, False) for cond in r["conditions"]):
                 matched.append(r)
         return matched
+
+    def fact_matrix(self, facts_list: List[Dict[str, bool]]) -> np.ndarray:
+        """
+        Build the (n_patients, n_symptoms) 0/1 matrix for a list of fact dicts.
+        Symptoms no rule refers to are dropped.
+        """
+        if not self.compiled:
+            self.compile()
+        F = np.zeros((len(facts_list), len(self.symptom_index)), dtype=np.float32)
+        for n, facts in enumerate(facts_list):
+            for k, v in facts.items():
+                j = self.symptom_index.get(k)
+                if v and j is not None:
+                    F[n, j] = 1.0
+        return F
+
+    def frame_matrix(self, df) -> np.ndarray:
+        """
+        Same as fact_matrix() for a pandas DataFrame with one column per symptom
+        (bool / 0-1 / "yes"-"no" text); other columns are ignored.
+        """
+        from pandas.api.types import is_bool_dtype, is_numeric_dtype
+
+        if not self.compiled:
+            self.compile()
+        F = np.zeros((len(df), len(self.symptom_index)), dtype=np.float32)
+        for col in df.columns:
+            j = self.symptom_index.get(col)
+            if j is None:
+                continue
+            values = df[col]
+            if is_bool_dtype(values.dtype):
+                present = values.fillna(False).astype(bool)
+            elif is_numeric_dtype(values.dtype):
+                present = values.fillna(0) != 0
+            else:
+                # object / str (pandas 3) / mixed cells: only TRUTHY text counts, so "no" and "0" are absent
+                present = values.astype(object).fillna("").astype(str).str.strip().str.lower().isin(TRUTHY)
+            F[:, j] = present.to_numpy(dtype=bool)
+        return F
+
+    def match_matrix(self, F: np.ndarray) -> np.ndarray:
+        """
+        F: (n_patients, n_symptoms) matrix with columns ordered by symptom_index.
+        Returns a (n_patients, n_rules) boolean hit matrix from a single matmul:
+        a rule fires when every one of its conditions is present.
+        """
+        if not self.compiled:
+            self.compile()
+        return (F @ self.cond_matrix.T) == self.cond_counts
+
+    def evaluate_many(self, facts_list: List[Dict[str, bool]]) -> List[List[dict]]:
+        """
+        Batch version of evaluate(): one result list per fact dict, same order.
+        """
+        hits = self.match_matrix(self.fact_matrix(facts_list))
+        return [[self.rules[i] for i in np.flatnonzero(row)] for row in hits]
+
+    def rank(self, facts: Dict[str, bool], top_k: int = 5, min_coverage: float = 0.0) -> List[dict]:
+        """
+        Partial matching, best first. Only rules sharing at least one present symptom
+        are scored (via the inverted index): coverage (share of the rule's conditions
+        present) blended with Jaccard, times severity weight and emergency boost.
+        Each result is the rule dict plus score, coverage, matched and missing.
+        """
+        if not self.compiled:
+            self.compile()
+        present = [k for k, v in facts.items() if v]
+        bits = [self.symptom_index[k] for k in present if k in self.symptom_index]
+        if not bits or top_k <= 0:
+            return []
+        off = self.postings_offsets
+        candidates = np.concatenate([self.postings[off[b]:off[b + 1]] for b in bits])
+        rule_ids, overlap = np.unique(candidates, return_counts=True)
+
+        n_cond = self.cond_counts[rule_ids]
+        coverage = overlap / n_cond
+        jaccard = overlap / (len(present) + n_cond - overlap)
+        score = (COVERAGE_WEIGHT * coverage + (1 - COVERAGE_WEIGHT) * jaccard) * self.rule_weights[rule_ids]
+        if min_coverage > 0:
+            keep = coverage >= min_coverage
+            rule_ids, coverage, score = rule_ids[keep], coverage[keep], score[keep]
+        # ties: rule order; float32 sums of different fractions may differ in the last bits
+        top = np.lexsort((rule_ids, -np.round(score, 6)))[:top_k]
+
+        present_set = set(present)
+        ranked = []
+        for j in top:
+            r = self.rules[rule_ids[j]]
+            ranked.append({
+                **r,
+                "score": float(score[j]),
+                "coverage": float(coverage[j]),
+                "matched": [c for c in r["conditions"] if c in present_set],
+                "missing": [c for c in r["conditions"] if c not in present_set],
+            })
+        return ranked
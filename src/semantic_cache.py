@@ -0,0 +1,106 @@
+"""
+Semantic near-duplicate cache for free-text hybrid queries.
+
+Paraphrases ("I have fever and a bad cough" / "fever with bad cough") never share
+an exact LLM-cache key, so each would pay for retrieval and a full LLM call.
+Here prior queries are kept in a small FAISS inner-product index over their
+normalized embeddings (from RAGIndex.embed_queries, the embedder retrieval
+uses); a lookup returns the stored value when the nearest prior query with
+the *same* true symptom flags is at least SEMANTIC_CACHE_THRESHOLD similar.
+
+Entries are evicted least-recently-used once SEMANTIC_CACHE_SIZE is reached.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from metrics import CACHE_LOOKUPS
+
+if TYPE_CHECKING:
+    from rag import RAGIndex
+
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1024"))  # 0 disables the cache
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))  # cosine similarity
+SEMANTIC_CACHE_PROBE = 8  # neighbours checked for one with identical symptom flags
+
+
+def flags_key(symptoms: Dict[str, bool]) -> Tuple[str, ...]:
+    return tuple(sorted(k for k, v in symptoms.items() if v))
+
+
+class SemanticCache:
+    """Thread-safe; vectors must be L2-normalized float32 of size dim."""
+
+    def __init__(self, dim: int, max_entries: int = SEMANTIC_CACHE_SIZE,
+                 threshold: float = SEMANTIC_CACHE_THRESHOLD, probe: int = SEMANTIC_CACHE_PROBE):
+        self.dim = dim
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.probe = probe
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        self._entries = OrderedDict()  # id -> (flags key, value), least recently used first
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, vec: np.ndarray, symptoms: Dict[str, bool]) -> Tuple[Optional[Any], float]:
+        """(stored value, similarity) of the best match, or (None, best similarity seen)."""
+        key = flags_key(symptoms)
+        q = np.ascontiguousarray(vec, dtype=np.float32).reshape(1, -1)
+        best = 0.0
+        with self._lock:
+            if self.index.ntotal:
+                D, I = self.index.search(q, min(self.probe, self.index.ntotal))
+                best = float(D[0, 0])
+                for sim, entry_id in zip(D[0].tolist(), I[0].tolist()):
+                    if sim < self.threshold:
+                        break
+                    flags, value = self._entries[entry_id]
+                    if flags == key:
+                        self._entries.move_to_end(entry_id)
+                        self.hits += 1
+                        CACHE_LOOKUPS.inc(cache="semantic", result="hit")
+                        return value, sim
+            self.misses += 1
+        CACHE_LOOKUPS.inc(cache="semantic", result="miss")
+        return None, best
+
+    def put(self, vec: np.ndarray, symptoms: Dict[str, bool], value: Any):
+        if self.max_entries <= 0:
+            return
+        q = np.ascontiguousarray(vec, dtype=np.float32).reshape(1, -1)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self.index.add_with_ids(q, np.array([entry_id], dtype=np.int64))
+            self._entries[entry_id] = (flags_key(symptoms), value)
+            if len(self._entries) > self.max_entries:
+                evicted = []
+                while len(self._entries) > self.max_entries:
+                    evicted.append(self._entries.popitem(last=False)[0])
+                self.index.remove_ids(np.array(evicted, dtype=np.int64))
+                self.evictions += len(evicted)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "size": len(self._entries), "max_entries": self.max_entries,
+                "evictions": self.evictions, "threshold": self.threshold}
+
+
+def default_semantic_cache(rag: "RAGIndex") -> Optional[SemanticCache]:
+    """None when disabled (SEMANTIC_CACHE_SIZE=0)."""
+    if SEMANTIC_CACHE_SIZE <= 0:
+        return None
+    return SemanticCache(rag.dim)
@@ -21,14 +21,69 @@ st.set_page_config(
 
 # --- 2. Import Custom Modules (Lazy load to catch errors) ---
 try:
-    from rules_engine import RuleEngine
-    from hybrid_engine import HybridEngine, load_rag_index
-    from llm_wrapper import generate_with_llm
-    import pandas as pd
+    import resources
+    from rules_engine import symptom_query
 except Exception as e:
     st.error(f"Critical Error: Failed to import application modules.\n\nDetails: {e}")
     st.stop()
 
+@st.cache_resource(show_spinner="Loading models and knowledge index...")
+def shared_resources():
+    """Once per server process: shared by every session and rerun."""
+    resources.warm_up()
+    return (resources.get_rule_engine(), resources.get_rag_index(), resources.get_hybrid_engine(),
+            resources.get_answer_table())
+
+rule_engine, rag_index, hybrid_engine, answer_table = shared_resources()
+
+def show_elaboration(state):
+    """The fast path's background LLM elaboration; only polls while it is still being written."""
+    if "result" not in state:
+        poll_elaboration(state)
+    elif state["result"][0] == "ok":
+        st.write(state["result"][1])
+    else:
+        st.error(f"LLM elaboration failed: {state['result'][1]}")
+
+@st.fragment(run_every=1.0)
+def poll_elaboration(state):
+    future = state["future"]
+    if not future.done():
+        st.caption("The LLM elaboration is still being written...")
+        return
+    try:
+        state["result"] = ("ok", future.result()["llm_summary"])
+    except Exception as e:
+        state["result"] = ("error", str(e))
+    st.rerun()  # full rerun: the page is redrawn from session_state without this polling fragment
+
+def show_hybrid(view, llm_stream=None):
+    """Hybrid output; the first draw streams the summary, redraws reuse the text kept in view."""
+    st.subheader("Rule Matches")
+    if not view["rule_matches"]:
+        st.write("No rule matches.")
+    else:
+        for r in view["rule_matches"]:
+            st.markdown(f"**{r['name']}** — Severity: {r['severity']} — Emergency: {r['emergency']}")
+            st.write(r["explanation"])
+
+    st.subheader("Retrieved Context (top)")
+    for score, p in view["retrieved"]:
+        st.write(f"- ({score:.3f}) {p['text'][:400]}")
+
+    if view["path"] == "fast":
+        st.subheader("Rule-based Summary")
+        st.caption(f"Fast path ({view['fast_reason']} match): answered from the rules without waiting for the LLM.")
+    else:
+        st.subheader("LLM Summary (cautious)")
+    if llm_stream is not None:
+        view["summary"] = st.write_stream(llm_stream)
+    else:
+        st.write(view["summary"])
+    if "elaboration" in view:
+        st.subheader("LLM Summary (cautious)")
+        show_elaboration(view["elaboration"])
+
 st.title("Neural Tech— Medical Diagnosis (Prototype)")
 st.markdown("**Disclaimer:** Prototype only. This is not medical advice.")
 st.markdown("If you cant find your condition, try RAG or Hybrid mode")
@@ -37,10 +92,7 @@ st.markdown("If you cant find your condition, try RAG or Hybrid mode")
 mode = st.sidebar.radio("Choose layer", ["Rule-Based", "RAG (Knowledge)", "Hybrid (Rule+RAG+LLM)"])
 
 # symptom checklist
-SYMPTOMS = [
-    "fever","cough","sore_throat","chills","sweating","headache","body_pain",
-    "runny_nose","nausea","vomiting","abdominal_pain","shortness_breath","chest_pain","fatigue"
-]
+SYMPTOMS = resources.SYMPTOMS
 st.header("Enter symptoms")
 cols = st.columns(3)
 symptom_flags = {}
@@ -50,14 +102,25 @@ for i, s in enumerate(SYMPTOMS):
 
 user_text = st.text_area("Optional: Describe your symptoms in your own words (Only for LLM mode/window)", height=100)
 
+hybrid_inputs = (mode, tuple(s for s, v in symptom_flags.items() if v), user_text)
+
 # buttons
 if st.button("Run"):
+    st.session_state.pop("hybrid_view", None)
     # RULE MODE
-    engine = RuleEngine()
     if mode == "Rule-Based":
-        matches = engine.evaluate(symptom_flags)
+        # precomputed table for checklist answers, live evaluation otherwise
+        matches = answer_table.rule_matches(symptom_flags) if answer_table else None
+        if matches is None:
+            matches = rule_engine.evaluate(symptom_flags)
         if not matches:
             st.warning("No rule matched. Consider using Hybrid mode or consult a doctor.")
+            ranked = rule_engine.rank(symptom_flags, top_k=3)
+            if ranked:
+                st.subheader("Closest partial matches")
+                for m in ranked:
+                    st.markdown(f"**{m['name']}** — {m['coverage']:.0%} of its symptoms present "
+                                f"(missing: {', '.join(m['missing'])}) — Severity: {m['severity']} — Emergency: {m['emergency']}")
         else:
             for m in matches:
                 st.subheader(m["name"])
@@ -66,29 +129,21 @@ if st.button("Run"):
                 st.write("Why:", m["explanation"])
 
     elif mode == "RAG (Knowledge)":
-        # ensure index loaded
-        rag = load_rag_index()
-        query = user_text if user_text.strip() else ", ".join([k for k,v in symptom_flags.items() if v])
-        results = rag.query(query, top_k=5)
+        results = answer_table.retrieved(symptom_flags, rag_index, user_text, top_k=5) if answer_table else None
+        if results is None:
+            results = rag_index.query(symptom_query(symptom_flags, user_text), top_k=5)
         st.subheader("Retrieved knowledge (top matches)")
         for score, passage in results:
             st.write(f"- (score: {score:.3f}) {passage['text']}")
 
     elif mode == "Hybrid (Rule+RAG+LLM)":
         st.info("Running hybrid engine (rules + RAG + LLM)...")
-        hybrid = HybridEngine()
-        out = hybrid.explain(symptom_flags, user_text)
-        st.subheader("Rule Matches")
-        if not out["rule_matches"]:
-            st.write("No rule matches.")
-        else:
-            for r in out["rule_matches"]:
-                st.markdown(f"**{r['name']}** — Severity: {r['severity']} — Emergency: {r['emergency']}")
-                st.write(r["explanation"])
-
-        st.subheader("Retrieved Context (top)")
-        for score, p in out["retrieved"]:
-            st.write(f"- ({score:.3f}) {p['text'][:400]}")
-
-        st.subheader("LLM Summary (cautious)")
-        st.write(out["llm_summary"])
+        out = hybrid_engine.explain_stream(symptom_flags, user_text)
+        view = {k: out[k] for k in ("rule_matches", "retrieved", "path", "fast_reason") if k in out}
+        if "elaboration" in out:
+            view["elaboration"] = {"future": out["elaboration"]}
+            # kept so the rerun that ends the elaboration polling can redraw this answer
+            st.session_state["hybrid_view"] = (hybrid_inputs, view)
+        show_hybrid(view, out["llm_stream"])
+elif st.session_state.get("hybrid_view", (None,))[0] == hybrid_inputs:
+    show_hybrid(st.session_state["hybrid_view"][1])
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules live flat in src/ (run as `python src/<module>.py` / `uvicorn api:app --app-dir src`)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
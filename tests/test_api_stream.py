@@ -0,0 +1,85 @@
+import json
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import api
+import hybrid_engine
+from hybrid_engine import HybridEngine
+from llm_cache import TieredCache
+from rules_engine import RuleEngine
+
+EMERGENCY = {"chest_pain": True, "shortness_breath": True, "fatigue": True, "fever": False}
+
+
+class StubRAG:
+    """The parts of RAGIndex the hybrid engine touches, without an embedder."""
+    dim = 4
+
+    def query(self, text, top_k=5, mode=None):
+        return [(0.9, {"id": 1, "text": "Chest pain with shortness of breath needs urgent care. Call for help."})]
+
+    def _vecs(self, texts):
+        v = np.ones((len(texts), self.dim), dtype=np.float32)
+        return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+    embed_queries = embed_passages = _vecs
+
+
+def _events(body: str):
+    out = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        out.append((lines["event"], json.loads(lines["data"])))
+    return out
+
+
+@pytest.fixture
+def client(monkeypatch):
+    async def stream(prompt, max_tokens=500):
+        for chunk in ("Possible ", "cardiac ", "event."):
+            yield chunk
+
+    monkeypatch.setattr(hybrid_engine, "stream_with_llm_async", stream)
+    # the shared engine is compact: rule matches are Rule objects, not dicts
+    engine = HybridEngine(rag=StubRAG(), rules=RuleEngine(compiled=True, compact=True), llm_cache=TieredCache([]),
+                          semantic_cache=False, fast_path_llm="deferred")
+    monkeypatch.setattr(api, "get_hybrid_engine", lambda: engine)
+    return TestClient(api.app)
+
+
+@pytest.mark.parametrize("fast_path", ["off", "emergency"])
+def test_sse_hybrid_with_rule_match(client, fast_path):
+    r = client.post("/diagnose", json={"symptoms": EMERGENCY, "mode": "hybrid", "stream": True,
+                                       "fast_path": fast_path})
+    assert r.status_code == 200
+    events = _events(r.text)
+    assert [e for e, _ in events][0] == "context" and events[-1][0] == "done"
+    matches = events[0][1]["rule_matches"]
+    assert matches and all(isinstance(m["conditions"], list) for m in matches)
+    assert any(m["emergency"] for m in matches)
+    text = "".join(d["text"] for e, d in events if e == "chunk")
+    if fast_path == "off":
+        assert text == "Possible cardiac event." and events[-1][1]["path"] == "full"
+    else:
+        assert "rule-based screening result" in text and events[-1][1]["path"] == "fast"
+
+
+def test_json_hybrid_rule_matches_are_dicts(client):
+    r = client.post("/diagnose", json={"symptoms": EMERGENCY, "mode": "hybrid", "fast_path": "emergency"})
+    assert r.status_code == 200
+    assert r.json()["rule_matches"][0]["conditions"]
+
+
+def test_batch_csv_and_json(client):
+    csv = b'id,chest_pain,shortness_breath,fatigue,fever\n"p,1",1,1,1,0\np2,0,0,0,1\n'
+    r = client.post("/diagnose/batch", content=csv, headers={"content-type": "text/csv"})
+    assert r.status_code == 200
+    rows = [json.loads(line) for line in r.text.splitlines()]
+    assert [row["id"] for row in rows] == ["p,1", "p2"]
+    assert rows[0]["emergency"] and not rows[1]["emergency"]
+    r = client.post("/diagnose/batch", json={"patients": [EMERGENCY, {}]})
+    assert [json.loads(line)["emergency"] for line in r.text.splitlines()] == [True, False]
+    r = client.post("/diagnose/batch", content=b"{not json", headers={"content-type": "application/json"})
+    assert r.status_code == 400
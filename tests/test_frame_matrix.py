@@ -0,0 +1,62 @@
+import io
+import json
+
+import pandas as pd
+
+from bulk_triage import read_chunks, run
+from rules_engine import RuleEngine
+
+COHORT = """id,chest_pain,shortness_breath,fatigue,cough,fever
+p0,no,no,no,0,No
+p1,yes,yes,yes,1,Y
+p2,no,Yes,0,true,
+p3,0,1,1,0,no
+"""
+
+
+def _columns(engine, F, names):
+    return F[:, [engine.symptom_index[c] for c in names]].tolist()
+
+
+def test_text_yes_no_columns():
+    engine = RuleEngine(compiled=True)
+    df = pd.read_csv(io.StringIO(COHORT))
+    F = engine.frame_matrix(df)
+    assert _columns(engine, F, ["chest_pain", "shortness_breath", "fatigue", "cough", "fever"]) == [
+        [0, 0, 0, 0, 0],
+        [1, 1, 1, 1, 1],
+        [0, 1, 0, 1, 0],
+        [0, 1, 1, 0, 0],
+    ]
+
+
+def test_bool_and_numeric_columns():
+    engine = RuleEngine(compiled=True)
+    df = pd.DataFrame({"fever": [True, False, None],
+                       "cough": pd.array([True, None, False], dtype="boolean"),
+                       "fatigue": [1.0, 0.0, float("nan")]})
+    F = engine.frame_matrix(df)
+    assert _columns(engine, F, ["fever", "cough", "fatigue"]) == [[1, 1, 1], [0, 0, 0], [0, 0, 0]]
+
+
+def test_bulk_triage_rules_only(tmp_path):
+    src = tmp_path / "cohort.csv"
+    src.write_text(COHORT)
+    out = tmp_path / "out.jsonl"
+    stats = run(str(src), str(out), workers=0, index_dir=None)
+    rows = [json.loads(line) for line in out.read_text().splitlines()]
+    assert stats["rows"] == 4
+    assert [r["id"] for r in rows] == ["p0", "p1", "p2", "p3"]
+    assert rows[0]["symptoms"] == [] and rows[0]["matches"] == [] and not rows[0]["emergency"]
+    assert "fever" in rows[1]["symptoms"] and rows[1]["emergency"]
+    assert rows[2]["matches"] == ["Asthma Attack"]  # shortness_breath "Yes" + cough "true"
+    assert [r["emergency"] for r in rows] == [False, True, True, False]
+
+
+def test_csv_resume_counts_data_rows(tmp_path):
+    src = tmp_path / "notes.csv"
+    src.write_text('id,fever,note\np0,1,"line one\nline two\nline three"\np1,0,plain\np2,1,"a\nb"\np3,0,last\n')
+    ids = lambda chunks: [i for df in chunks for i in df["id"]]
+    assert ids(read_chunks(str(src), chunk_rows=2)) == ["p0", "p1", "p2", "p3"]
+    for skip in range(5):
+        assert ids(read_chunks(str(src), chunk_rows=2, skip_rows=skip)) == ["p0", "p1", "p2", "p3"][skip:]
@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+import pytest
+
+import llm_cache
+from llm_cache import MemoryCache, SQLiteCache, TieredCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(t=1000.0)
+    monkeypatch.setattr(llm_cache, "time", SimpleNamespace(time=lambda: now.t))
+    return now
+
+
+def _keys(cache):
+    return sorted(k for (k,) in cache._conn.execute("SELECT key FROM llm_cache"))
+
+
+def test_sqlite_ttl_expiry(tmp_path, clock):
+    cache = SQLiteCache(str(tmp_path / "c.sqlite"), ttl=100, max_entries=10)
+    cache.put("old", "v1")
+    clock.t += 100
+    assert cache.get("old") == "v1"  # reading does not extend the TTL
+    cache.put("new", "v2")
+    clock.t += 1
+    assert cache.get("old") is None and _keys(cache) == ["new"]  # expired rows are deleted on read
+    clock.t += 100
+    cache.put("newest", "v3")  # and pruned on write
+    assert _keys(cache) == ["newest"]
+
+
+def test_sqlite_lru_eviction_and_sharing(tmp_path, clock):
+    path = str(tmp_path / "c.sqlite")
+    cache = SQLiteCache(path, ttl=0, max_entries=2)
+    for key in ("a", "b"):
+        clock.t += 1
+        cache.put(key, key.upper())
+    clock.t += 1
+    assert cache.get("a") == "A"  # b is now least recently used
+    clock.t += 1
+    cache.put("c", "C")
+    assert _keys(cache) == ["a", "c"]
+    assert SQLiteCache(path, ttl=0).get("c") == "C"  # another process sees the same rows
+
+
+def test_tier_two_hit_is_promoted(tmp_path, clock):
+    memory, disk = MemoryCache(max_entries=4, ttl=100), SQLiteCache(str(tmp_path / "c.sqlite"), ttl=100)
+    cache = TieredCache([memory, disk])
+    disk.put("k", "answer")
+    assert cache.lookup_nonblocking("k") == (None, None)  # never touches SQLite
+    assert cache.lookup("k") == ("answer", "sqlite")
+    assert memory.get("k") == "answer"
+    assert cache.lookup_nonblocking("k") == ("answer", "memory")
+    assert cache.lookup("missing") == (None, None)
+    assert (cache.hits, cache.misses) == (2, 1)
+    clock.t += 101
+    assert cache.lookup("k") == (None, None)  # expired in both tiers
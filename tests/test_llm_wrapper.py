@@ -0,0 +1,77 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import llm_wrapper
+from llm_wrapper import EmptyResponseError, stream_with_llm
+
+
+@pytest.fixture
+def slots(monkeypatch):
+    sem = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(llm_wrapper, "_sync_slots", sem)
+    monkeypatch.setattr(llm_wrapper, "_full_prompt", lambda prompt: prompt)
+    return sem
+
+
+def fake_upstream(monkeypatch, chunks):
+    def open_stream(full_prompt, max_tokens, timeout):
+        it = iter(chunks)
+        return next(it, None), it
+
+    monkeypatch.setattr(llm_wrapper, "_open_stream", open_stream)
+
+
+def slot_freed(sem, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not sem.acquire(blocking=False):
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    sem.release()
+    return True
+
+
+def test_slot_not_held_by_a_slow_consumer(slots, monkeypatch):
+    fake_upstream(monkeypatch, [SimpleNamespace(text=t) for t in ("a", "", "b", "c")])
+    gen = stream_with_llm("prompt")
+    assert next(gen) == "a"
+    assert slot_freed(slots)  # upstream drained while the consumer sits on its first chunk
+    assert list(gen) == ["b", "c"]
+
+
+def test_abandoned_stream_releases_the_slot(slots, monkeypatch):
+    closed = threading.Event()
+
+    def endless():
+        try:
+            while True:
+                time.sleep(0.01)
+                yield SimpleNamespace(text="more ")
+        finally:
+            closed.set()
+
+    fake_upstream(monkeypatch, endless())
+    gen = stream_with_llm("prompt")
+    assert next(gen) == "more "
+    gen.close()
+    assert slot_freed(slots) and closed.wait(2)
+
+
+def test_errors_and_empty_streams(slots, monkeypatch):
+    fake_upstream(monkeypatch, [SimpleNamespace(text="")])
+    with pytest.raises(EmptyResponseError):
+        list(stream_with_llm("prompt"))
+
+    def broken():
+        yield SimpleNamespace(text="partial")
+        raise ConnectionResetError("reset")
+
+    fake_upstream(monkeypatch, broken())
+    gen = stream_with_llm("prompt")
+    assert next(gen) == "partial"
+    with pytest.raises(RuntimeError, match="Gemini error: reset"):
+        next(gen)
+    assert slot_freed(slots)
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from passage_store import PassageStore, PassageStoreWriter
+
+
+def _write(path_dir, texts):
+    with PassageStoreWriter(path_dir) as w:
+        w.append(range(len(texts)), texts)
+
+
+def test_rewrite_under_a_mapped_reader(tmp_path):
+    _write(tmp_path, ["alpha " * 200 + str(i) for i in range(50)])
+    live = PassageStore.open(str(tmp_path))  # mmap, as an API worker holds it
+    _write(tmp_path, ["beta"])
+    assert live[49]["text"].endswith("49")  # old mapping still readable
+    assert [p["text"] for p in PassageStore.open(str(tmp_path))] == ["beta"]
+    assert not [n for n in os.listdir(tmp_path) if ".tmp" in n]
+
+
+def test_failed_write_keeps_the_old_store(tmp_path):
+    _write(tmp_path, ["kept"])
+    with pytest.raises(RuntimeError):
+        with PassageStoreWriter(tmp_path) as w:
+            w.append([0], ["half written"])
+            raise RuntimeError("interrupted")
+    assert [p["text"] for p in PassageStore.open(str(tmp_path))] == ["kept"]
+    assert not [n for n in os.listdir(tmp_path) if ".tmp" in n]
+
+
+def test_save_over_own_mapping(tmp_path):
+    _write(tmp_path, ["one", "two", "three"])
+    store = PassageStore.open(str(tmp_path))
+    store.save(str(tmp_path))
+    assert [p["text"] for p in PassageStore.open(str(tmp_path))] == ["one", "two", "three"]
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from bench_pipeline import HashEmbedder
+from metrics import collect_timings
+from rag import FUSION_DEPTH, RAGIndex, rrf_fuse
+
+TEXTS = [f"passage {i} about fever and cough" for i in range(100)] + ["chest pain radiating to the left arm"]
+
+
+@pytest.fixture(scope="module")
+def rag():
+    rag = RAGIndex(embedder=HashEmbedder(32))
+    rag.build_from_df(pd.DataFrame({"text": TEXTS}))
+    return rag
+
+
+def test_batched_query_reports_stage_timings(rag):
+    rag.enable_batching()
+    try:
+        with collect_timings() as timings:
+            results = rag.query("chest pain, batched", top_k=3)  # new text: an LRU miss, so embed runs
+        assert len(results) == 3
+        assert {"embed", "faiss_search"} <= set(timings)
+    finally:
+        rag.batcher = None
+
+
+def test_rrf_fuse_order_and_ties():
+    scores, positions = rrf_fuse([np.array([3, 1, 2]), np.array([1, 4, -1])], top_k=5, k=0)
+    # 1: 1/2 + 1/1, 3: 1/1, 4: 1/2, 2: 1/3; -1 slots are skipped, unused outputs stay empty
+    assert positions.tolist() == [1, 3, 4, 2, -1]
+    assert scores.tolist() == pytest.approx([1.5, 1.0, 0.5, 1 / 3, 0.0])
+    # equal fused scores: lower passage position first, whichever ranking it came from
+    _, positions = rrf_fuse([np.array([7, 2]), np.array([2, 7])], top_k=2)
+    assert positions.tolist() == [2, 7]
+    _, positions = rrf_fuse([np.array([5]), np.array([4])], top_k=1)
+    assert positions.tolist() == [4]
+
+
+def test_query_modes(rag):
+    query = "radiating to the left arm"
+    with collect_timings() as timings:
+        lexical = rag.query_many([query], top_k=3, mode="lexical")[0]
+    assert lexical[0][1]["text"] == TEXTS[-1]
+    assert "bm25_search" in timings and "embed" not in timings and "faiss_search" not in timings
+
+    _, lex = rag.bm25.search(query, FUSION_DEPTH)
+    dense_depth = rag.search([query], top_k=FUSION_DEPTH, mode="dense")[1][0]
+    scores, positions = rag.search([query], top_k=3, mode="fused")
+    expected_scores, expected_positions = rrf_fuse([dense_depth, lex], 3)
+    assert positions[0].tolist() == expected_positions.tolist()
+    assert scores[0].tolist() == pytest.approx(expected_scores.tolist())
+    assert positions[0][0] == len(TEXTS) - 1  # ranked first lexically, so first after fusion too
+    assert rag.resolve_mode(None) == rag.query_mode
+
+    with pytest.raises(ValueError):
+        rag.search([query], top_k=3, mode="sparse")
+
+
+def test_modes_fall_back_to_dense_without_bm25(rag, monkeypatch):
+    dense = rag.search(["fever"], top_k=3, mode="dense")
+    monkeypatch.setattr(rag, "bm25", None)
+    for mode in ("lexical", "fused"):
+        assert rag.resolve_mode(mode) == "dense"
+        D, I = rag.search(["fever"], top_k=3, mode=mode)
+        assert I.tolist() == dense[1].tolist() and D.tolist() == dense[0].tolist()
+    with pytest.raises(ValueError):
+        rag.resolve_mode("sparse")
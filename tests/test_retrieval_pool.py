@@ -0,0 +1,76 @@
+import os
+import signal
+import time
+from concurrent.futures import wait
+
+import pandas as pd
+import pytest
+
+from bench_pipeline import HashEmbedder
+from rag import RAGIndex
+from retrieval_pool import RetrievalPool
+
+ENCODE_SECONDS = 0.2  # per encode() in the workers, so batches are in flight when a worker is killed
+
+
+class SlowEmbedder(HashEmbedder):
+    def encode(self, texts, **kwargs):
+        time.sleep(ENCODE_SECONDS)
+        return super().encode(texts, **kwargs)
+
+
+def slow_loader(index_dir, backend):
+    rag = RAGIndex(embedder=SlowEmbedder(32))
+    rag.load(index_dir, mmap=True)
+    return rag
+
+
+@pytest.fixture(scope="module")
+def index_dir(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("index"))
+    rag = RAGIndex(embedder=HashEmbedder(32))
+    rag.build_from_df(pd.DataFrame({"text": [f"passage {i} about fever and cough" for i in range(200)]}))
+    rag.save(path)
+    return path
+
+
+def test_killed_worker_fails_its_requests_and_is_replaced(index_dir):
+    pool = RetrievalPool(index_dir, workers=2, max_batch=4, loader=slow_loader).start()
+    try:
+        futures = [pool.submit("search", [f"query {i}"], 3, "dense") for i in range(40)]
+        time.sleep(ENCODE_SECONDS / 2)
+        busy = [w for w in pool._workers if w.taken]
+        assert busy
+        os.kill(busy[0].proc.pid, signal.SIGKILL)
+
+        done, not_done = wait(futures, timeout=20)
+        assert not not_done  # nothing waits for a client timeout, the survivor keeps serving
+        failed = [f for f in futures if f.exception() is not None]
+        assert failed and all("died" in str(f.exception()) for f in failed)
+        assert len(failed) < len(futures)
+
+        deadline = time.monotonic() + 30
+        while pool.stats()["alive"] < 2 or not all(w.ready for w in pool._workers):
+            assert time.monotonic() < deadline
+            time.sleep(0.1)
+        assert pool.stats()["restarts"] == 1
+        # both workers (the replacement included) answer
+        again = [pool.submit("search", [f"again {i}"], 3, "dense") for i in range(16)]
+        assert all(f.result(timeout=20)[1].shape == (1, 3) for f in again)
+        assert pool.stats()["pending"] == 0
+    finally:
+        pool.close()
+
+
+def test_killed_idle_worker_does_not_block_the_others(index_dir):
+    pool = RetrievalPool(index_dir, workers=2, loader=slow_loader).start()
+    try:
+        os.kill(pool._workers[0].proc.pid, signal.SIGKILL)  # blocked waiting for work
+        deadline = time.monotonic() + 10
+        while pool.stats()["restarts"] < 1:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        futures = [pool.submit("embed", [f"text {i}"]) for i in range(8)]
+        assert all(f.result(timeout=20)[0].shape == (1, 32) for f in futures)
+    finally:
+        pool.close()
@@ -0,0 +1,93 @@
+import random
+
+import pytest
+
+from rules_engine import COVERAGE_WEIGHT, DEFAULT_RULES, EMERGENCY_BOOST, SEVERITY_WEIGHTS, RuleEngine
+
+# more than 64 symptoms, so the compiled masks span several uint64 words
+VOCAB = [f"s{i}" for i in range(90)]
+SEVERITIES = list(SEVERITY_WEIGHTS) + ["Unlisted"]
+
+
+def random_rules(rng, n=150):
+    return [{"name": f"rule {i}", "conditions": rng.sample(VOCAB, rng.randint(1, 6)),
+             "severity": rng.choice(SEVERITIES), "emergency": rng.random() < 0.2, "explanation": f"r{i}"}
+            for i in range(n)]
+
+
+def random_facts(rng, rules):
+    """Present, explicitly false, missing and unknown symptoms; sometimes a whole rule present."""
+    facts = {s: rng.random() < 0.3 for s in rng.sample(VOCAB, rng.randint(0, 40))}
+    if rng.random() < 0.5:
+        facts.update(dict.fromkeys(rng.choice(rules)["conditions"], True))
+    if rng.random() < 0.3:
+        facts["not_in_any_rule"] = True
+    return facts
+
+
+def reference_rank(rules, facts, top_k, min_coverage=0.0):
+    present = [k for k, v in facts.items() if v]
+    scored = []
+    for i, r in enumerate(rules):
+        conds = set(r["conditions"])
+        overlap = len(conds.intersection(present))
+        if not overlap:
+            continue
+        coverage = overlap / len(conds)
+        if coverage < min_coverage:
+            continue
+        jaccard = overlap / (len(present) + len(conds) - overlap)
+        weight = SEVERITY_WEIGHTS.get(r["severity"], 1.0) * (EMERGENCY_BOOST if r["emergency"] else 1.0)
+        scored.append(((COVERAGE_WEIGHT * coverage + (1 - COVERAGE_WEIGHT) * jaccard) * weight, i))
+    scored.sort(key=lambda t: (-round(t[0], 6), t[1]))
+    return [(rules[i]["name"], score) for score, i in scored[:top_k]]
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_compiled_evaluate_matches_interpreted(compact):
+    rng = random.Random(0)
+    for _ in range(20):
+        rules = random_rules(rng)
+        interpreted = RuleEngine(rules)
+        compiled = RuleEngine(rules, compiled=True, compact=compact)
+        facts_list = [random_facts(rng, rules) for _ in range(50)]
+        expected = [[r["name"] for r in interpreted.evaluate(f)] for f in facts_list]
+        assert [[r["name"] for r in compiled.evaluate(f)] for f in facts_list] == expected
+        assert [[r["name"] for r in m] for m in compiled.evaluate_many(facts_list)] == expected
+        assert any(expected)  # the generator does produce matches
+
+
+def test_default_rules_every_checklist_combination_sample():
+    rng = random.Random(1)
+    interpreted, compiled = RuleEngine(), RuleEngine(compiled=True, compact=True)
+    symptoms = sorted({c for r in DEFAULT_RULES for c in r["conditions"]})
+    for _ in range(500):
+        facts = {s: rng.random() < 0.4 for s in symptoms if rng.random() < 0.8}
+        assert compiled.evaluate(facts) == interpreted.evaluate(facts)
+
+
+@pytest.mark.parametrize("top_k", [1, 3, 10, 1000])
+def test_rank_order_and_top_k(top_k):
+    rng = random.Random(2)
+    for _ in range(10):
+        rules = random_rules(rng)
+        engine = RuleEngine(rules, compiled=True)
+        for _ in range(30):
+            facts = random_facts(rng, rules)
+            ranked = engine.rank(facts, top_k=top_k)
+            expected = reference_rank(rules, facts, top_k)
+            assert [r["name"] for r in ranked] == [name for name, _ in expected]
+            assert [r["score"] for r in ranked] == pytest.approx([s for _, s in expected], rel=1e-5)
+            assert len(ranked) <= top_k
+
+
+def test_rank_ties_follow_rule_order_and_min_coverage():
+    rules = [{"name": n, "conditions": ["a", "b"], "severity": "Mild", "emergency": False, "explanation": ""}
+             for n in ("first", "second", "third")]
+    engine = RuleEngine(rules, compiled=True)
+    assert [r["name"] for r in engine.rank({"a": True}, top_k=2)] == ["first", "second"]
+    ranked = engine.rank({"a": True, "c": False}, top_k=5, min_coverage=0.5)
+    assert [(r["matched"], r["missing"], r["coverage"]) for r in ranked] == [(["a"], ["b"], 0.5)] * 3
+    assert engine.rank({"a": True}, min_coverage=0.6) == []
+    assert engine.rank({"a": False, "z": True}) == []
+    assert engine.rank({"a": True}, top_k=0) == []
@@ -0,0 +1,46 @@
+import numpy as np
+
+from semantic_cache import SemanticCache
+
+DIM = 4
+FEVER = {"fever": True, "cough": False}
+
+
+def unit(i):
+    v = np.zeros(DIM, dtype=np.float32)
+    v[i] = 1.0
+    return v
+
+
+def at_similarity(sim):
+    """A unit vector whose inner product with unit(0) is exactly sim (for sims exact in float32)."""
+    return np.array([sim, np.sqrt(1 - sim * sim), 0, 0], dtype=np.float32)
+
+
+def test_hit_at_threshold_miss_below():
+    cache = SemanticCache(DIM, max_entries=8, threshold=0.75)
+    cache.put(unit(0), FEVER, "answer")
+    assert cache.lookup(at_similarity(0.75), {"fever": True}) == ("answer", 0.75)  # false flags don't count
+    value, best = cache.lookup(at_similarity(0.625), FEVER)
+    assert value is None and best == 0.625
+    # a near-identical query with different symptom flags never hits
+    assert cache.lookup(unit(0), {"fever": True, "cough": True})[0] is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_lru_eviction_removes_vectors():
+    cache = SemanticCache(DIM, max_entries=2, threshold=0.75)
+    cache.put(unit(0), FEVER, "a")
+    cache.put(unit(1), FEVER, "b")
+    assert cache.lookup(unit(0), FEVER)[0] == "a"  # a is now the most recently used
+    cache.put(unit(2), FEVER, "c")
+    assert len(cache) == 2 and cache.index.ntotal == 2 and cache.evictions == 1
+    assert cache.lookup(unit(1), FEVER) == (None, 0.0)  # b's vector left the index too
+    assert cache.lookup(unit(0), FEVER)[0] == "a"
+    assert cache.lookup(unit(2), FEVER)[0] == "c"
+
+
+def test_disabled_cache_stores_nothing():
+    cache = SemanticCache(DIM, max_entries=0)
+    cache.put(unit(0), FEVER, "a")
+    assert len(cache) == 0 and cache.lookup(unit(0), FEVER) == (None, 0.0)